@@ -1,12 +1,35 @@
-from flask import Flask, render_template, request, send_from_directory
-from flask_socketio import SocketIO, emit, join_room, leave_room
+import server_config
+server_config.monkey_patch()
+
+import logs
+logs.setup_logging()
+
+from flask import Flask, request, jsonify
+from flask_socketio import SocketIO, emit
 from datetime import datetime
+import logging
 import os
-import uuid
-import random
-import string
+import atexit
 from werkzeug.utils import secure_filename
-import base64
+from chunked_upload import ChunkedUploadManager, UploadError
+from upload_serving import serve_blob, serve_upload
+from blob_store import create_blob_store
+from thumbnails import Previews, THUMB_SUFFIX
+from worker_pool import PoolFull, WorkerPool
+from message_store import create_message_store, HISTORY_PAGE_SIZE
+from cluster import create_cluster
+from room_lifecycle import RoomLifecycle
+from broadcast import BroadcastBatcher
+from codec import json_codec
+from wire import Wire
+from rate_limit import RateLimiter
+from metrics import ChatMetrics
+from static_assets import StaticAssets
+import profiling
+from presence import PresenceBroadcaster
+from typing_indicator import TypingAggregator
+
+log = logging.getLogger('chat')
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
@@ -17,12 +40,52 @@ os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'mp4', 'webm', 'pdf', 'txt', 'doc', 'docx'}
 
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+# Room codes, membership and broadcasts can be shared between workers (see CLUSTER_URL)
+state, client_manager = create_cluster()
 
-# Store active users and rooms
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=server_config.ASYNC_MODE, client_manager=client_manager,
+                    json=json_codec())
+
+# Users connected to this process
 users = {}
-rooms = {}
-room_codes = {}  # Maps codes to room names
+
+# Per-connection, per-address and per-room event limits (see RATE_LIMITS)
+limiter = RateLimiter(room_of=lambda sid: users.get(sid, {}).get('room'))
+
+# JSON or MessagePack per client for outgoing events (see wire.py)
+wire = Wire(socketio)
+
+# Chat messages go out in short per-room batches (see BROADCAST_WINDOW_MS)
+messages_out = BroadcastBatcher(socketio, 'receive_messages', emit=wire.broadcast)
+
+# Sends online-user changes as versioned deltas, batched per tick
+presence = PresenceBroadcaster(socketio, state, emit=wire.broadcast)
+
+# Who is typing, broadcast per room on a fixed tick instead of per keypress
+typing = TypingAggregator(socketio, emit=wire.broadcast)
+
+# Room history, kept in memory or in an on-disk log (see MESSAGE_STORE)
+message_store = create_message_store()
+atexit.register(message_store.close)
+
+# Counters and histograms served at /metrics
+metrics = ChatMetrics(socketio, state, message_store, wire)
+
+# Idle rooms give up their history and, later, their codes (see ROOM_IDLE_TIMEOUT)
+lifecycle = RoomLifecycle(socketio, state, message_store)
+
+uploads = ChunkedUploadManager(app.config['UPLOAD_FOLDER'], app.config['MAX_CONTENT_LENGTH'])
+
+# Chunk writes run here, off the event path; a full pool asks clients to retry
+upload_io = WorkerPool(socketio, workers=4, max_pending=64)
+
+# Finished uploads, stored once per distinct content; a blob goes once no message in history uses it
+blobs = create_blob_store(app.config['UPLOAD_FOLDER'])
+atexit.register(blobs.close)
+message_store.on_discard = blobs.release_messages
+
+# Thumbnails and video poster frames, built off the event path
+previews = Previews(blobs, WorkerPool(socketio, workers=2))
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -36,145 +99,186 @@ def get_file_type(filename):
     else:
         return 'file'
 
-def generate_room_code():
-    import random
-    import string
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+# Minified, precompressed stylesheet and script under content-hashed names (see static_assets.py)
+assets = StaticAssets(app)
+
+# Rendered once; it only changes when the assets it links to do
+index_page = assets.page('index.html', msgpack=wire.msgpack_enabled)
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return assets.send(index_page)
+
+@app.route('/uploads/<digest>/<filename>')
+def uploaded_blob(digest, filename):
+    return serve_blob(blobs, digest, filename)
+
+@app.route('/thumbs/<digest>.jpg')
+def thumbnail(digest):
+    return serve_blob(blobs, digest, 'thumb.jpg', suffix=THUMB_SUFFIX)
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return serve_upload(app.config['UPLOAD_FOLDER'], filename)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return metrics.endpoint()
+
+@app.route('/api/rooms/<code>/messages')
+@limiter.limit_request('room_messages')
+def room_messages(code):
+    room = state.get_code(code.upper())
+    if room is None:
+        return jsonify({'error': 'Invalid room code'}), 404
+    
+    limit = max(1, min(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), HISTORY_PAGE_SIZE))
+    before_id = request.args.get('before_id', type=int)
+    if before_id is None:
+        messages = message_store.recent(room, limit)
+    else:
+        messages = message_store.before(room, before_id, limit)
+    
+    return jsonify({'messages': messages})
 
 @socketio.on('connect')
-def handle_connect():
-    print(f'Client connected: {request.sid}')
+def handle_connect(auth=None):
+    codec = wire.connect(request.sid, auth)
+    log.debug('connected (%s)', codec, extra={'event': 'connect', 'sid': request.sid})
 
 @socketio.on('test_connection')
 def handle_test_connection():
-    print(f'Connection test from: {request.sid}')
+    log.debug('connection test', extra={'event': 'test_connection', 'sid': request.sid})
     emit('connection_confirmed')
 
 @socketio.on('disconnect')
+@metrics.timed('disconnect')
 def handle_disconnect():
-    print(f'Client disconnected: {request.sid}')
+    log.debug('disconnected', extra={'event': 'disconnect', 'sid': request.sid})
+    wire.disconnect(request.sid)
+    limiter.forget(request.sid)
     if request.sid in users:
         username = users[request.sid]['username']
-        room = users[request.sid]['room']
         
-        if room in rooms and username in rooms[room]['users']:
-            rooms[room]['users'].remove(username)
+        typing.stop(users[request.sid]['room'], request.sid)
         
-        emit('user_left', {
-            'username': username,
-            'timestamp': datetime.now().strftime('%H:%M')
-        }, room=room)
-        
-        emit('update_users', {'users': rooms[room]['users']}, room=room)
+        # The reverse index knows every room this sid was in
+        for room, version in state.leave_all(request.sid):
+            presence.left(room, request.sid, version)
+            lifecycle.touch(room)
+            wire.broadcast('user_left', {
+                'username': username,
+                'timestamp': datetime.now().strftime('%H:%M')
+            }, room)
         del users[request.sid]
 
 @socketio.on('create_room')
+@metrics.timed('create_room')
+@limiter.limit('create_room')
 def handle_create_room(data):
     try:
         username = data['username']
         room_name = data.get('room_name', 'general')
         
-        print(f"Creating room for {username}, room: {room_name}")
-        
-        # Generate unique code
-        code = generate_room_code()
-        while code in room_codes:
-            code = generate_room_code()
-        
-        print(f"Generated code: {code}")
-        
-        # Store mapping
-        room_codes[code] = room_name
-        
-        # Create room if doesn't exist
-        if room_name not in rooms:
-            rooms[room_name] = {'users': [], 'messages': []}
+        # A room keeps its code; only a new room gets one (see code_allocator.py)
+        code = state.allocate_code(room_name)
         
         # Store user info
         users[request.sid] = {'username': username, 'room': room_name}
         
         # Join room
-        join_room(room_name)
-        rooms[room_name]['users'].append(username)
-        
-        print(f"User {username} joined room {room_name}")
+        wire.join(request.sid, room_name)
+        version = state.add_member(room_name, request.sid, username)
+        presence.joined(room_name, request.sid, username, version)
+        lifecycle.touch(room_name)
         
         # Send response
-        emit('room_created', {
+        wire.send('room_created', {
             'room_name': room_name,
             'code': code,
-            'messages': rooms[room_name]['messages']
-        })
+            'messages': message_store.recent(room_name, HISTORY_PAGE_SIZE),
+            'presence': presence.snapshot(room_name)
+        }, request.sid)
         
         # Notify others
-        emit('user_joined', {
+        wire.broadcast('user_joined', {
             'username': username,
             'timestamp': datetime.now().strftime('%H:%M')
-        }, room=room_name)
+        }, room_name)
         
-        emit('update_users', {'users': rooms[room_name]['users']}, room=room_name)
-        print(f'{username} created room {room_name} with code {code}')
+        log.info('created room with code %s', code, extra={'event': 'create_room', 'room': room_name, 'user': username})
         
-    except Exception as e:
-        print(f"Error creating room: {e}")
+    except Exception:
+        log.exception('Error creating room', extra={'event': 'create_room'})
         emit('join_error', {'message': 'Failed to create room'})
 
 @socketio.on('join_with_code')
+@metrics.timed('join_with_code')
+@limiter.limit('join_with_code')
 def handle_join_with_code(data):
     try:
         username = data['username']
         code = data['code'].upper()
         
-        print(f"User {username} trying to join with code {code}")
-        
-        if code not in room_codes:
-            print(f"Invalid code: {code}")
+        room_name = state.get_code(code)
+        if room_name is None:
+            log.info('invalid code', extra={'event': 'join_with_code', 'code': code, 'user': username})
             emit('join_error', {'message': 'Invalid room code'})
             return
         
-        room_name = room_codes[code]
-        print(f"Code {code} maps to room {room_name}")
-        
-        # Create room if doesn't exist
-        if room_name not in rooms:
-            rooms[room_name] = {'users': [], 'messages': []}
-        
         # Store user info
         users[request.sid] = {'username': username, 'room': room_name}
         
         # Join room
-        join_room(room_name)
-        rooms[room_name]['users'].append(username)
+        wire.join(request.sid, room_name)
+        version = state.add_member(room_name, request.sid, username)
+        presence.joined(room_name, request.sid, username, version)
+        lifecycle.touch(room_name)
         
         # Send response
-        emit('room_joined', {
+        wire.send('room_joined', {
             'room_name': room_name,
             'code': code,
-            'messages': rooms[room_name]['messages']
-        })
+            'messages': message_store.recent(room_name, HISTORY_PAGE_SIZE),
+            'presence': presence.snapshot(room_name)
+        }, request.sid)
         
         # Notify others
-        emit('user_joined', {
+        wire.broadcast('user_joined', {
             'username': username,
             'timestamp': datetime.now().strftime('%H:%M')
-        }, room=room_name)
+        }, room_name)
         
-        emit('update_users', {'users': rooms[room_name]['users']}, room=room_name)
-        print(f'{username} joined room {room_name} with code {code}')
+        log.info('joined with code %s', code, extra={'event': 'join_with_code', 'room': room_name, 'user': username})
         
-    except Exception as e:
-        print(f"Error joining room: {e}")
+    except Exception:
+        log.exception('Error joining room', extra={'event': 'join_with_code'})
         emit('join_error', {'message': 'Failed to join room'})
 
+@socketio.on('presence_sync')
+@limiter.limit('presence_sync')
+def handle_presence_sync():
+    if request.sid not in users:
+        return {'version': 0, 'users': []}
+    return presence.snapshot(users[request.sid]['room'])
+
+@socketio.on('fetch_history')
+@limiter.limit('fetch_history')
+def handle_fetch_history(data):
+    if request.sid not in users:
+        return {'messages': []}
+    
+    room = users[request.sid]['room']
+    try:
+        before_id = int(data['before_id'])
+        limit = max(1, min(int(data.get('limit', HISTORY_PAGE_SIZE)), HISTORY_PAGE_SIZE))
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return {'messages': [], 'error': 'before_id and limit must be numbers'}
+    return {'messages': message_store.before(room, before_id, limit)}
+
 @socketio.on('send_message')
+@metrics.timed('send_message')
+@limiter.limit('send_message')
 def handle_message(data):
     if request.sid not in users:
         return
@@ -191,73 +295,132 @@ def handle_message(data):
     }
     
     # Store message
-    rooms[room]['messages'].append(message_data)
+    message_store.append(room, message_data)
     
-    # Keep only last 100 messages
-    if len(rooms[room]['messages']) > 100:
-        rooms[room]['messages'] = rooms[room]['messages'][-100:]
+    # Sending a message ends the sender's typing
+    typing.stop(room, request.sid)
     
     # Broadcast to room
-    emit('receive_message', message_data, room=room)
-    print(f'{username} in {room}: {message}')
+    messages_out.send(room, message_data)
+    metrics.message_sent(room)
+    log.debug('message of %d chars', len(message), extra={'event': 'send_message', 'room': room, 'user': username})
 
-@socketio.on('upload_file')
-def handle_file_upload(data):
-    if request.sid not in users:
-        return
+def post_file_message(username, room, filename, size, digest):
+    """Store and broadcast a message sharing the blob `digest`, with its preview if one can be made.
+
+    The caller has already referenced the blob from `room`.
+    """
+    file_type = get_file_type(filename)
     
-    username = users[request.sid]['username']
-    room = users[request.sid]['room']
+    def post(preview):
+        file_info = {
+            'filename': filename,
+            'url': f'/uploads/{digest}/{filename}',
+            'type': file_type,
+            'size': size,
+            'sha256': digest
+        }
+        if preview:
+            # Original and thumbnail dimensions, so clients can reserve the space
+            file_info.update(preview, thumbnail=f'/thumbs/{digest}.jpg')
+        
+        message_data = {
+            'username': username,
+            'message': '',
+            'timestamp': datetime.now().strftime('%H:%M'),
+            'file': file_info
+        }
+        message_store.append(room, message_data)
+        messages_out.send(room, message_data)
+        metrics.message_sent(room)
     
+    previews.request(digest, file_type, post)
+
+@socketio.on('upload_start')
+@metrics.timed('upload_start')
+@limiter.limit('upload_start')
+def handle_upload_start(data):
     try:
-        file_data = base64.b64decode(data['file_data'].split(',')[1])
         filename = secure_filename(data['filename'])
+        size = int(data['size'])
+        upload_id = data.get('upload_id')
         
         if not allowed_file(filename):
-            emit('upload_error', {'message': 'File type not allowed'})
-            return
-        
-        unique_filename = f"{uuid.uuid4()}_{filename}"
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        
-        with open(file_path, 'wb') as f:
-            f.write(file_data)
-        
-        timestamp = datetime.now().strftime('%H:%M')
-        message_data = {
-            'username': username,
-            'message': '',
-            'timestamp': timestamp,
-            'file': {
-                'filename': filename,
-                'url': f'/uploads/{unique_filename}',
-                'type': get_file_type(filename),
-                'size': len(file_data)
-            }
+            return {'error': 'File type not allowed'}
+        
+        # Only a fresh upload needs a room; a resumed one already knows its room
+        user = users.get(request.sid, {})
+        if not user and upload_id not in uploads.sessions:
+            return {'error': 'Join a room first'}
+        
+        # Same bytes as a file this room already shares: nothing needs to be sent.
+        # Only this room's, since a client could claim any digest it has seen.
+        sha256 = data.get('sha256')
+        if (user and not upload_id and blobs.size(sha256) == size
+                and blobs.add_ref_if_shared(user['room'], sha256)):
+            post_file_message(user['username'], user['room'], filename, size, sha256)
+            emit('file_uploaded', {'success': True})
+            return {'offset': size, 'done': True}
+        
+        session = uploads.start(filename, size, user.get('username'), user.get('room'),
+                                upload_id=upload_id)
+        
+        return {
+            'upload_id': session.upload_id,
+            'offset': session.received,
+            'chunk_size': uploads.chunk_size
         }
         
-        rooms[room]['messages'].append(message_data)
+    except UploadError as e:
+        return {'error': str(e)}
+    except Exception:
+        log.exception('Upload start error', extra={'event': 'upload_start'})
+        return {'error': 'Upload failed'}
+
+@socketio.on('upload_chunk')
+@metrics.timed('upload_chunk')
+@limiter.limit('upload_chunk')
+def handle_upload_chunk(data):
+    try:
+        upload_id = data['upload_id']
+        session, written = upload_io.call(uploads.write_chunk, upload_id, int(data['offset']), data['data'])
+        # Resent chunks are ignored, so they don't count
+        metrics.upload_bytes.inc(written)
         
-        if len(rooms[room]['messages']) > 100:
-            rooms[room]['messages'] = rooms[room]['messages'][-100:]
+        if session.received < session.size:
+            return {'offset': session.received}
         
-        emit('receive_message', message_data, room=room)
+        session = upload_io.call(uploads.finish, upload_id, blobs)
+        post_file_message(session.username, session.room, session.filename, session.size, session.digest)
         emit('file_uploaded', {'success': True})
-        
-    except Exception as e:
-        emit('upload_error', {'message': 'Upload failed'})
-        print(f"Upload error: {e}")
+        return {'offset': session.received, 'done': True}
+        
+    except PoolFull:
+        return {'busy': True}
+    except UploadError as e:
+        return {'error': str(e)}
+    except Exception:
+        log.exception('Upload error', extra={'event': 'upload_chunk'})
+        return {'error': 'Upload failed'}
 
 @socketio.on('typing')
-def handle_typing():
-    if request.sid not in users:
+@limiter.limit('typing')
+def handle_typing(data=None):
+    if request.sid not in users or not (data is None or isinstance(data, dict)):
         return
     
     username = users[request.sid]['username']
     room = users[request.sid]['room']
     
-    emit('user_typing', {'username': username}, room=room, include_self=False)
+    # Older clients send a bare 'typing' on every keypress
+    if data is None or data.get('typing', True):
+        typing.start(room, request.sid, username)
+    else:
+        typing.stop(room, request.sid)
+
+# Per-event handler timings and sampling profiles, when PROFILING is set
+profiling.install(app, socketio)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
-    socketio.run(app, debug=True, host='0.0.0.0', port=port, allow_unsafe_werkzeug=True)
+    socketio.run(app, host='0.0.0.0', port=port, **server_config.run_options(debug=True))
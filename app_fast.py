@@ -1,136 +1,211 @@
-from flask import Flask, render_template, request
-from flask_socketio import SocketIO, emit, join_room
+import server_config
+server_config.monkey_patch()
+
+import logs
+logs.setup_logging()
+
+from flask import Flask, request, jsonify
+from flask_socketio import SocketIO, emit
 from datetime import datetime
+import logging
 import os
+import atexit
+from message_store import create_message_store, HISTORY_PAGE_SIZE
+from cluster import create_cluster
+from room_lifecycle import RoomLifecycle
+from broadcast import BroadcastBatcher
+from codec import json_codec
+from wire import Wire
+from rate_limit import RateLimiter
+from metrics import ChatMetrics
+from static_assets import StaticAssets
+import profiling
+from presence import PresenceBroadcaster
+
+log = logging.getLogger('chat')
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
 
-# Use threading for faster local development
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+# Room codes, membership and broadcasts can be shared between workers (see CLUSTER_URL)
+state, client_manager = create_cluster()
 
-# Store active users and rooms
+# Threading by default for faster local development (see ASYNC_MODE)
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=server_config.ASYNC_MODE, client_manager=client_manager,
+                    json=json_codec())
+
+# Users connected to this process
 users = {}
-rooms = {}
-room_codes = {}
 
-def generate_room_code():
-    import random
-    import string
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+# Per-connection, per-address and per-room event limits (see RATE_LIMITS)
+limiter = RateLimiter(room_of=lambda sid: users.get(sid, {}).get('room'))
+
+# JSON or MessagePack per client for outgoing events (see wire.py)
+wire = Wire(socketio)
+
+# Chat messages go out in short per-room batches (see BROADCAST_WINDOW_MS)
+messages_out = BroadcastBatcher(socketio, 'receive_messages', emit=wire.broadcast)
+
+# Sends online-user changes as versioned deltas, batched per tick
+presence = PresenceBroadcaster(socketio, state, emit=wire.broadcast)
+
+# Room history, kept in memory or in an on-disk log (see MESSAGE_STORE)
+message_store = create_message_store()
+atexit.register(message_store.close)
+
+# Counters and histograms served at /metrics
+metrics = ChatMetrics(socketio, state, message_store, wire)
+
+# Idle rooms give up their history and, later, their codes (see ROOM_IDLE_TIMEOUT)
+lifecycle = RoomLifecycle(socketio, state, message_store)
+
+# Minified, precompressed stylesheet and script under content-hashed names (see static_assets.py)
+assets = StaticAssets(app)
+
+# Rendered once; it only changes when the assets it links to do
+index_page = assets.page('index.html', msgpack=wire.msgpack_enabled)
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return assets.send(index_page)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return metrics.endpoint()
+
+@app.route('/api/rooms/<code>/messages')
+@limiter.limit_request('room_messages')
+def room_messages(code):
+    room = state.get_code(code.upper())
+    if room is None:
+        return jsonify({'error': 'Invalid room code'}), 404
+    
+    limit = max(1, min(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), HISTORY_PAGE_SIZE))
+    before_id = request.args.get('before_id', type=int)
+    if before_id is None:
+        messages = message_store.recent(room, limit)
+    else:
+        messages = message_store.before(room, before_id, limit)
+    
+    return jsonify({'messages': messages})
 
 @socketio.on('connect')
-def handle_connect():
-    print(f'Client connected: {request.sid}')
+def handle_connect(auth=None):
+    codec = wire.connect(request.sid, auth)
+    log.debug('connected (%s)', codec, extra={'event': 'connect', 'sid': request.sid})
 
 @socketio.on('test_connection')
 def handle_test_connection():
-    print(f'Connection test from: {request.sid}')
+    log.debug('connection test', extra={'event': 'test_connection', 'sid': request.sid})
     emit('connection_confirmed')
 
 @socketio.on('create_room')
+@metrics.timed('create_room')
+@limiter.limit('create_room')
 def handle_create_room(data):
     try:
         username = data['username']
         room_name = data.get('room_name', 'general')
         
-        print(f"Creating room for {username}, room: {room_name}")
-        
-        # Generate unique code
-        code = generate_room_code()
-        while code in room_codes:
-            code = generate_room_code()
-        
-        print(f"Generated code: {code}")
-        
-        # Store mapping
-        room_codes[code] = room_name
-        
-        # Create room if doesn't exist
-        if room_name not in rooms:
-            rooms[room_name] = {'users': [], 'messages': []}
+        # A room keeps its code; only a new room gets one (see code_allocator.py)
+        code = state.allocate_code(room_name)
         
         # Store user info
         users[request.sid] = {'username': username, 'room': room_name}
         
         # Join room
-        join_room(room_name)
-        rooms[room_name]['users'].append(username)
-        
-        print(f"User {username} joined room {room_name}")
+        wire.join(request.sid, room_name)
+        version = state.add_member(room_name, request.sid, username)
+        presence.joined(room_name, request.sid, username, version)
+        lifecycle.touch(room_name)
         
         # Send response
-        emit('room_created', {
+        wire.send('room_created', {
             'room_name': room_name,
             'code': code,
-            'messages': rooms[room_name]['messages']
-        })
+            'messages': message_store.recent(room_name, HISTORY_PAGE_SIZE),
+            'presence': presence.snapshot(room_name)
+        }, request.sid)
         
         # Notify others
-        emit('user_joined', {
+        wire.broadcast('user_joined', {
             'username': username,
             'timestamp': datetime.now().strftime('%H:%M')
-        }, room=room_name)
+        }, room_name)
         
-        emit('update_users', {'users': rooms[room_name]['users']}, room=room_name)
-        print(f'{username} created room {room_name} with code {code}')
+        log.info('created room with code %s', code, extra={'event': 'create_room', 'room': room_name, 'user': username})
         
-    except Exception as e:
-        print(f"Error creating room: {e}")
+    except Exception:
+        log.exception('Error creating room', extra={'event': 'create_room'})
         emit('join_error', {'message': 'Failed to create room'})
 
 @socketio.on('join_with_code')
+@metrics.timed('join_with_code')
+@limiter.limit('join_with_code')
 def handle_join_with_code(data):
     try:
         username = data['username']
         code = data['code'].upper()
         
-        print(f"User {username} trying to join with code {code}")
-        
-        if code not in room_codes:
-            print(f"Invalid code: {code}")
+        room_name = state.get_code(code)
+        if room_name is None:
+            log.info('invalid code', extra={'event': 'join_with_code', 'code': code, 'user': username})
             emit('join_error', {'message': 'Invalid room code'})
             return
         
-        room_name = room_codes[code]
-        print(f"Code {code} maps to room {room_name}")
-        
-        # Create room if doesn't exist
-        if room_name not in rooms:
-            rooms[room_name] = {'users': [], 'messages': []}
-        
         # Store user info
         users[request.sid] = {'username': username, 'room': room_name}
         
         # Join room
-        join_room(room_name)
-        rooms[room_name]['users'].append(username)
+        wire.join(request.sid, room_name)
+        version = state.add_member(room_name, request.sid, username)
+        presence.joined(room_name, request.sid, username, version)
+        lifecycle.touch(room_name)
         
         # Send response
-        emit('room_joined', {
+        wire.send('room_joined', {
             'room_name': room_name,
             'code': code,
-            'messages': rooms[room_name]['messages']
-        })
+            'messages': message_store.recent(room_name, HISTORY_PAGE_SIZE),
+            'presence': presence.snapshot(room_name)
+        }, request.sid)
         
         # Notify others
-        emit('user_joined', {
+        wire.broadcast('user_joined', {
             'username': username,
             'timestamp': datetime.now().strftime('%H:%M')
-        }, room=room_name)
+        }, room_name)
         
-        emit('update_users', {'users': rooms[room_name]['users']}, room=room_name)
-        print(f'{username} joined room {room_name} with code {code}')
+        log.info('joined with code %s', code, extra={'event': 'join_with_code', 'room': room_name, 'user': username})
         
-    except Exception as e:
-        print(f"Error joining room: {e}")
+    except Exception:
+        log.exception('Error joining room', extra={'event': 'join_with_code'})
         emit('join_error', {'message': 'Failed to join room'})
 
+@socketio.on('presence_sync')
+@limiter.limit('presence_sync')
+def handle_presence_sync():
+    if request.sid not in users:
+        return {'version': 0, 'users': []}
+    return presence.snapshot(users[request.sid]['room'])
+
+@socketio.on('fetch_history')
+@limiter.limit('fetch_history')
+def handle_fetch_history(data):
+    if request.sid not in users:
+        return {'messages': []}
+    
+    room = users[request.sid]['room']
+    try:
+        before_id = int(data['before_id'])
+        limit = max(1, min(int(data.get('limit', HISTORY_PAGE_SIZE)), HISTORY_PAGE_SIZE))
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return {'messages': [], 'error': 'before_id and limit must be numbers'}
+    return {'messages': message_store.before(room, before_id, limit)}
+
 @socketio.on('send_message')
+@metrics.timed('send_message')
+@limiter.limit('send_message')
 def handle_message(data):
     if request.sid not in users:
         return
@@ -147,34 +222,35 @@ def handle_message(data):
     }
     
     # Store message
-    rooms[room]['messages'].append(message_data)
-    
-    # Keep only last 100 messages
-    if len(rooms[room]['messages']) > 100:
-        rooms[room]['messages'] = rooms[room]['messages'][-100:]
+    message_store.append(room, message_data)
     
     # Broadcast to room
-    emit('receive_message', message_data, room=room)
-    print(f'{username} in {room}: {message}')
+    messages_out.send(room, message_data)
+    metrics.message_sent(room)
+    log.debug('message of %d chars', len(message), extra={'event': 'send_message', 'room': room, 'user': username})
 
 @socketio.on('disconnect')
+@metrics.timed('disconnect')
 def handle_disconnect():
-    print(f'Client disconnected: {request.sid}')
+    log.debug('disconnected', extra={'event': 'disconnect', 'sid': request.sid})
+    wire.disconnect(request.sid)
+    limiter.forget(request.sid)
     if request.sid in users:
         username = users[request.sid]['username']
-        room = users[request.sid]['room']
-        
-        if room in rooms and username in rooms[room]['users']:
-            rooms[room]['users'].remove(username)
         
-        emit('user_left', {
-            'username': username,
-            'timestamp': datetime.now().strftime('%H:%M')
-        }, room=room)
-        
-        emit('update_users', {'users': rooms[room]['users']}, room=room)
+        # The reverse index knows every room this sid was in
+        for room, version in state.leave_all(request.sid):
+            presence.left(room, request.sid, version)
+            lifecycle.touch(room)
+            wire.broadcast('user_left', {
+                'username': username,
+                'timestamp': datetime.now().strftime('%H:%M')
+            }, room)
         del users[request.sid]
 
+# Per-event handler timings and sampling profiles, when PROFILING is set
+profiling.install(app, socketio)
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     print(f"Starting server on port {port}")
@@ -182,7 +258,7 @@ if __name__ == '__main__':
     # Use different settings for production vs development
     if os.environ.get('RENDER'):
         # Production settings for Render
-        socketio.run(app, host='0.0.0.0', port=port, debug=False)
+        socketio.run(app, host='0.0.0.0', port=port, **server_config.run_options(debug=False))
     else:
         # Development settings
-        socketio.run(app, debug=True, host='0.0.0.0', port=port, allow_unsafe_werkzeug=True)
\ No newline at end of file
+        socketio.run(app, host='0.0.0.0', port=port, **server_config.run_options(debug=True))
\ No newline at end of file
@@ -0,0 +1,158 @@
+"""Connection-count benchmark for the ASYNC_MODE settings.
+
+Starts a server in a subprocess for each mode, opens N idle Socket.IO
+websocket connections against it and reports how fast they connected and
+what the server process costs while holding them (RSS and OS threads).
+
+    python bench_connections.py [--clients 2000] [--modes threading eventlet gevent] [--server app_fast]
+
+The clients are plain asyncio sockets speaking just enough of the websocket
+and Engine.IO protocols to connect and answer pings, so one benchmark
+process can hold thousands of them. Raise `ulimit -n` for large counts.
+"""
+import argparse
+import asyncio
+import base64
+import os
+import socket
+import subprocess
+import sys
+import time
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def ws_frame(text):
+    # Client frames must be masked; an all-zero mask keeps the payload as-is
+    payload = text.encode()
+    return bytes([0x81, 0x80 | len(payload)]) + b'\0\0\0\0' + payload
+
+
+async def read_frame(reader):
+    head = await reader.readexactly(2)
+    length = head[1] & 0x7f
+    if length == 126:
+        length = int.from_bytes(await reader.readexactly(2), 'big')
+    elif length == 127:
+        length = int.from_bytes(await reader.readexactly(8), 'big')
+    return (await reader.readexactly(length)).decode(errors='replace')
+
+
+async def idle_client(port, connected, stop, handshakes):
+    # `handshakes` limits how many clients are mid-handshake at once, so we
+    # don't race too far ahead of the server's accept loop
+    async with handshakes:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write((
+            'GET /socket.io/?EIO=4&transport=websocket HTTP/1.1\r\n'
+            f'Host: 127.0.0.1:{port}\r\n'
+            'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+            f'Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n'
+        ).encode())
+        await reader.readuntil(b'\r\n\r\n')
+
+        await read_frame(reader)            # Engine.IO open packet
+        writer.write(ws_frame('40'))        # Socket.IO connect
+        while not (await read_frame(reader)).startswith('40'):
+            pass
+        connected.append(time.perf_counter())
+
+    # Stay connected, answering pings, until the benchmark is done
+    while not stop.is_set():
+        try:
+            frame = await asyncio.wait_for(read_frame(reader), 1)
+        except asyncio.TimeoutError:
+            continue
+        if frame == '2':
+            writer.write(ws_frame('3'))
+    writer.close()
+
+
+def server_stats(pid):
+    stats = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'Threads'):
+                stats[key] = int(value.split()[0])
+    return stats
+
+
+async def run_clients(port, clients, concurrency):
+    connected = []
+    stop = asyncio.Event()
+    handshakes = asyncio.Semaphore(concurrency)
+
+    start = time.perf_counter()
+    tasks = [asyncio.ensure_future(idle_client(port, connected, stop, handshakes))
+             for _ in range(clients)]
+    while len(connected) + sum(1 for t in tasks if t.done()) < clients:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+
+    failed = sum(1 for t in tasks if t.done() and t.exception() is not None)
+    return connected, elapsed, failed, stop, tasks
+
+
+# Run the server without debug so there is no reloader process in the way
+RUN_SERVER = """
+import sys, server_config
+server_config.monkey_patch()
+server = __import__(sys.argv[1])
+server.socketio.run(server.app, port=int(sys.argv[2]), **server_config.run_options())
+"""
+
+
+def bench_mode(mode, clients, concurrency, server_module):
+    port = free_port()
+    env = dict(os.environ, ASYNC_MODE=mode)
+    server = subprocess.Popen([sys.executable, '-c', RUN_SERVER, server_module, str(port)], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            if server.poll() is not None:
+                print(f'{mode:10} server did not start (is {mode} installed?)')
+                return
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        idle = server_stats(server.pid)
+
+        async def main():
+            connected, elapsed, failed, stop, tasks = await run_clients(port, clients, concurrency)
+            await asyncio.sleep(1)
+            loaded = server_stats(server.pid)
+            stop.set()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            return connected, elapsed, failed, loaded
+
+        connected, elapsed, failed, loaded = asyncio.run(main())
+    finally:
+        server.terminate()
+        server.wait()
+
+    rate = len(connected) / elapsed if elapsed else 0
+    per_conn = (loaded['VmRSS'] - idle['VmRSS']) / max(len(connected), 1)
+    print(f'{mode:10} {len(connected):7d} {failed:7d} {rate:10.0f} '
+          f'{loaded["VmRSS"] / 1024:9.1f} {per_conn:9.1f} {loaded["Threads"]:8d}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=100,
+                        help='connections allowed to be mid-handshake at once')
+    parser.add_argument('--modes', nargs='+', default=['threading', 'eventlet', 'gevent'])
+    parser.add_argument('--server', default='app_fast', help='server module to run')
+    args = parser.parse_args()
+
+    print(f'{"mode":10} {"clients":>7} {"failed":>7} {"conn/s":>10} {"RSS MiB":>9} {"KiB/conn":>9} {"threads":>8}')
+    for mode in args.modes:
+        bench_mode(mode, args.clients, args.concurrency, args.server)
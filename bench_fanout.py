@@ -0,0 +1,90 @@
+"""CPU cost of one room broadcast, by room size and JSON codec.
+
+Builds a python-socketio server with N members in one room, backed by real
+Engine.IO socket objects (their send queues are drained between rounds,
+outside the timing), and times:
+
+- per-recipient: one emit per member, so the packet is encoded N times
+- broadcast: one emit to the room, encoded once and shared by every member
+
+for each available codec (see codec.py).
+
+    python bench_fanout.py [--sizes 10 1000 10000] [--messages 3]
+"""
+import argparse
+import time
+
+import engineio.socket
+import socketio
+
+from codec import json_codec
+
+
+def make_server(codec, members):
+    server = socketio.Server(async_mode='threading', json=codec)
+    sids = []
+    for i in range(members):
+        eio_sid = f'eio{i}'
+        server.eio.sockets[eio_sid] = engineio.socket.Socket(server.eio, eio_sid)
+        sid = server.manager.connect(eio_sid, '/')
+        server.manager.enter_room(sid, '/', 'room')
+        sids.append(sid)
+    return server, sids
+
+
+def drain(server):
+    for s in server.eio.sockets.values():
+        while not s.queue.empty():
+            s.queue.get_nowait()
+
+
+def make_batch(messages):
+    return [{
+        'id': 1000 + i,
+        'username': f'user{i}',
+        'message': f'message number {i}, with a bit of text to make it a realistic length',
+        'timestamp': '12:34'
+    } for i in range(messages)]
+
+
+def bench(server, sids, batch, per_recipient, rounds):
+    total = 0
+    for _ in range(rounds):
+        start = time.process_time()
+        if per_recipient:
+            for sid in sids:
+                server.emit('receive_messages', batch, to=sid)
+        else:
+            server.emit('receive_messages', batch, to='room')
+        total += time.process_time() - start
+        drain(server)
+    return total / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 10000])
+    parser.add_argument('--messages', type=int, default=3, help='messages per broadcast batch')
+    args = parser.parse_args()
+
+    codecs = ['json']
+    try:
+        json_codec('orjson')
+        codecs.append('orjson')
+    except ImportError:
+        print('orjson not installed, skipping it')
+
+    batch = make_batch(args.messages)
+    print(f'{"members":>8} {"codec":>7} {"mode":>14} {"ms/broadcast":>13} {"us/member":>10}')
+    for size in args.sizes:
+        rounds = max(3, 20000 // size)
+        for name in codecs:
+            server, sids = make_server(json_codec(name), size)
+            for per_recipient in (True, False):
+                seconds = bench(server, sids, batch, per_recipient, rounds)
+                mode = 'per-recipient' if per_recipient else 'broadcast'
+                print(f'{size:8d} {name:>7} {mode:>14} {seconds * 1000:13.3f} {seconds / size * 1e6:10.2f}')
+
+
+if __name__ == '__main__':
+    main()
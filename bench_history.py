@@ -0,0 +1,113 @@
+"""Microbenchmark for room history storage.
+
+Compares the old list + `[-100:]` trimming against RoomHistory:
+per-append cost in one busy room, the whole MemoryMessageStore.append()
+and recent() that handlers call, and memory per room with 10k full rooms.
+
+    python bench_history.py [--rooms 10000] [--appends 200000]
+"""
+import argparse
+import time
+import tracemalloc
+
+from message_store import MemoryMessageStore
+from room_history import RoomHistory
+
+CAPACITY = 100
+BYTE_BUDGET = 256 * 1024
+
+
+def make_message(i):
+    return {'id': i, 'username': f'user{i % 50}', 'message': f'hello there {i}', 'timestamp': '12:34'}
+
+
+def append_list(history, message):
+    history.append(message)
+    if len(history) > CAPACITY:
+        history = history[-CAPACITY:]
+    return history
+
+
+def bench_append(appends):
+    messages = [make_message(i) for i in range(appends)]
+
+    history = []
+    start = time.perf_counter()
+    for message in messages:
+        history = append_list(history, message)
+    list_ns = (time.perf_counter() - start) / appends * 1e9
+
+    ring = RoomHistory(CAPACITY, BYTE_BUDGET)
+    start = time.perf_counter()
+    for message in messages:
+        ring.append(message)
+    ring_ns = (time.perf_counter() - start) / appends * 1e9
+
+    # What a handler pays: lock, id, history; the dicts are fresh as they would be
+    store = MemoryMessageStore(CAPACITY, BYTE_BUDGET)
+    fresh = [dict(message) for message in messages]
+    start = time.perf_counter()
+    for message in fresh:
+        store.append('room', message)
+    store_ns = (time.perf_counter() - start) / appends * 1e9
+
+    joins = max(appends // 10, 1)
+    start = time.perf_counter()
+    for _ in range(joins):
+        store.recent('room', 30)
+    recent_ns = (time.perf_counter() - start) / joins * 1e9
+
+    print(f'append, one busy room ({appends} messages)')
+    print(f'  list + slice trim           {list_ns:8.0f} ns/append')
+    print(f'  RoomHistory                 {ring_ns:8.0f} ns/append')
+    print(f'  MemoryMessageStore.append   {store_ns:8.0f} ns/append')
+    print(f'  MemoryMessageStore.recent   {recent_ns:8.0f} ns/join (30 messages)')
+
+
+def measure(build, rooms):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build(rooms)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return (after - before) / rooms
+
+
+def build_lists(rooms):
+    result = {}
+    for r in range(rooms):
+        history = []
+        for i in range(CAPACITY + 10):
+            history = append_list(history, make_message(i))
+        result[r] = history
+    return result
+
+
+def build_rings(rooms):
+    result = {}
+    for r in range(rooms):
+        ring = RoomHistory(CAPACITY, BYTE_BUDGET)
+        for i in range(CAPACITY + 10):
+            ring.append(make_message(i))
+        result[r] = ring
+    return result
+
+
+def bench_memory(rooms):
+    list_bytes = measure(build_lists, rooms)
+    ring_bytes = measure(build_rings, rooms)
+
+    print(f'memory, {rooms} rooms with {CAPACITY} messages each')
+    print(f'  list of dicts               {list_bytes / 1024:8.1f} KiB/room')
+    print(f'  RoomHistory                 {ring_bytes / 1024:8.1f} KiB/room')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rooms', type=int, default=10000)
+    parser.add_argument('--appends', type=int, default=200000)
+    args = parser.parse_args()
+
+    bench_append(args.appends)
+    bench_memory(args.rooms)
@@ -0,0 +1,157 @@
+"""Frame-count benchmark for the typing indicator.
+
+Starts app.py, puts N clients in one room and has K of them type in bursts
+(a few seconds at --keys per second, then a pause). Counts the typing frames
+clients send and receive for two client behaviours against the aggregating
+server:
+
+- keypress: a bare `typing` on every key, like the old script.js
+- debounced: start / refresh / stop, like the current script.js
+
+and compares them with the old server, which rebroadcast every keypress to
+the other N-1 members.
+
+    python bench_typing.py [--clients 200] [--typists 10] [--keys 8] [--duration 10]
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import socketio
+
+from bench_connections import RUN_SERVER, free_port
+
+# Keep in step with noteTyping() in static/script.js
+TYPING_REFRESH = 3.0
+TYPING_IDLE = 2.0
+
+
+class Counters:
+    def __init__(self):
+        self.keypresses = 0
+        self.sent = 0
+        self.received = 0
+
+
+class Typist:
+    """The client-side debounce from script.js."""
+
+    def __init__(self, sio, counters):
+        self.sio = sio
+        self.counters = counters
+        self.since = 0
+        self.idle = None
+
+    async def key(self):
+        now = time.monotonic()
+        if now - self.since > TYPING_REFRESH:
+            await self.sio.emit('typing', {'typing': True})
+            self.counters.sent += 1
+            self.since = now
+        if self.idle:
+            self.idle.cancel()
+        self.idle = asyncio.ensure_future(self.stop_later())
+
+    async def stop_later(self):
+        await asyncio.sleep(TYPING_IDLE)
+        await self.sio.emit('typing', {'typing': False})
+        self.counters.sent += 1
+        self.since = 0
+
+
+async def type_in_bursts(sio, counters, mode, keys, deadline):
+    typist = Typist(sio, counters)
+    while time.monotonic() < deadline:
+        burst_end = min(time.monotonic() + random.uniform(1, 4), deadline)
+        while time.monotonic() < burst_end:
+            counters.keypresses += 1
+            if mode == 'keypress':
+                await sio.emit('typing')
+                counters.sent += 1
+            else:
+                await typist.key()
+            await asyncio.sleep(random.expovariate(keys))
+        await asyncio.sleep(random.uniform(1, 3))
+    if typist.idle:
+        await typist.idle
+
+
+async def run(url, mode, args):
+    counters = Counters()
+    clients = [socketio.AsyncClient(reconnection=False) for _ in range(args.clients)]
+    joined = [asyncio.Event() for _ in clients]
+    code = {}
+
+    for sio, event in zip(clients, joined):
+        async def on_joined(data, event=event):
+            code['code'] = data['code']
+            event.set()
+
+        async def on_typing(data):
+            counters.received += 1
+
+        sio.on('room_created', on_joined)
+        sio.on('room_joined', on_joined)
+        sio.on('typing_users', on_typing)
+
+    for i in range(0, len(clients), 50):
+        await asyncio.gather(*(c.connect(url, transports=['websocket']) for c in clients[i:i + 50]))
+
+    await clients[0].emit('create_room', {'username': 'user0', 'room_name': 'typing'})
+    await asyncio.wait_for(joined[0].wait(), 10)
+    await asyncio.gather(*(
+        c.emit('join_with_code', {'username': f'user{i}', 'code': code['code']})
+        for i, c in enumerate(clients) if i
+    ))
+    await asyncio.wait_for(asyncio.gather(*(e.wait() for e in joined[1:])), 30)
+
+    deadline = time.monotonic() + args.duration
+    await asyncio.gather(*(
+        type_in_bursts(c, counters, mode, args.keys, deadline) for c in clients[:args.typists]
+    ))
+    # Let the last tick go out
+    await asyncio.sleep(1)
+    await asyncio.gather(*(c.disconnect() for c in clients))
+    return counters
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=200, help='room size')
+    parser.add_argument('--typists', type=int, default=10)
+    parser.add_argument('--keys', type=float, default=8, help='keys per second while typing')
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args()
+
+    print(f'{args.clients} clients in one room, {args.typists} typing for {args.duration:.0f}s')
+    print(f'{"":28} {"keypresses":>10} {"sent":>8} {"received":>10}')
+    for mode in ('keypress', 'debounced'):
+        port = free_port()
+        workdir = tempfile.mkdtemp(prefix='bench-typing-')
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+        server = subprocess.Popen([sys.executable, '-c', RUN_SERVER, 'app', str(port)],
+                                  cwd=workdir, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            time.sleep(2)
+            counters = asyncio.run(run(f'http://127.0.0.1:{port}', mode, args))
+        finally:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        if mode == 'keypress':
+            # The old handler sent one user_typing per keypress to everyone else
+            old = counters.keypresses * (args.clients - 1)
+            print(f'{"old server (per keypress)":28} {counters.keypresses:10d} {counters.keypresses:8d} {old:10d}')
+        print(f'{mode + " client":28} {counters.keypresses:10d} {counters.sent:8d} {counters.received:10d}')
+
+
+if __name__ == '__main__':
+    main()
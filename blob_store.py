@@ -0,0 +1,204 @@
+"""Content-addressed storage for uploaded files.
+
+Each distinct file is stored once, named by the SHA-256 of its bytes and
+sharded two levels deep so no directory grows too large:
+
+    uploads/9f/86/9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08
+
+Messages point at a blob by digest. `refs.json` next to the shards counts
+how many messages in each room use each one. Sending a file the store
+already has costs no blob write at all.
+
+Counting is all that happens when a message is posted or leaves history.
+A flusher on its own OS thread writes `refs.json` every `flush_interval`
+seconds when the counts changed, and deletes blobs that no message uses any
+more, so neither the JSON nor the deletes run on the thread handling an
+event. Counts changed within the last interval before a crash are lost.
+
+The reference counts belong to one process. Servers sharing a process
+under `CLUSTER_URL=local://` share one store; with a redis CLUSTER_URL,
+where each worker is its own process, create_blob_store() refuses to
+start, since the workers' counts would delete each other's files.
+"""
+import json
+import logging
+import os
+import re
+
+import server_config
+
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+log = logging.getLogger('chat.blobs')
+
+# Shared with the flusher thread, so it must be a real OS lock under eventlet/gevent
+_threads = server_config.os_threads()
+
+
+class BlobStore:
+    def __init__(self, root, flush_interval=1.0):
+        self.root = root
+        self.refs_path = os.path.join(root, 'refs.json')
+        self.flush_interval = flush_interval
+        # digest -> {room: number of messages}
+        self.refs = {}
+        # Digests whose last reference went, for the flusher to delete
+        self.unreferenced = set()
+        self.dirty = False
+        self.closed = False
+        self.lock = _threads.allocate_lock()
+        # One flush at a time, whoever runs it
+        self.flush_lock = _threads.allocate_lock()
+        # Held except when the flusher is being woken to exit
+        self.wake = _threads.allocate_lock()
+        self.wake.acquire()
+        try:
+            with open(self.refs_path) as f:
+                refs = json.load(f)
+        except FileNotFoundError:
+            refs = {}
+        for digest, rooms in refs.items():
+            # Older files counted references per digest only
+            self.refs[digest] = rooms if isinstance(rooms, dict) else {'': rooms}
+
+        _threads.start_new_thread(self._flush_periodically, ())
+
+    def relative_path(self, digest):
+        """Path of a blob below the root, or None for anything that isn't a digest."""
+        if not isinstance(digest, str) or not DIGEST_RE.match(digest):
+            return None
+        return os.path.join(digest[:2], digest[2:4], digest)
+
+    def path(self, digest):
+        relative = self.relative_path(digest)
+        return os.path.join(self.root, relative) if relative else None
+
+    def size(self, digest):
+        """Size of a stored blob, or None if we don't have it."""
+        path = self.path(digest)
+        if path is None:
+            return None
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return None
+
+    def put(self, src_path, digest, room):
+        """Move a finished file into the store, referenced by a message in `room`.
+
+        A duplicate is just deleted. The reference is taken under the same
+        lock, so the flusher can't delete the blob before it is counted.
+        """
+        path = self.path(digest)
+        with self.lock:
+            self._add_ref(room, digest)
+            if os.path.exists(path):
+                os.remove(src_path)
+                return path
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(src_path, path)
+        return path
+
+    def add_ref_if_shared(self, room, digest):
+        """Reference the blob again if a message in `room` already uses it; whether one did."""
+        with self.lock:
+            if room not in self.refs.get(digest, ()):
+                return False
+            self._add_ref(room, digest)
+            return True
+
+    def _add_ref(self, room, digest):
+        rooms = self.refs.setdefault(digest, {})
+        rooms[room] = rooms.get(room, 0) + 1
+        # Referenced again, so the flusher must leave it alone
+        self.unreferenced.discard(digest)
+        self.dirty = True
+
+    def release(self, room, digest):
+        with self.lock:
+            rooms = self.refs.get(digest)
+            if not rooms or room not in rooms:
+                return
+            count = rooms[room] - 1
+            if count > 0:
+                rooms[room] = count
+            else:
+                del rooms[room]
+                if not rooms:
+                    del self.refs[digest]
+                    self.unreferenced.add(digest)
+            self.dirty = True
+
+    def release_messages(self, room, messages):
+        """release() every blob the messages share; a MessageStore.on_discard callback."""
+        for message in messages:
+            digest = message.get('file', {}).get('sha256')
+            if digest:
+                self.release(room, digest)
+
+    def flush(self):
+        """Write refs.json and delete unreferenced blobs, on this thread."""
+        with self.flush_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                refs = json.dumps(self.refs)
+                self.dirty = False
+
+            tmp_path = self.refs_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(refs)
+            os.replace(tmp_path, self.refs_path)
+
+            with self.lock:
+                # Under the lock, so nothing can put() or reference a blob mid-delete
+                for digest in self.unreferenced:
+                    self._delete(digest)
+                self.unreferenced.clear()
+
+    def close(self):
+        self.closed = True
+        self.flush()
+        if self.wake.locked():
+            self.wake.release()
+
+    def _delete(self, digest):
+        # The blob and anything derived from it, like thumbnails
+        path = self.path(digest)
+        try:
+            names = os.listdir(os.path.dirname(path))
+        except OSError:
+            return
+        for name in names:
+            if name.startswith(digest):
+                try:
+                    os.remove(os.path.join(os.path.dirname(path), name))
+                except OSError:
+                    pass
+
+    def _flush_periodically(self):
+        # A real OS thread even under eventlet/gevent, so disk writes never stall the hub
+        while not self.closed:
+            self.wake.acquire(timeout=self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Flushing blob references failed')
+
+
+# The store every server in this process shares under CLUSTER_URL=local://
+_local_blobs = None
+
+
+def create_blob_store(root):
+    """Build the BlobStore for the CLUSTER_URL environment variable."""
+    global _local_blobs
+    url = os.environ.get('CLUSTER_URL', '')
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        raise ValueError('Uploads keep their reference counts in one process and '
+                         'cannot be used with a redis CLUSTER_URL')
+    if url.startswith('local://'):
+        if _local_blobs is None:
+            _local_blobs = BlobStore(root)
+        return _local_blobs
+    return BlobStore(root)
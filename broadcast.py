@@ -0,0 +1,55 @@
+"""Outgoing chat messages, batched per room.
+
+Handlers queue messages here instead of emitting them one by one. The first
+message queued opens a short window (BROADCAST_WINDOW_MS, 5 ms by default);
+when it closes, everything queued for each room goes out as one event
+carrying a list:
+
+    receive_messages: [{'id': 41, 'username': ..., 'message': ..., 'timestamp': ...}, ...]
+
+A batch is one Socket.IO packet, encoded once and written once to each
+member, however many messages it holds. A window of 0 sends each message as
+a batch of one straight away.
+"""
+import os
+import threading
+
+BROADCAST_WINDOW = float(os.environ.get('BROADCAST_WINDOW_MS', 5)) / 1000
+
+
+class BroadcastBatcher:
+    def __init__(self, socketio, event, window=BROADCAST_WINDOW, emit=None):
+        self.socketio = socketio
+        self.emit = emit or socketio.emit
+        self.event = event
+        self.window = window
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wakeup = None
+
+    def send(self, room, message):
+        if self.window <= 0:
+            self.emit(self.event, [message], to=room)
+            return
+
+        with self.lock:
+            if self.wakeup is None:
+                self.wakeup = self.socketio.server.eio.create_event()
+                self.socketio.start_background_task(self._run)
+            self.pending.setdefault(room, []).append(message)
+        self.wakeup.set()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        for room, messages in pending.items():
+            self.emit(self.event, messages, to=room)
+
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            # Let the window fill, then send whatever arrived in it
+            self.socketio.sleep(self.window)
+            self.flush()
@@ -0,0 +1,147 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+# Largest chunk a client may send in one upload_chunk event. This is also the
+# most file data the server ever holds in memory for a single upload.
+CHUNK_SIZE = 256 * 1024
+
+# Partial uploads nobody has touched for this long are deleted
+STALE_AFTER = 60 * 60
+
+
+class UploadError(Exception):
+    pass
+
+
+class UploadSession:
+    def __init__(self, upload_id, filename, size, part_path, username, room):
+        self.upload_id = upload_id
+        self.filename = filename
+        self.size = size
+        self.part_path = part_path
+        self.username = username
+        self.room = room
+        self.received = 0
+        self.updated_at = time.time()
+        # Held while a chunk is written, which may be on a pool thread
+        self.lock = threading.Lock()
+        # Hashed as the chunks arrive, so finishing never re-reads the file
+        self.hash = hashlib.sha256()
+        self.digest = None
+
+
+class ChunkedUploadManager:
+    """Streams uploads to disk one chunk at a time.
+
+    Each upload gets a `<upload_id>.part` file in the upload folder. Chunks are
+    written at their offset as soon as they arrive, so a client that
+    reconnects can ask for the current offset and carry on from there.
+    Finished files go into a content-addressed BlobStore.
+    """
+
+    def __init__(self, upload_folder, max_size, chunk_size=CHUNK_SIZE, stale_after=STALE_AFTER):
+        self.upload_folder = upload_folder
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.stale_after = stale_after
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def start(self, filename, size, username, room, upload_id=None):
+        """Begin a new upload, or resume `upload_id` if we still have it."""
+        self.expire_stale()
+
+        with self.lock:
+            session = self.sessions.get(upload_id) if upload_id else None
+            if session is not None:
+                if session.filename != filename or session.size != size:
+                    raise UploadError('Upload does not match the original file')
+                session.updated_at = time.time()
+                return session
+
+        if size <= 0:
+            raise UploadError('File is empty')
+        if size > self.max_size:
+            raise UploadError('File is too large')
+
+        # The .part file is created by the first chunk, so starting touches no disk
+        upload_id = uuid.uuid4().hex
+        part_path = os.path.join(self.upload_folder, f'{upload_id}.part')
+
+        session = UploadSession(upload_id, filename, size, part_path, username, room)
+        with self.lock:
+            self.sessions[upload_id] = session
+        return session
+
+    def write_chunk(self, upload_id, offset, data):
+        """Write one chunk; returns (session, bytes written).
+
+        Chunks must arrive in order. A chunk for an offset we already have
+        (resent after a reconnect) is ignored and counts as 0 bytes; the
+        caller should reply with `session.received` so the client picks up
+        from the right place.
+        """
+        with self.lock:
+            session = self.sessions.get(upload_id)
+        if session is None:
+            raise UploadError('Unknown upload')
+        if not isinstance(data, (bytes, bytearray)):
+            raise UploadError('Chunk must be binary')
+        if len(data) > self.chunk_size:
+            raise UploadError('Chunk is too large')
+
+        # A copy resent while the first is still being written is ignored too
+        if not session.lock.acquire(blocking=False):
+            return session, 0
+        try:
+            if offset != session.received:
+                return session, 0
+            if session.received + len(data) > session.size:
+                raise UploadError('Chunk goes past the end of the file')
+
+            with open(session.part_path, 'r+b' if offset else 'wb') as f:
+                f.seek(offset)
+                f.write(data)
+
+            session.hash.update(data)
+            session.received += len(data)
+            session.updated_at = time.time()
+        finally:
+            session.lock.release()
+        return session, len(data)
+
+    def finish(self, upload_id, store):
+        """Hand a completed upload to `store` (a BlobStore) for its room and forget its session."""
+        with self.lock:
+            session = self.sessions.pop(upload_id, None)
+        if session is None:
+            raise UploadError('Unknown upload')
+
+        session.digest = session.hash.hexdigest()
+        store.put(session.part_path, session.digest, session.room)
+        return session
+
+    def abort(self, upload_id):
+        with self.lock:
+            session = self.sessions.pop(upload_id, None)
+        if session is not None:
+            _remove_quietly(session.part_path)
+
+    def expire_stale(self):
+        cutoff = time.time() - self.stale_after
+        with self.lock:
+            stale = [s for s in self.sessions.values() if s.updated_at < cutoff]
+            for session in stale:
+                del self.sessions[session.upload_id]
+        for session in stale:
+            _remove_quietly(session.part_path)
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
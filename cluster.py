@@ -0,0 +1,264 @@
+"""Shared state and pub/sub for running more than one server process.
+
+Room codes and room membership live in a state backend, and Socket.IO
+broadcasts go through a pub/sub client manager, so a message sent in a room on
+one worker reaches that room's clients on every worker. Both are picked by the
+CLUSTER_URL environment variable:
+
+- unset: a single process, nothing shared
+- `local://`: an in-process stand-in, for tests that run several servers in one process
+- `redis://host:port/db`: Redis, for production (needs `pip install redis`)
+"""
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+from collections import deque
+
+import socketio
+
+from code_allocator import CodePermutation
+from membership import RoomMembership
+
+
+class LocalState:
+    """Room codes and membership held in this process."""
+
+    def __init__(self):
+        self.codes = {}
+        self.room_codes = {}
+        self.active = {}
+        self.permutation = CodePermutation()
+        self.next_code = 0
+        self.free_codes = deque()
+        self.membership = RoomMembership()
+        self.lock = threading.Lock()
+
+    def allocate_code(self, room):
+        """The room's join code, giving it a fresh one if it has none."""
+        with self.lock:
+            code = self.room_codes.get(room)
+            if code is None:
+                if self.free_codes:
+                    code = self.free_codes.popleft()
+                else:
+                    code = self.permutation.code(self.next_code)
+                    self.next_code += 1
+                self.codes[code] = room
+                self.room_codes[room] = code
+            return code
+
+    def get_code(self, code):
+        return self.codes.get(code)
+
+    def code_of(self, room):
+        return self.room_codes.get(room)
+
+    def touch(self, room):
+        self.active[room] = time.time()
+
+    def last_active(self, room):
+        return self.active.get(room)
+
+    def drop_room(self, room):
+        """Forget a room's code and activity; its code stops working."""
+        with self.lock:
+            code = self.room_codes.pop(room, None)
+            if code is not None:
+                del self.codes[code]
+                self.free_codes.append(code)
+            self.active.pop(room, None)
+            self.membership.forget(room)
+
+    def add_member(self, room, sid, username):
+        with self.lock:
+            return self.membership.join(room, sid, username)
+
+    def remove_member(self, room, sid):
+        with self.lock:
+            return self.membership.leave(room, sid)
+
+    def leave_all(self, sid):
+        with self.lock:
+            return self.membership.leave_all(sid)
+
+    def presence(self, room):
+        with self.lock:
+            return self.membership.snapshot(room)
+
+    def member_count(self, room):
+        return self.membership.count(room)
+
+    def room_sizes(self):
+        """{room: member count} for every room with members."""
+        with self.lock:
+            return {room: len(members) for room, members in self.membership.rooms.items()}
+
+
+class RedisState:
+    """Room codes and membership kept in Redis, shared by every worker.
+
+    Every membership change bumps a per-room version, so each worker can
+    keep its own copy of the user list and only re-read it when it changed.
+    """
+
+    def __init__(self, url, prefix='chat'):
+        import redis
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.snapshots = {}
+        self.permutation = None
+
+    def allocate_code(self, room):
+        code = self.code_of(room)
+        if code is not None:
+            return code
+
+        code = self.redis.lpop(f'{self.prefix}:free_codes')
+        if code is None:
+            code = self._permutation().code(self.redis.incr(f'{self.prefix}:next_code') - 1)
+        if not self.redis.hsetnx(f'{self.prefix}:room_codes', room, code):
+            # Another worker gave the room a code first; ours goes back to the front
+            self.redis.lpush(f'{self.prefix}:free_codes', code)
+            return self.code_of(room)
+        self.redis.hset(f'{self.prefix}:codes', code, room)
+        return code
+
+    def _permutation(self):
+        # Every worker has to shuffle the counter the same way
+        if self.permutation is None:
+            self.redis.set(f'{self.prefix}:code_key', secrets.token_hex(32), nx=True)
+            self.permutation = CodePermutation(bytes.fromhex(self.redis.get(f'{self.prefix}:code_key')))
+        return self.permutation
+
+    def get_code(self, code):
+        return self.redis.hget(f'{self.prefix}:codes', code)
+
+    def code_of(self, room):
+        return self.redis.hget(f'{self.prefix}:room_codes', room)
+
+    def touch(self, room):
+        self.redis.hset(f'{self.prefix}:active', room, time.time())
+
+    def last_active(self, room):
+        value = self.redis.hget(f'{self.prefix}:active', room)
+        return float(value) if value is not None else None
+
+    def drop_room(self, room):
+        code = self.code_of(room)
+        pipe = self.redis.pipeline()
+        if code is not None:
+            pipe.hdel(f'{self.prefix}:codes', code)
+            pipe.rpush(f'{self.prefix}:free_codes', code)
+        pipe.hdel(f'{self.prefix}:room_codes', room)
+        pipe.hdel(f'{self.prefix}:active', room)
+        if not self.member_count(room):
+            pipe.delete(f'{self.prefix}:members_version:{room}')
+        pipe.execute()
+        self.snapshots.pop(room, None)
+
+    def add_member(self, room, sid, username):
+        pipe = self.redis.pipeline()
+        pipe.hset(f'{self.prefix}:members:{room}', sid, username)
+        pipe.sadd(f'{self.prefix}:sid_rooms:{sid}', room)
+        pipe.incr(f'{self.prefix}:members_version:{room}')
+        return pipe.execute()[-1]
+
+    def remove_member(self, room, sid):
+        pipe = self.redis.pipeline()
+        pipe.hdel(f'{self.prefix}:members:{room}', sid)
+        pipe.srem(f'{self.prefix}:sid_rooms:{sid}', room)
+        pipe.incr(f'{self.prefix}:members_version:{room}')
+        removed, _, version = pipe.execute()
+        return version if removed else None
+
+    def leave_all(self, sid):
+        rooms = self.redis.smembers(f'{self.prefix}:sid_rooms:{sid}')
+        return [(room, self.remove_member(room, sid)) for room in rooms]
+
+    def presence(self, room):
+        version = int(self.redis.get(f'{self.prefix}:members_version:{room}') or 0)
+        cached = self.snapshots.get(room)
+        if cached is not None and cached[0] == version:
+            return cached
+        members = self.redis.hgetall(f'{self.prefix}:members:{room}')
+        snapshot = self.snapshots[room] = (version, [{'id': sid, 'name': name} for sid, name in members.items()])
+        return snapshot
+
+    def member_count(self, room):
+        return self.redis.hlen(f'{self.prefix}:members:{room}')
+
+    def room_sizes(self):
+        prefix = f'{self.prefix}:members:'
+        keys = list(self.redis.scan_iter(match=prefix + '*', count=500))
+        pipe = self.redis.pipeline()
+        for key in keys:
+            pipe.hlen(key)
+        # Empty hashes don't exist in Redis, so every key has members
+        return {key[len(prefix):]: count for key, count in zip(keys, pipe.execute())}
+
+
+class LocalHub:
+    """Fans published messages out to every subscriber in this process."""
+
+    def __init__(self):
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, channel):
+        q = queue.Queue()
+        with self.lock:
+            self.subscribers.setdefault(channel, []).append(q)
+        return q
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscribers = list(self.subscribers.get(channel, []))
+        for q in subscribers:
+            q.put(message)
+
+
+local_hub = LocalHub()
+
+
+class LocalPubSubManager(socketio.PubSubManager):
+    """Socket.IO client manager that talks over a LocalHub.
+
+    Messages are JSON-encoded on the way through, like they would be on a
+    real queue, so anything that would not survive Redis fails here too.
+    """
+
+    name = 'local'
+
+    def __init__(self, channel='socketio', hub=local_hub, write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.hub = hub
+        self.queue = hub.subscribe(channel)
+
+    def _publish(self, data):
+        self.hub.publish(self.channel, json.dumps(data))
+
+    def _listen(self):
+        while True:
+            yield self.queue.get()
+
+
+local_state = LocalState()
+
+
+def create_cluster():
+    """Return (state, client_manager) for the CLUSTER_URL environment variable.
+
+    client_manager is None when running as a single process, in which case
+    Socket.IO uses its default in-memory manager.
+    """
+    url = os.environ.get('CLUSTER_URL')
+    if not url:
+        return LocalState(), None
+    if url.startswith('local://'):
+        return local_state, LocalPubSubManager()
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisState(url), socketio.RedisManager(url)
+    raise ValueError(f'Unsupported CLUSTER_URL: {url}')
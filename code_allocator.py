@@ -0,0 +1,75 @@
+"""Room codes handed out from a shuffled counter.
+
+Room n gets code number `permute(n)`, where `permute` is a keyed Feistel
+network over 32 bits, cycle-walked down to the 36**6 six-character codes.
+It is a bijection, so two counter values never give the same code: no
+collision checks, no retries, and the same cost for the first code as for
+the billionth. The key comes from `secrets`, so without it the next code
+can't be guessed from the last one.
+
+The state backends in cluster.py keep the counter, the code <-> room maps
+for lookups both ways, and a free list: codes given back when rooms expire
+are handed out again, oldest first, before the counter moves on.
+"""
+import secrets
+import string
+
+ALPHABET = string.ascii_uppercase + string.digits
+CODE_LENGTH = 6
+
+ROUNDS = 4
+
+MASK64 = (1 << 64) - 1
+
+
+class CodeSpaceExhausted(Exception):
+    pass
+
+
+class CodePermutation:
+    def __init__(self, key=None, alphabet=ALPHABET, length=CODE_LENGTH):
+        self.key = key or secrets.token_bytes(8 * ROUNDS)
+        # One 64-bit round key per round
+        self.round_keys = [int.from_bytes(self.key[8 * i:8 * i + 8], 'big') for i in range(ROUNDS)]
+        self.alphabet = alphabet
+        self.length = length
+        self.size = len(alphabet) ** length
+        # Smallest even number of bits covering the code space
+        bits = max(self.size - 1, 1).bit_length()
+        self.half_bits = (bits + 1) // 2
+        self.half_mask = (1 << self.half_bits) - 1
+
+    def permute(self, n):
+        """The code number for counter value `n`; distinct for every n below `size`."""
+        if not 0 <= n < self.size:
+            raise CodeSpaceExhausted('No room codes left')
+        # The Feistel network permutes a power-of-two range; walking the cycle
+        # until we land inside the code space keeps it a permutation of that
+        while True:
+            n = self._feistel(n)
+            if n < self.size:
+                return n
+
+    def encode(self, number):
+        chars = []
+        for _ in range(self.length):
+            number, digit = divmod(number, len(self.alphabet))
+            chars.append(self.alphabet[digit])
+        return ''.join(chars)
+
+    def code(self, n):
+        return self.encode(self.permute(n))
+
+    def _feistel(self, n):
+        left, right = n >> self.half_bits, n & self.half_mask
+        for i in range(ROUNDS):
+            left, right = right, left ^ self._round(i, right)
+        return (left << self.half_bits) | right
+
+    def _round(self, i, half):
+        # A keyed splitmix64-style mix: cheap, and good enough to scramble
+        # the order without the key
+        x = ((half ^ self.round_keys[i]) * 0x9E3779B97F4A7C15) & MASK64
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+        x ^= x >> 31
+        return x & self.half_mask
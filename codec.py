@@ -0,0 +1,46 @@
+"""JSON codec used to encode and decode Socket.IO packets.
+
+SOCKETIO_JSON picks it:
+
+- `json` (default): the standard library
+- `orjson`: several times faster on chat payloads (needs `pip install orjson`)
+
+Whatever the codec, a room broadcast is encoded once and the same frame is
+written to every member, so a faster codec saves CPU per broadcast, not per
+recipient.
+"""
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+SOCKETIO_JSON = os.environ.get('SOCKETIO_JSON', 'json')
+
+
+class OrjsonCodec:
+    """orjson behind the `json` module interface python-socketio expects."""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        # orjson output is always compact, so `separators` and friends are moot.
+        # Packets are text frames, hence the decode.
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
+
+
+def json_codec(name=None):
+    """The module-like codec to pass as SocketIO(json=...)."""
+    name = name or SOCKETIO_JSON
+    if name == 'json':
+        return json
+    if name == 'orjson':
+        if orjson is None:
+            raise ImportError('SOCKETIO_JSON=orjson needs `pip install orjson`')
+        return OrjsonCodec
+    raise ValueError(f'Unknown SOCKETIO_JSON: {name}')
@@ -0,0 +1,271 @@
+"""Headless load generator that speaks the real Socket.IO protocol.
+
+Opens N simulated clients against a running server (or starts one), spreads
+them over a number of rooms and has each client perform a weighted mix of
+actions. Reports connect rate, fan-out latency (time from a send_message
+until each room member receives it), message throughput and server RSS.
+
+    python loadtest.py --start app_fast --clients 200 --rooms 10 --duration 20
+    python loadtest.py --url http://localhost:5000 --flavor final --pid 1234
+    python loadtest.py --start app --mix send_message=60,typing=30,upload_file=10
+
+Needs `pip install "python-socketio[asyncio_client]"`.
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import socketio
+
+from bench_connections import RUN_SERVER, free_port, server_stats
+
+# Event names and payload keys differ between app.py/app_fast.py and FINAL_WORKING_VERSION.py
+FLAVORS = {
+    'app': {
+        'join': 'join_with_code',
+        'room_key': 'room_name',
+        'message': 'receive_messages',
+    },
+    'final': {
+        'join': 'join_room',
+        'room_key': 'roomname',
+        'message': 'messages',
+    },
+}
+
+UPLOAD_SIZE = 64 * 1024
+
+# Seconds to wait for an ack; a call that gets none counts as an error
+CALL_TIMEOUT = 5
+
+DEFAULT_MIX = 'send_message=70,typing=28,upload_file=2'
+
+# Servers without the upload events, which the default mix leaves uploads out for
+NO_UPLOADS = ('app_fast',)
+
+
+class Stats:
+    def __init__(self):
+        self.connect_times = []
+        self.latencies = []
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+        self.limited = 0
+        self.actions = {}
+
+
+class SimulatedClient:
+    def __init__(self, number, url, flavor, stats):
+        self.number = number
+        self.url = url
+        self.flavor = flavor
+        self.stats = stats
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.joined = asyncio.Event()
+        self.room_code = None
+        self.seq = 0
+
+        self.sio.on(flavor['message'], self.on_message)
+        self.sio.on('room_created', self.on_joined)
+        self.sio.on('room_joined', self.on_joined)
+        self.sio.on('join_error', self.on_error)
+        self.sio.on('error', self.on_error)
+        self.sio.on('upload_error', self.on_error)
+        self.sio.on('rate_limited', self.on_limited)
+
+    async def connect(self):
+        start = time.perf_counter()
+        await self.sio.connect(self.url, transports=['websocket'])
+        self.stats.connect_times.append(time.perf_counter() - start)
+
+    async def on_joined(self, data):
+        self.room_code = data['code']
+        self.joined.set()
+
+    async def on_error(self, data):
+        self.stats.errors += 1
+
+    async def on_limited(self, data):
+        self.stats.limited += 1
+
+    async def on_message(self, batch):
+        now = time.perf_counter()
+        for data in batch:
+            text = data.get('message', '')
+            if text.startswith('lt '):
+                self.stats.latencies.append(now - float(text.split()[1]))
+        self.stats.received += len(batch)
+
+    async def create_room(self, room_name):
+        await self.sio.emit('create_room', {'username': f'user{self.number}', self.flavor['room_key']: room_name})
+        await asyncio.wait_for(self.joined.wait(), 10)
+
+    async def join(self, code):
+        await self.sio.emit(self.flavor['join'], {'username': f'user{self.number}', 'code': code})
+        await asyncio.wait_for(self.joined.wait(), 10)
+
+    async def send_message(self):
+        self.seq += 1
+        # The send time rides along in the text so receivers can work out fan-out latency
+        await self.sio.emit('send_message', {'message': f'lt {time.perf_counter()} {self.number} {self.seq}'})
+        self.stats.sent += 1
+
+    async def typing(self):
+        await self.sio.emit('typing', {'typing': True})
+
+    async def upload_file(self):
+        data = os.urandom(UPLOAD_SIZE)
+        response = await self.sio.call('upload_start', {'filename': 'loadtest.txt', 'size': len(data)},
+                                       timeout=CALL_TIMEOUT)
+        if 'error' in response:
+            self.stats.errors += 1
+            return
+        offset = response['offset']
+        while offset < len(data):
+            chunk = data[offset:offset + response['chunk_size']]
+            reply = await self.sio.call('upload_chunk', {
+                'upload_id': response['upload_id'], 'offset': offset, 'data': chunk
+            }, timeout=CALL_TIMEOUT)
+            if reply.get('busy') or 'retry_after' in reply:
+                await asyncio.sleep(max(0.5, reply.get('retry_after', 0)))
+                continue
+            if 'error' in reply:
+                self.stats.errors += 1
+                return
+            offset = reply['offset']
+
+    async def run(self, mix, rate, deadline):
+        actions = list(mix)
+        weights = [mix[a] for a in actions]
+        while time.perf_counter() < deadline:
+            action = random.choices(actions, weights)[0]
+            self.stats.actions[action] = self.stats.actions.get(action, 0) + 1
+            try:
+                await getattr(self, action)()
+            except Exception:
+                self.stats.errors += 1
+            # Poisson arrivals so clients don't fire in lockstep
+            await asyncio.sleep(random.expovariate(rate))
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ('send_message', 'typing', 'upload_file'):
+            raise argparse.ArgumentTypeError(f'unknown action {name}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+async def run(args, flavor, pid):
+    stats = Stats()
+    clients = [SimulatedClient(i, args.url, flavor, stats) for i in range(args.clients)]
+
+    start = time.perf_counter()
+    for i in range(0, len(clients), args.connect_batch):
+        await asyncio.gather(*(c.connect() for c in clients[i:i + args.connect_batch]))
+    connect_elapsed = time.perf_counter() - start
+
+    # The first client of each room creates it, everyone else joins with its code
+    owners = clients[:args.rooms]
+    await asyncio.gather(*(c.create_room(f'load{i}') for i, c in enumerate(owners)))
+    await asyncio.gather(*(
+        c.join(owners[i % args.rooms].room_code)
+        for i, c in enumerate(clients) if i >= args.rooms
+    ))
+    rss_idle = server_stats(pid)['VmRSS'] if pid else None
+
+    start = time.perf_counter()
+    deadline = start + args.duration
+    await asyncio.gather(*(c.run(args.mix, args.rate, deadline) for c in clients))
+    elapsed = time.perf_counter() - start
+    # Give the last broadcasts a moment to land
+    await asyncio.sleep(1)
+    rss_loaded = server_stats(pid)['VmRSS'] if pid else None
+
+    await asyncio.gather(*(c.sio.disconnect() for c in clients))
+    report(args, stats, connect_elapsed, elapsed, rss_idle, rss_loaded)
+
+
+def report(args, stats, connect_elapsed, elapsed, rss_idle, rss_loaded):
+    print(f'clients            {args.clients} in {args.rooms} rooms, {args.duration}s')
+    print(f'connect rate       {len(stats.connect_times) / connect_elapsed:.0f}/s '
+          f'(p50 {percentile(stats.connect_times, 50) * 1000:.1f} ms, '
+          f'p99 {percentile(stats.connect_times, 99) * 1000:.1f} ms)')
+    print(f'actions            ' + ', '.join(f'{k}={v}' for k, v in sorted(stats.actions.items())))
+    print(f'messages sent      {stats.sent / elapsed:.0f}/s')
+    print(f'messages received  {stats.received / elapsed:.0f}/s')
+    print(f'fan-out latency    p50 {percentile(stats.latencies, 50) * 1000:.1f} ms, '
+          f'p99 {percentile(stats.latencies, 99) * 1000:.1f} ms')
+    print(f'errors             {stats.errors}')
+    print(f'rate limited       {stats.limited}')
+    if rss_idle is not None:
+        print(f'server RSS         {rss_idle / 1024:.1f} MiB joined, {rss_loaded / 1024:.1f} MiB after load')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help='server to test, e.g. http://localhost:5000')
+    parser.add_argument('--start', metavar='MODULE', help='start this server module (app, app_fast, FINAL_WORKING_VERSION) instead')
+    parser.add_argument('--flavor', choices=FLAVORS, help='event names to use (default: from --start, else app)')
+    parser.add_argument('--pid', type=int, help='server process to read RSS from')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--rate', type=float, default=1, help='actions per second per client')
+    parser.add_argument('--mix', type=parse_mix,
+                        help=f'weighted actions (default: {DEFAULT_MIX}, without uploads for app_fast)')
+    parser.add_argument('--connect-batch', type=int, default=50)
+    args = parser.parse_args()
+
+    if not args.url and not args.start:
+        parser.error('give --url or --start')
+    args.rooms = min(args.rooms, args.clients)
+    if args.mix is None:
+        args.mix = parse_mix(DEFAULT_MIX)
+        if args.start in NO_UPLOADS:
+            del args.mix['upload_file']
+
+    server = None
+    pid = args.pid
+    if args.start:
+        port = free_port()
+        # Run it in a scratch directory so test uploads and logs don't land in the repo
+        workdir = tempfile.mkdtemp(prefix='loadtest-')
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+        # Every simulated client comes from one address, so per-IP limits would throttle the test itself
+        env.setdefault('RATE_LIMITS', 'off')
+        server = subprocess.Popen([sys.executable, '-c', RUN_SERVER, args.start, str(port)],
+                                  cwd=workdir, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        args.url = f'http://127.0.0.1:{port}'
+        pid = server.pid
+        time.sleep(2)
+
+    flavor = args.flavor or ('final' if args.start == 'FINAL_WORKING_VERSION' else 'app')
+    try:
+        asyncio.run(run(args, FLAVORS[flavor], pid))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""Logging for the chat servers.
+
+Servers and their modules log through the standard `logging` module, under
+the `chat` logger. `setup_logging()` puts records on a queue that one writer
+drains on a real OS thread, even under eventlet/gevent, so a handler never
+waits for stdout. The writer formats them as key=value lines:
+
+    ts=2026-10-18T12:00:01 level=info logger=chat event=join room=general user=bob msg="joined with code K3X9QZ"
+
+LOG_LEVEL sets the level of the `chat` loggers (default info). Per-message
+and per-connection logs are at debug level, so with the default level they
+cost one isEnabledFor() check. LOG_SAMPLE keeps only a fraction of the
+records for busy events, e.g. to watch a loaded server at debug level:
+
+    LOG_LEVEL=debug LOG_SAMPLE=send_message=0.01,typing=0
+
+Handlers name their event and any other fields with `extra`:
+
+    log.debug('message', extra={'event': 'send_message', 'room': room, 'user': username})
+
+At most LOG_QUEUE_LIMIT records (default 10000) wait to be written. Past
+that, records are dropped rather than piling up in memory while stdout is
+slow; the writer reports how many in a warning once it catches up.
+"""
+import atexit
+import logging
+import os
+import random
+import sys
+import time
+
+import server_config
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'info').upper()
+LOG_QUEUE_LIMIT = int(os.environ.get('LOG_QUEUE_LIMIT', 10000))
+
+# Fields taken from a record's `extra`, in the order they are written
+FIELDS = ('event', 'sid', 'room', 'user', 'code', 'size', 'error')
+
+
+def parse_samples(spec):
+    """{event: fraction kept} from a LOG_SAMPLE string."""
+    rates = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        event, _, rate = entry.partition('=')
+        rates[event] = float(rate)
+    return rates
+
+
+LOG_SAMPLE = parse_samples(os.environ.get('LOG_SAMPLE', ''))
+
+
+class SampleFilter(logging.Filter):
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, 'event', None))
+        return rate is None or random.random() < rate
+
+
+class KeyValueFormatter(logging.Formatter):
+    def format(self, record):
+        parts = [
+            'ts=' + time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)),
+            'level=' + record.levelname.lower(),
+            'logger=' + record.name,
+        ]
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                parts.append(f'{field}={_quote(value)}')
+        parts.append('msg=' + _quote(record.getMessage()))
+        line = ' '.join(parts)
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+def _quote(value):
+    text = str(value)
+    if text and not any(c in text for c in ' "=\n'):
+        return text
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+
+class QueueWriter(logging.Handler):
+    """Queues records in the caller; formats and writes them on its own thread."""
+
+    def __init__(self, stream, limit=LOG_QUEUE_LIMIT):
+        super().__init__()
+        self.stream = stream
+        self.limit = limit
+        self.queue = server_config.os_simple_queue()()
+        self.threads = server_config.os_threads()
+        self.write_lock = self.threads.allocate_lock()
+        self.started = False
+        # Records dropped because the queue was full, and how many of them were reported
+        self.dropped = 0
+        self.reported = 0
+        self.drop_lock = self.threads.allocate_lock()
+
+    def emit(self, record):
+        if not self.started:
+            self.started = True
+            self.threads.start_new_thread(self._run, ())
+        if self.queue.qsize() >= self.limit:
+            with self.drop_lock:
+                self.dropped += 1
+            return
+        self.queue.put(record)
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            with self.write_lock:
+                self._write(record)
+                # Write whatever else is waiting before flushing once
+                while not self.queue.empty():
+                    self._write(self.queue.get())
+                self._report_dropped()
+                self.stream.flush()
+
+    def _write(self, record):
+        try:
+            self.stream.write(self.format(record) + '\n')
+        except Exception:
+            self.handleError(record)
+
+    def _report_dropped(self):
+        dropped = self.dropped
+        if dropped > self.reported:
+            record = logging.LogRecord('chat.logs', logging.WARNING, __file__, 0,
+                                       'dropped %d log records, the queue was full', (dropped - self.reported,), None)
+            self._write(record)
+            self.reported = dropped
+
+    def drain(self):
+        """Write out anything still queued, for shutdown."""
+        with self.write_lock:
+            while not self.queue.empty():
+                self._write(self.queue.get())
+            self._report_dropped()
+            self.stream.flush()
+
+
+_writer = None
+
+
+def dropped_records():
+    """How many records were dropped because the queue was full."""
+    return _writer.dropped if _writer is not None else 0
+
+
+def setup_logging(level=LOG_LEVEL, samples=LOG_SAMPLE, stream=None):
+    global _writer
+    if _writer is not None:
+        return
+
+    _writer = QueueWriter(stream or sys.stdout)
+    _writer.setFormatter(KeyValueFormatter())
+    _writer.addFilter(SampleFilter(samples))
+    atexit.register(_writer.drain)
+
+    # Library records keep the root logger's level; LOG_LEVEL is for ours
+    logging.getLogger().addHandler(_writer)
+    logging.getLogger('chat').setLevel(level)
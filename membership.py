@@ -0,0 +1,73 @@
+class RoomMembership:
+    """Who is in which room, indexed both ways.
+
+    Members are keyed by sid, so two people with the same name are still two
+    members. Joining and leaving are O(1) dict/set operations, and leaving
+    every room on disconnect only touches the rooms that sid was in.
+
+    Each room has a version that goes up with every change, and keeps going
+    up while the room is empty, until `forget(room)`. `snapshot(room)`
+    hands out a cached `(version, users)` pair that is only rebuilt after the
+    room's membership changes. Callers share that list and must not modify it.
+    """
+
+    def __init__(self):
+        self.rooms = {}
+        self.sid_rooms = {}
+        self.versions = {}
+        self.snapshots = {}
+
+    def join(self, room, sid, username):
+        """Add `sid` to `room` and return the room's new version."""
+        self.rooms.setdefault(room, {})[sid] = username
+        self.sid_rooms.setdefault(sid, set()).add(room)
+        return self._changed(room)
+
+    def leave(self, room, sid):
+        """Remove `sid` from `room`; return the new version, or None if it wasn't there."""
+        members = self.rooms.get(room)
+        if members is None or sid not in members:
+            return None
+
+        del members[sid]
+        if not members:
+            del self.rooms[room]
+
+        sid_rooms = self.sid_rooms[sid]
+        sid_rooms.discard(room)
+        if not sid_rooms:
+            del self.sid_rooms[sid]
+        return self._changed(room)
+
+    def leave_all(self, sid):
+        """Remove `sid` from every room it is in; return (room, version) pairs."""
+        return [(room, self.leave(room, sid)) for room in list(self.sid_rooms.get(sid, ()))]
+
+    def rooms_of(self, sid):
+        return self.sid_rooms.get(sid, set())
+
+    def snapshot(self, room):
+        snapshot = self.snapshots.get(room)
+        if snapshot is None:
+            members = self.rooms.get(room)
+            if members is None:
+                return self.versions.get(room, 0), []
+            users = [{'id': sid, 'name': name} for sid, name in members.items()]
+            snapshot = self.snapshots[room] = (self.versions[room], users)
+        return snapshot
+
+    def forget(self, room):
+        """Drop an empty room's version, once the room itself is gone."""
+        if room not in self.rooms:
+            self.versions.pop(room, None)
+            self.snapshots.pop(room, None)
+
+    def count(self, room):
+        return len(self.rooms.get(room, ()))
+
+    def _changed(self, room):
+        self.snapshots.pop(room, None)
+        # Not reset when the room empties: a delta still on its way to a
+        # rejoining client must not look older than the list it got
+        version = self.versions[room] = self.versions.get(room, 0) + 1
+        return version
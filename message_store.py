@@ -0,0 +1,566 @@
+import hashlib
+import json
+import logging
+import os
+
+import server_config
+from room_history import RoomHistory
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# How many messages each room keeps around for history
+HISTORY_LIMIT = 100
+
+# Upper bound on the (approximate) size of one room's history
+HISTORY_BYTES = 256 * 1024
+
+# How many messages are sent on join and per fetch_history page
+HISTORY_PAGE_SIZE = 30
+
+log = logging.getLogger('chat.messages')
+
+# The log's flusher is a real OS thread and shares the store's lock, so the
+# lock must work across OS threads even under eventlet/gevent
+_threads = server_config.os_threads()
+
+
+class MessageStore:
+    """Where room history lives.
+
+    Every message gets a per-room id (its offset in that room's stream) which
+    is also stored on the message dict as `id`. Only the newest `capacity`
+    messages of each room are kept, and fewer if they add up to more than
+    `byte_budget`.
+    """
+
+    # Called as on_discard(room, messages) with messages that leave the store
+    # for good: pushed out of a full history, or dropped along with their room
+    on_discard = None
+
+    def append(self, room, message):
+        raise NotImplementedError
+
+    def recent(self, room, limit=None):
+        raise NotImplementedError
+
+    def before(self, room, before_id, limit=HISTORY_PAGE_SIZE):
+        """Up to `limit` messages older than `before_id`, oldest first."""
+        raise NotImplementedError
+
+    def room_names(self):
+        """Rooms that have history in memory."""
+        raise NotImplementedError
+
+    def memory_bytes(self):
+        """Approximate size of the history held in memory."""
+        raise NotImplementedError
+
+    def evict(self, room):
+        """Take an idle room's history out of memory."""
+        raise NotImplementedError
+
+    def drop(self, room):
+        """Delete a room's history for good."""
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class MemoryMessageStore(MessageStore):
+    """Keeps history in a bounded ring per room. Lost on restart."""
+
+    def __init__(self, capacity=HISTORY_LIMIT, byte_budget=HISTORY_BYTES):
+        self.capacity = capacity
+        self.byte_budget = byte_budget
+        self.rooms = {}
+        self.next_ids = {}
+        self.lock = _threads.allocate_lock()
+
+    def append(self, room, message):
+        with self.lock:
+            return self._append(room, message)
+
+    def _append(self, room, message):
+        history = self._history(room)
+        message_id = self.next_ids.get(room, 0)
+        self.next_ids[room] = message_id + 1
+
+        message['id'] = message_id
+        dropped = history.append(message)
+        if dropped and self.on_discard is not None:
+            self.on_discard(room, dropped)
+        return message_id
+
+    def _history(self, room):
+        history = self.rooms.get(room)
+        if history is None:
+            history = self.rooms[room] = RoomHistory(self.capacity, self.byte_budget)
+        return history
+
+    def _lookup(self, room):
+        # A room's history for reading, or None if it has none
+        return self.rooms.get(room)
+
+    def recent(self, room, limit=None):
+        with self.lock:
+            history = self._lookup(room)
+            if not history:
+                return []
+            return history.newest(limit)
+
+    def before(self, room, before_id, limit=HISTORY_PAGE_SIZE):
+        with self.lock:
+            history = self._lookup(room)
+            if not history:
+                return []
+            return history.before(before_id, limit)
+
+    def room_names(self):
+        with self.lock:
+            return list(self.rooms)
+
+    def memory_bytes(self):
+        with self.lock:
+            return sum(history.bytes for history in self.rooms.values())
+
+    def evict(self, room):
+        # Memory is the only place history lives, so evicting it loses it
+        self.drop(room)
+
+    def drop(self, room):
+        with self.lock:
+            history = self.rooms.pop(room, None)
+            self.next_ids.pop(room, None)
+        if history and self.on_discard is not None:
+            self.on_discard(room, list(history))
+
+
+class LogMessageStore(MemoryMessageStore):
+    """Appends every message to a log on disk and replays it on startup.
+
+    The log is a directory of segment files holding one JSON record per line.
+    `append()` only writes to a buffered file. A flusher on its own OS thread
+    fsyncs it in batches, every `fsync_every` messages or every
+    `fsync_interval` seconds, whichever comes first. Once there are more than
+    `max_segments` segments, the history held in memory is snapshotted when
+    the next segment starts. The flusher writes the snapshot over the last
+    full segment and deletes the ones before it, so the log stays about as
+    big as the retained history. Neither the fsyncs nor the compaction run on
+    the thread that appends.
+
+    An evicted room's history is written to its own file under `rooms/` and
+    leaves memory (and so the log, at the next compaction). The first use of
+    the room reads it back and writes it to the log again. The file is
+    written outside the store's lock; until it is done, the room is read
+    back from the copy being written.
+
+    Evicting and dropping a room also append an `{"evict": room}` or
+    `{"drop": room}` record, so replay forgets the room's earlier records
+    instead of bringing back history that was archived or deleted.
+
+    Only one store may use a directory at a time: a second one, in this
+    process or another, fails to open it rather than interleaving its
+    records and ids with the first's.
+    """
+
+    def __init__(self, path, capacity=HISTORY_LIMIT, byte_budget=HISTORY_BYTES, fsync_every=64,
+                 fsync_interval=1.0, segment_bytes=4 * 1024 * 1024, max_segments=8):
+        super().__init__(capacity, byte_budget)
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.unsynced = 0
+        self.closed = False
+        # Segments written up to the end, waiting for the flusher to fsync and close them
+        self.rolled = []
+        # (segment number, [(room, messages)]) for the flusher to compact into
+        self.compaction = None
+        # room -> messages of an eviction whose archive is still being written
+        self.evicting = {}
+        # One flush at a time, whoever runs it
+        self.flush_lock = _threads.allocate_lock()
+        # Held except when the flusher is being woken early
+        self.wake = _threads.allocate_lock()
+        self.wake.acquire()
+
+        os.makedirs(path, exist_ok=True)
+        self.dir_lock = self._lock_directory()
+        self._replay()
+
+        segments = self._segments()
+        self.segment_number = segments[-1] if segments else 0
+        self.segment = self._open_segment(self.segment_number)
+
+        _threads.start_new_thread(self._flush_periodically, ())
+
+    def append(self, room, message):
+        with self.lock:
+            message_id = self._append(room, message)
+            self._write({'room': room, 'message': message})
+
+            self.unsynced += 1
+            if self.unsynced >= self.fsync_every:
+                self._wake_flusher()
+
+            if self.segment.tell() >= self.segment_bytes:
+                self._roll()
+        return message_id
+
+    def flush(self):
+        """fsync what has been written and run any pending compaction, on this thread."""
+        with self.flush_lock:
+            with self.lock:
+                if self.closed:
+                    return
+                self.segment.flush()
+                # A duplicate descriptor stays valid even if the segment is rolled meanwhile
+                fd = os.dup(self.segment.fileno()) if self.unsynced else None
+                self.unsynced = 0
+                rolled, self.rolled = self.rolled, []
+                compaction, self.compaction = self.compaction, None
+
+            for segment in rolled:
+                os.fsync(segment.fileno())
+                segment.close()
+            if fd is not None:
+                os.fsync(fd)
+                os.close(fd)
+            if compaction is not None:
+                self._compact(*compaction)
+
+    def close(self):
+        with self.flush_lock, self.lock:
+            if self.closed:
+                return
+            for segment in self.rolled + [self.segment]:
+                segment.flush()
+                os.fsync(segment.fileno())
+                segment.close()
+            self.rolled = []
+            self.closed = True
+            self.dir_lock.close()
+        self._wake_flusher()
+
+    def evict(self, room):
+        with self.lock:
+            history = self.rooms.pop(room, None)
+            self.next_ids.pop(room, None)
+            if history is None:
+                return
+            messages = self.evicting[room] = list(history)
+
+        # Disk I/O, so not under the lock every append and read takes
+        path = self._archive_path(room)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            for message in messages:
+                f.write(json.dumps(message, separators=(',', ':')) + '\n')
+        os.replace(path + '.tmp', path)
+
+        with self.lock:
+            if self.evicting.get(room) is messages:
+                del self.evicting[room]
+                # Only now that the archive exists may replay skip the log's copy
+                self._write({'evict': room})
+                return
+        # The room was used or dropped while the archive was written
+        _remove(path)
+
+    def drop(self, room):
+        with self.lock:
+            history = self.rooms.pop(room, None)
+            self.next_ids.pop(room, None)
+            messages = self.evicting.pop(room, None)
+            self._write({'drop': room})
+        if history is not None:
+            messages = list(history)
+        archived = self._read_archive(room)
+        if archived is not None:
+            _remove(self._archive_path(room))
+        # A room lives in memory or in its archive; should both turn up,
+        # releasing one keeps each message from being discarded twice
+        messages = messages or archived
+        if messages and self.on_discard is not None:
+            self.on_discard(room, messages)
+
+    def _lookup(self, room):
+        history = self.rooms.get(room)
+        if history is None and (room in self.evicting or os.path.exists(self._archive_path(room))):
+            history = self._history(room)
+        return history
+
+    def _history(self, room):
+        history = self.rooms.get(room)
+        if history is None:
+            history = super()._history(room)
+            self._unarchive(room, history)
+        return history
+
+    def _read_archive(self, room):
+        try:
+            with open(self._archive_path(room), encoding='utf-8') as f:
+                return [json.loads(line) for line in f]
+        except FileNotFoundError:
+            return None
+
+    def _unarchive(self, room, history):
+        messages = self.evicting.pop(room, None)
+        from_file = messages is None
+        if from_file:
+            messages = self._read_archive(room)
+            if messages is None:
+                return
+        for message in messages:
+            history.append(message)
+            # Back into the log, which no longer has it after compaction
+            self._write({'room': room, 'message': message})
+        if messages:
+            self.next_ids[room] = messages[-1]['id'] + 1
+            self.unsynced += len(messages)
+        if from_file:
+            os.remove(self._archive_path(room))
+
+    def _lock_directory(self):
+        f = open(os.path.join(self.path, 'lock'), 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                raise RuntimeError(f'Message log {self.path} is already in use; give each server process '
+                                   f'its own MESSAGE_LOG_DIR, or share history with a redis CLUSTER_URL')
+        return f
+
+    def _archive_path(self, room):
+        # Room names can be anything, so the file is named after a hash
+        name = hashlib.sha1(room.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, 'rooms', f'{name}.jsonl')
+
+    def _write(self, record):
+        self.segment.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def _wake_flusher(self):
+        if self.wake.locked():
+            self.wake.release()
+
+    def _roll(self):
+        # The flusher fsyncs and closes the full segment
+        self.segment.flush()
+        self.rolled.append(self.segment)
+        self.segment_number += 1
+        self.segment = self._open_segment(self.segment_number)
+
+        if self.compaction is None and len(self._segments()) - 1 >= self.max_segments:
+            # Everything we still want is in memory. Copying the message lists
+            # is all that happens here; the flusher writes them out.
+            snapshot = [(room, list(history)) for room, history in self.rooms.items()]
+            # Archives still being written aren't safe to drop from the log yet
+            snapshot += self.evicting.items()
+            self.compaction = (self.segment_number - 1, snapshot)
+            self._wake_flusher()
+
+    def _compact(self, last, snapshot):
+        # The snapshot holds everything kept from segments up to `last`, so it
+        # replaces `last` and the older ones go. A crash part way leaves the
+        # old segments too, whose repeats replay skips.
+        tmp_path = self._segment_path(last) + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for room, messages in snapshot:
+                for message in messages:
+                    f.write(json.dumps({'room': room, 'message': message}, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._segment_path(last))
+        for number in self._segments():
+            if number < last:
+                os.remove(self._segment_path(number))
+
+    def _replay(self):
+        for number in self._segments():
+            with open(self._segment_path(number), encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn write at the end of the last segment
+                        continue
+                    if 'room' in record:
+                        self._restore(record['room'], record['message'])
+                    else:
+                        # An evict or drop: what came before is archived or gone
+                        room = record.get('evict', record.get('drop'))
+                        self.rooms.pop(room, None)
+                        self.next_ids.pop(room, None)
+
+        # A crash between writing an archive and logging the eviction leaves
+        # both; the log's copy is the one that is current
+        for room in self.rooms:
+            _remove(self._archive_path(room))
+
+    def _restore(self, room, message):
+        # Compaction rewrites messages we already have, so skip repeats
+        message_id = message['id']
+        if message_id < self.next_ids.get(room, 0):
+            return
+        self.next_ids[room] = message_id + 1
+        # The segments hold the newest history, so this skips the archive
+        MemoryMessageStore._history(self, room).append(message)
+
+    def _segments(self):
+        numbers = []
+        for name in os.listdir(self.path):
+            if name.endswith('.log'):
+                numbers.append(int(name[:-4]))
+        return sorted(numbers)
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, f'{number:08d}.log')
+
+    def _open_segment(self, number):
+        return open(self._segment_path(number), 'a', encoding='utf-8')
+
+    def _flush_periodically(self):
+        # A real OS thread even under eventlet/gevent, so fsync never stalls the hub
+        while not self.closed:
+            self.wake.acquire(timeout=self.fsync_interval)
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Flushing the message log failed')
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# Appends a message under the room's next id and trims the list to capacity,
+# returning the id followed by the messages trimmed off. The message arrives
+# encoded without its opening brace, so the id can go in front.
+_REDIS_APPEND = """
+local id = redis.call('INCR', KEYS[2]) - 1
+local over = redis.call('RPUSH', KEYS[1], '{"id":' .. id .. ',' .. ARGV[1]) - tonumber(ARGV[2])
+local result = {id}
+if over > 0 then
+    result = redis.call('LRANGE', KEYS[1], 0, over - 1)
+    table.insert(result, 1, id)
+    redis.call('LTRIM', KEYS[1], over, -1)
+end
+return result
+"""
+
+# Ids in a room's list are consecutive, so the page is a range of positions
+_REDIS_BEFORE = """
+local next_id = tonumber(redis.call('GET', KEYS[2]) or '0')
+local first = next_id - redis.call('LLEN', KEYS[1])
+local stop = math.min(tonumber(ARGV[1]), next_id) - first
+if stop <= 0 then
+    return {}
+end
+return redis.call('LRANGE', KEYS[1], math.max(stop - tonumber(ARGV[2]), 0), stop - 1)
+"""
+
+
+class RedisMessageStore(MessageStore):
+    """Keeps history in Redis, where every worker of a cluster shares it.
+
+    Each room is a list of JSON messages trimmed to `capacity`, with its ids
+    drawn from a counter next to it. `byte_budget` is not enforced; Redis
+    holds the bytes, not the workers. Evicting leaves the history in Redis
+    for whichever worker the room comes back on; dropping deletes it.
+    """
+
+    def __init__(self, url, capacity=HISTORY_LIMIT, prefix='chat'):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.capacity = capacity
+        self.prefix = prefix
+        self.append_script = self.redis.register_script(_REDIS_APPEND)
+        self.before_script = self.redis.register_script(_REDIS_BEFORE)
+
+    def _keys(self, room):
+        return [f'{self.prefix}:history:{room}', f'{self.prefix}:history_next:{room}']
+
+    def append(self, room, message):
+        message.pop('id', None)
+        body = json.dumps(message, separators=(',', ':'))
+        result = self.append_script(keys=self._keys(room), args=[body[1:], self.capacity])
+        message_id = message['id'] = int(result[0])
+        if len(result) > 1 and self.on_discard is not None:
+            self.on_discard(room, [json.loads(item) for item in result[1:]])
+        return message_id
+
+    def recent(self, room, limit=None):
+        if limit == 0:
+            return []
+        key = self._keys(room)[0]
+        return [json.loads(item) for item in self.redis.lrange(key, -limit if limit else 0, -1)]
+
+    def before(self, room, before_id, limit=HISTORY_PAGE_SIZE):
+        return [json.loads(item) for item in self.before_script(keys=self._keys(room), args=[before_id, limit])]
+
+    def room_names(self):
+        prefix = f'{self.prefix}:history:'
+        return [key.decode()[len(prefix):] for key in self.redis.scan_iter(match=prefix + '*', count=500)]
+
+    def memory_bytes(self):
+        # Nothing is held in this process
+        return 0
+
+    def evict(self, room):
+        pass
+
+    def drop(self, room):
+        pipe = self.redis.pipeline()
+        pipe.lrange(self._keys(room)[0], 0, -1)
+        pipe.delete(*self._keys(room))
+        messages = pipe.execute()[0]
+        if messages and self.on_discard is not None:
+            self.on_discard(room, [json.loads(item) for item in messages])
+
+
+# The store every server in this process shares under CLUSTER_URL=local://
+_local_store = None
+
+
+def create_message_store():
+    """Build the store picked by the MESSAGE_STORE and CLUSTER_URL environment variables.
+
+    History has to be shared the way room codes are, or two workers would
+    hand out the same message ids. With a redis CLUSTER_URL it lives in
+    Redis and MESSAGE_STORE is ignored; with `local://` every server in the
+    process gets the same store.
+    """
+    global _local_store
+    url = os.environ.get('CLUSTER_URL', '')
+    capacity = int(os.environ.get('HISTORY_LIMIT', HISTORY_LIMIT))
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisMessageStore(url, capacity)
+    if url.startswith('local://'):
+        if _local_store is None:
+            _local_store = _create_local_store(capacity)
+        return _local_store
+    return _create_local_store(capacity)
+
+
+def _create_local_store(capacity):
+    kind = os.environ.get('MESSAGE_STORE', 'memory')
+    byte_budget = int(os.environ.get('HISTORY_BYTES', HISTORY_BYTES))
+
+    if kind == 'memory':
+        return MemoryMessageStore(capacity, byte_budget)
+    if kind == 'log':
+        path = os.environ.get('MESSAGE_LOG_DIR', os.path.join('data', 'messages'))
+        return LogMessageStore(path, capacity, byte_budget)
+    raise ValueError(f'Unknown MESSAGE_STORE: {kind}')
@@ -0,0 +1,217 @@
+"""Counters and histograms for the /metrics endpoint, in Prometheus text format.
+
+Recording is meant to be cheap enough for every message. Each OS thread
+updates its own shard without a lock: under eventlet/gevent that is the one
+hub thread, and green threads never switch in the middle of an update. The
+shards are only added up when /metrics is scraped. Shards of threads that
+have exited are folded into a running total then, so threading mode, which
+starts a thread per event, doesn't pile them up.
+
+Gauges (connections, rooms, members, history size) are read from the live
+server state at scrape time and cost nothing in between.
+
+Set METRICS_TOKEN to require `Authorization: Bearer <token>` on /metrics,
+since the per-room gauges name every room.
+"""
+import functools
+import hmac
+import os
+import sys
+import time
+from bisect import bisect_left
+
+from flask import Response, request
+
+import logs
+import server_config
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Handler latency buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+# How many clients on this process a message went to
+FANOUT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 10000)
+
+_threads = server_config.os_threads()
+
+
+class Sharded:
+    """A metric whose values live in one shard per OS thread until collected."""
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.shards = {}
+        self.retired = {}
+        self.lock = _threads.allocate_lock()
+
+    def _shard(self):
+        ident = _threads.get_ident()
+        shard = self.shards.get(ident)
+        if shard is None:
+            with self.lock:
+                # A new thread often means others have finished; without a
+                # scrape their shards would pile up in threading mode
+                self._retire_finished()
+                shard = self.shards[ident] = {}
+        return shard
+
+    def collect(self):
+        """{label value: total} over every shard."""
+        with self.lock:
+            self._retire_finished()
+            totals = {}
+            self._merge(totals, self.retired)
+            for shard in list(self.shards.values()):
+                self._merge(totals, shard)
+        return totals
+
+    def _retire_finished(self):
+        # Fold the shards of threads that have exited into one; under self.lock
+        alive = sys._current_frames()
+        for ident in [ident for ident in self.shards if ident not in alive]:
+            self._merge(self.retired, self.shards.pop(ident))
+
+    def _labels(self, value, extra=''):
+        labels = []
+        if self.label is not None and value is not None:
+            labels.append(f'{self.label}="{_escape(value)}"')
+        if extra:
+            labels.append(extra)
+        return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class Counter(Sharded):
+    def inc(self, amount=1, label=None):
+        shard = self._shard()
+        shard[label] = shard.get(label, 0) + amount
+
+    def _merge(self, into, shard):
+        for key, value in list(shard.items()):
+            into[key] = into.get(key, 0) + value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for label, value in sorted(self.collect().items(), key=_label_order):
+            lines.append(f'{self.name}{self._labels(label)} {value}')
+        if len(lines) == 2 and self.label is None:
+            lines.append(f'{self.name} 0')
+        return lines
+
+
+class Histogram(Sharded):
+    def __init__(self, name, help, buckets, label=None):
+        super().__init__(name, help, label)
+        self.buckets = buckets
+
+    def observe(self, value, label=None):
+        shard = self._shard()
+        counts = shard.get(label)
+        if counts is None:
+            # One slot per bucket, one for +Inf, then the sum
+            counts = shard[label] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def timed(self, label):
+        """Decorator that observes how long each call of a handler takes."""
+        def decorator(handler):
+            @functools.wraps(handler)
+            def wrapper(*args):
+                start = time.perf_counter()
+                try:
+                    return handler(*args)
+                finally:
+                    self.observe(time.perf_counter() - start, label)
+            return wrapper
+        return decorator
+
+    def _merge(self, into, shard):
+        for key, counts in list(shard.items()):
+            total = into.get(key)
+            if total is None:
+                into[key] = list(counts)
+            else:
+                for i, count in enumerate(counts):
+                    total[i] += count
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for label, counts in sorted(self.collect().items(), key=_label_order):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                bucket = self._labels(label, 'le="%s"' % bound)
+                lines.append(f'{self.name}_bucket{bucket} {cumulative}')
+            lines.append(f'{self.name}_sum{self._labels(label)} {counts[-1]}')
+            lines.append(f'{self.name}_count{self._labels(label)} {cumulative}')
+        return lines
+
+
+class ChatMetrics:
+    """The metrics every chat server reports."""
+
+    def __init__(self, socketio, state, message_store, wire):
+        self.socketio = socketio
+        self.state = state
+        self.message_store = message_store
+        self.wire = wire
+        self.messages = Counter('chat_messages_total', 'Chat messages sent')
+        self.upload_bytes = Counter('chat_upload_bytes_total', 'Bytes of uploaded files received')
+        self.fanout = Histogram('chat_fanout_recipients', 'Clients on this process each message went to',
+                                FANOUT_BUCKETS)
+        self.handler_seconds = Histogram('chat_handler_seconds', 'Time spent in Socket.IO handlers',
+                                         LATENCY_BUCKETS, label='event')
+
+    def timed(self, event):
+        return self.handler_seconds.timed(event)
+
+    def message_sent(self, room):
+        self.messages.inc()
+        self.fanout.observe(self.wire.recipients(room))
+
+    def endpoint(self):
+        """The /metrics response for the current request."""
+        if METRICS_TOKEN:
+            auth = request.headers.get('Authorization', '')
+            if not hmac.compare_digest(auth.encode(), f'Bearer {METRICS_TOKEN}'.encode()):
+                return Response('Unauthorized\n', 401, {'WWW-Authenticate': 'Bearer'})
+        return Response(self.render(), content_type=CONTENT_TYPE)
+
+    def render(self):
+        room_sizes = self.state.room_sizes()
+        lines = []
+        lines += _gauge('chat_connected_clients', 'Open Socket.IO connections on this process',
+                        [(None, len(self.socketio.server.eio.sockets))])
+        lines += _gauge('chat_rooms', 'Rooms with at least one member', [(None, len(room_sizes))])
+        lines += _gauge('chat_room_members', 'Members per room', sorted(room_sizes.items()), label='room')
+        lines += _gauge('chat_history_rooms', 'Rooms with history held in memory',
+                        [(None, len(self.message_store.room_names()))])
+        lines += _gauge('chat_history_bytes', 'Approximate size of the history held in memory',
+                        [(None, self.message_store.memory_bytes())])
+        lines += ['# HELP chat_log_records_dropped_total Log records dropped because the log queue was full',
+                  '# TYPE chat_log_records_dropped_total counter',
+                  f'chat_log_records_dropped_total {logs.dropped_records()}']
+        for metric in (self.messages, self.upload_bytes, self.fanout, self.handler_seconds):
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+def _gauge(name, help, values, label=None):
+    lines = [f'# HELP {name} {help}', f'# TYPE {name} gauge']
+    for key, value in values:
+        labels = f'{{{label}="{_escape(key)}"}}' if label else ''
+        lines.append(f'{name}{labels} {value}')
+    return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_order(item):
+    return '' if item[0] is None else str(item[0])
@@ -0,0 +1,80 @@
+"""Online-user list updates sent as versioned deltas.
+
+Every membership change bumps the room's presence version. Instead of sending
+the whole user list on every join and leave, changes are collected per room
+and broadcast once per tick as a `presence` event:
+
+    {'base': 41, 'version': 44, 'joined': [{'id': sid, 'name': username}], 'left': [sid]}
+
+A client holding version `base`, or any version up to `version`, applies the
+delta and moves to `version`: `joined` and `left` say where each user they name
+ended up, and nobody else changed. One already at `version` (or newer) ignores
+it. One older than `base` missed something, and asks for a full snapshot with
+`presence_sync`.
+"""
+import threading
+
+# How often queued changes are broadcast, in seconds
+PRESENCE_TICK = 0.25
+
+
+class PresenceBroadcaster:
+    def __init__(self, socketio, state, event='presence', tick=PRESENCE_TICK, emit=None):
+        self.socketio = socketio
+        self.emit = emit or socketio.emit
+        self.state = state
+        self.event = event
+        self.tick = tick
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.started = False
+
+    def snapshot(self, room):
+        """The full user list, for join responses and presence_sync."""
+        version, users = self.state.presence(room)
+        return {'version': version, 'users': users}
+
+    def joined(self, room, sid, username, version):
+        with self.lock:
+            delta = self._delta(room, version)
+            delta['left'].discard(sid)
+            delta['joined'][sid] = username
+
+    def left(self, room, sid, version):
+        with self.lock:
+            delta = self._delta(room, version)
+            # Someone who came and went within one tick was never announced
+            if delta['joined'].pop(sid, None) is None:
+                delta['left'].add(sid)
+
+    def _delta(self, room, version):
+        if not self.started:
+            self.started = True
+            self.socketio.start_background_task(self._run)
+
+        # Changes can be reported out of order (Redis round trips under
+        # eventlet), so the delta spans the lowest base and highest version seen
+        delta = self.pending.get(room)
+        if delta is None:
+            delta = self.pending[room] = {'base': version - 1, 'version': version, 'joined': {}, 'left': set()}
+        else:
+            delta['base'] = min(delta['base'], version - 1)
+            delta['version'] = max(delta['version'], version)
+        return delta
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        for room, delta in pending.items():
+            self.emit(self.event, {
+                'base': delta['base'],
+                'version': delta['version'],
+                'joined': [{'id': sid, 'name': name} for sid, name in delta['joined'].items()],
+                'left': list(delta['left'])
+            }, to=room)
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.tick)
+            self.flush()
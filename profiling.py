@@ -0,0 +1,164 @@
+"""Opt-in profiling of the Socket.IO handlers.
+
+With PROFILING=1, `install()` wraps every registered Socket.IO handler so
+each call adds its wall and CPU time to its event's totals, and adds two
+routes for whoever holds ADMIN_TOKEN (sent as `Authorization: Bearer <token>`):
+
+    GET /debug/handlers             calls, wall and CPU seconds per event, as JSON
+    GET /debug/profile?seconds=10   a sampling profile of the whole process
+
+The profile is in the collapsed-stack format that flamegraph.pl, speedscope
+and most flame graph viewers read: one `outer;...;inner count` line per
+distinct stack. Samples are taken from a real OS thread, so under
+eventlet/gevent they show whatever the hub thread is running, including a
+handler that never yields.
+
+Without PROFILING nothing is wrapped and no route is added, so it costs
+nothing. Under eventlet/gevent a handler's CPU time is that of the hub
+thread, so it includes any other green thread that ran while it waited.
+"""
+import functools
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import Response, request
+
+import server_config
+
+PROFILING = os.environ.get('PROFILING', '').lower() in ('1', 'on', 'true', 'yes')
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+# Seconds between stack samples, and the longest capture allowed
+SAMPLE_INTERVAL = 0.005
+MAX_PROFILE_SECONDS = 60
+
+_threads = server_config.os_threads()
+
+
+class HandlerStats:
+    def __init__(self):
+        # event -> [calls, wall seconds, CPU seconds, slowest call]
+        self.events = {}
+        self.lock = threading.Lock()
+
+    def wrap(self, event, handler):
+        @functools.wraps(handler)
+        def wrapper(*args):
+            wall, cpu = time.perf_counter(), time.thread_time()
+            try:
+                return handler(*args)
+            finally:
+                self.record(event, time.perf_counter() - wall, time.thread_time() - cpu)
+        return wrapper
+
+    def record(self, event, wall, cpu):
+        with self.lock:
+            totals = self.events.get(event)
+            if totals is None:
+                totals = self.events[event] = [0, 0.0, 0.0, 0.0]
+            totals[0] += 1
+            totals[1] += wall
+            totals[2] += cpu
+            totals[3] = max(totals[3], wall)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                event: {'calls': calls, 'wall_seconds': wall, 'cpu_seconds': cpu, 'max_wall_seconds': slowest}
+                for event, (calls, wall, cpu, slowest) in self.events.items()
+            }
+
+
+class SamplingProfiler:
+    """Samples every thread's stack for a while; one capture at a time."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+
+    def capture(self, seconds, sleep):
+        """Collapsed stacks for the next `seconds`, waiting with `sleep`; None if busy."""
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            stacks = Counter()
+            done = []
+            _threads.start_new_thread(self._sample, (stacks, time.monotonic() + seconds, done))
+            # Wait in a way that lets green threads run, since they are what we sample
+            sleep(seconds)
+            while not done:
+                sleep(self.interval)
+            return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+        finally:
+            self.lock.release()
+
+    def _sample(self, stacks, deadline, done):
+        own = _threads.get_ident()
+        # time.sleep may be monkey patched; timing out on a held OS lock never is
+        pause = _threads.allocate_lock()
+        pause.acquire()
+        try:
+            while time.monotonic() < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident != own:
+                        stacks[_collapse(frame)] += 1
+                pause.acquire(timeout=self.interval)
+        finally:
+            done.append(True)
+
+
+def _collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+
+def _authorized():
+    if not ADMIN_TOKEN:
+        return False
+    auth = request.headers.get('Authorization', '')
+    return hmac.compare_digest(auth.encode(), f'Bearer {ADMIN_TOKEN}'.encode())
+
+
+def install(app, socketio, enabled=PROFILING):
+    """Wrap every Socket.IO handler registered so far and add the /debug routes.
+
+    Call it after the last handler is defined. Returns the HandlerStats, or
+    None when profiling is off.
+    """
+    if not enabled:
+        return None
+
+    stats = HandlerStats()
+    profiler = SamplingProfiler()
+    for namespace, handlers in socketio.server.handlers.items():
+        for event, handler in handlers.items():
+            name = event if namespace == '/' else f'{namespace}:{event}'
+            handlers[event] = stats.wrap(name, handler)
+
+    @app.route('/debug/handlers')
+    def debug_handlers():
+        if not _authorized():
+            return Response('Forbidden\n', 403)
+        return Response(json.dumps(stats.snapshot(), indent=2, sort_keys=True), content_type='application/json')
+
+    @app.route('/debug/profile')
+    def debug_profile():
+        if not _authorized():
+            return Response('Forbidden\n', 403)
+        seconds = min(max(request.args.get('seconds', 10, type=float), 0.1), MAX_PROFILE_SECONDS)
+        stacks = profiler.capture(seconds, socketio.sleep)
+        if stacks is None:
+            return Response('A profile is already being captured\n', 409)
+        return Response(stacks, content_type='text/plain; charset=utf-8')
+
+    return stats
@@ -0,0 +1,190 @@
+"""Token-bucket rate limits for Socket.IO events.
+
+Each limited event has a bucket in up to three scopes: the connection
+(`sid`), the client address (`ip`) and the sender's room (`room`). A bucket
+holds up to `burst` tokens and refills at `rate` tokens a second. An event
+takes one token from each of its buckets, and when any of them is empty it is
+dropped before its handler looks at the data. The client gets a
+`rate_limited` event, `{'event': name, 'retry_after': seconds}`, and handlers
+called with an ack get the same as `{'error': ..., 'retry_after': ...}`.
+HTTP routes are limited per address only, and answer 429 with Retry-After.
+
+The defaults below can be changed with RATE_LIMITS, a comma-separated list of
+`event:scope=rate/burst` entries; a rate of 0 removes that limit, and
+`RATE_LIMITS=off` removes them all:
+
+    RATE_LIMITS=send_message:sid=2/5,create_room:ip=0.1/3
+
+Behind a reverse proxy set TRUSTED_PROXIES to the number of proxies in front
+of the server, so `ip` is read from X-Forwarded-For instead of being the
+proxy's own address. Buckets belong to one process; with several workers each
+one applies the limits on its own.
+"""
+import functools
+import os
+import threading
+import time
+
+from flask import jsonify, request
+from flask_socketio import emit
+
+SCOPES = ('sid', 'ip', 'room')
+
+# event -> scope -> (tokens per second, burst)
+DEFAULT_LIMITS = {
+    'send_message': {'sid': (5, 10), 'ip': (20, 40), 'room': (50, 100)},
+    'typing': {'sid': (2, 5)},
+    'create_room': {'sid': (0.2, 3), 'ip': (0.5, 10)},
+    # Joining is also how codes would be guessed
+    'join_with_code': {'sid': (1, 5), 'ip': (2, 20)},
+    'join_room': {'sid': (1, 5), 'ip': (2, 20)},
+    'upload_start': {'sid': (0.5, 5), 'ip': (1, 10)},
+    # 40 chunks of 256 KiB is 10 MiB/s per connection
+    'upload_chunk': {'sid': (40, 80), 'ip': (80, 160)},
+    'fetch_history': {'sid': (5, 10)},
+    'presence_sync': {'sid': (1, 5)},
+    # GET /api/rooms/<code>/messages, which also answers whether a code exists
+    'room_messages': {'ip': (2, 20)},
+}
+
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))
+
+# Buckets untouched long enough to be full again are dropped this often
+SWEEP_EVERY = 60
+
+
+def parse_limits(spec, defaults=DEFAULT_LIMITS):
+    """DEFAULT_LIMITS with the overrides in a RATE_LIMITS string applied."""
+    if spec.strip() == 'off':
+        return {}
+    limits = {event: dict(scopes) for event, scopes in defaults.items()}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        key, _, value = entry.partition('=')
+        event, _, scope = key.partition(':')
+        if scope not in SCOPES or not value:
+            raise ValueError(f'Bad RATE_LIMITS entry: {entry}')
+        rate, _, burst = value.partition('/')
+        rate = float(rate)
+        if rate > 0:
+            limits.setdefault(event, {})[scope] = (rate, float(burst or max(rate, 1)))
+        else:
+            limits.get(event, {}).pop(scope, None)
+    return limits
+
+
+RATE_LIMITS = parse_limits(os.environ.get('RATE_LIMITS', ''))
+
+
+def client_ip():
+    """Address of the client behind TRUSTED_PROXIES proxies."""
+    if TRUSTED_PROXIES:
+        forwarded = request.headers.get('X-Forwarded-For', '').split(',')
+        if len(forwarded) >= TRUSTED_PROXIES:
+            return forwarded[-TRUSTED_PROXIES].strip()
+    return request.remote_addr
+
+
+class RateLimiter:
+    def __init__(self, limits=RATE_LIMITS, room_of=None):
+        self.limits = limits
+        # room_of(sid) -> the room a connection is in, or None
+        self.room_of = room_of
+        # (event, scope, key) -> [tokens, last refill]
+        self.buckets = {}
+        # sid -> time before which it isn't told about drops again
+        self.notified = {}
+        self.lock = threading.Lock()
+        self.next_sweep = time.monotonic() + SWEEP_EVERY
+
+    def check(self, event, sid=None, ip=None, room=None):
+        """Take a token from each of `event`'s buckets.
+
+        Returns None if the event may go ahead. Otherwise nothing is taken and
+        the result is how many seconds until it could.
+        """
+        scopes = self.limits.get(event)
+        if not scopes:
+            return None
+        keys = {'sid': sid, 'ip': ip, 'room': room}
+        now = time.monotonic()
+
+        with self.lock:
+            if now >= self.next_sweep:
+                self._sweep(now)
+
+            buckets = []
+            wait = 0
+            for scope, (rate, burst) in scopes.items():
+                key = keys[scope]
+                if key is None:
+                    continue
+                bucket = self.buckets.get((event, scope, key))
+                if bucket is None:
+                    bucket = self.buckets[(event, scope, key)] = [burst, now]
+                else:
+                    bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                    bucket[1] = now
+                if bucket[0] < 1:
+                    wait = max(wait, (1 - bucket[0]) / rate)
+                buckets.append(bucket)
+
+            if wait:
+                return wait
+            for bucket in buckets:
+                bucket[0] -= 1
+        return None
+
+    def limit(self, event):
+        """Decorator for a Socket.IO handler that drops `event` when over its limits."""
+        def decorator(handler):
+            @functools.wraps(handler)
+            def wrapper(*args):
+                sid = request.sid
+                room = self.room_of(sid) if self.room_of else None
+                wait = self.check(event, sid, client_ip(), room)
+                if wait is None:
+                    return handler(*args)
+                self._notify(sid, event, wait)
+                return {'error': 'Too many requests, slow down', 'retry_after': round(wait, 2)}
+            return wrapper
+        return decorator
+
+    def limit_request(self, event):
+        """Decorator for a Flask view that answers 429 when the address is over `event`'s limits."""
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                wait = self.check(event, ip=client_ip())
+                if wait is None:
+                    return view(*args, **kwargs)
+                response = jsonify({'error': 'Too many requests, slow down', 'retry_after': round(wait, 2)})
+                response.status_code = 429
+                response.headers['Retry-After'] = str(max(1, round(wait)))
+                return response
+            return wrapper
+        return decorator
+
+    def forget(self, sid):
+        """Drop a disconnected client's own buckets."""
+        with self.lock:
+            for event in self.limits:
+                self.buckets.pop((event, 'sid', sid), None)
+            self.notified.pop(sid, None)
+
+    def _notify(self, sid, event, wait):
+        # A flood gets one notice per empty spell, not one per dropped frame
+        now = time.monotonic()
+        with self.lock:
+            if self.notified.get(sid, 0) > now:
+                return
+            self.notified[sid] = now + wait
+        emit('rate_limited', {'event': event, 'retry_after': round(wait, 2)})
+
+    def _sweep(self, now):
+        # A bucket that has refilled to its burst is the same as no bucket
+        for key, (tokens, last) in list(self.buckets.items()):
+            rate, burst = self.limits[key[0]][key[1]]
+            if tokens + (now - last) * rate >= burst:
+                del self.buckets[key]
+        self.notified = {sid: until for sid, until in self.notified.items() if until > now}
+        self.next_sweep = now + SWEEP_EVERY
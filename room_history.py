@@ -0,0 +1,90 @@
+from collections import deque
+from itertools import islice
+
+# Rough per-message overhead on top of the text itself, used for the byte budget
+RECORD_OVERHEAD = 64
+
+
+def message_size(message):
+    """Approximate size of a message dict, for the byte budget.
+
+    The timestamp is always "HH:MM", so it is part of the overhead.
+    """
+    size = RECORD_OVERHEAD + len(message['username']) + len(message['message'])
+    if 'file' in message:
+        file = message['file']
+        size += RECORD_OVERHEAD + len(file['filename']) + len(file['url'])
+    return size
+
+
+class RoomHistory:
+    """The newest messages of one room, as the message dicts themselves.
+
+    Bounded both by message count and by an approximate byte budget. Appends
+    are O(1): the deques drop the oldest message and its size themselves
+    once they are full, and the byte budget only ever pops from the left.
+    Reads hand out the stored dicts, so nothing is copied per join; they
+    must not be changed once appended.
+    """
+
+    __slots__ = ('messages', 'sizes', 'byte_budget', 'bytes')
+
+    def __init__(self, capacity, byte_budget):
+        self.messages = deque(maxlen=capacity)
+        # sizes[i] is message_size(messages[i])
+        self.sizes = deque(maxlen=capacity)
+        self.byte_budget = byte_budget
+        self.bytes = 0
+
+    def append(self, message):
+        """Add the newest message; returns a list of the ones it pushed out, or None."""
+        messages = self.messages
+        sizes = self.sizes
+        dropped = None
+        if len(sizes) == sizes.maxlen:
+            # The deques drop these two themselves
+            dropped = [messages[0]]
+            self.bytes -= sizes[0]
+        # message_size(), inlined for the common case of a text message
+        if 'file' in message:
+            size = message_size(message)
+        else:
+            size = RECORD_OVERHEAD + len(message['username']) + len(message['message'])
+        messages.append(message)
+        sizes.append(size)
+        self.bytes += size
+
+        # Always keep the newest message, even if it alone is over budget
+        while self.bytes > self.byte_budget and len(sizes) > 1:
+            if dropped is None:
+                dropped = []
+            dropped.append(messages.popleft())
+            self.bytes -= sizes.popleft()
+        return dropped
+
+    def newest(self, limit=None):
+        messages = self.messages
+        if limit is None or limit >= len(messages):
+            return list(messages)
+        # Walk from the right so we only touch the messages we return
+        result = list(islice(reversed(messages), limit))
+        result.reverse()
+        return result
+
+    def before(self, before_id, limit):
+        """Up to `limit` messages older than `before_id`, oldest first."""
+        messages = self.messages
+        if not messages:
+            return []
+        # Ids in a room are consecutive, so the position is just arithmetic
+        end = min(before_id - messages[0]['id'], len(messages))
+        if end <= 0:
+            return []
+        start = max(end - limit, 0)
+        return list(islice(messages, start, end))
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
@@ -0,0 +1,125 @@
+"""Idle rooms leave memory, and their join codes expire.
+
+A room with no members for ROOM_IDLE_TIMEOUT seconds (default 15 minutes)
+has its history evicted: dropped with MESSAGE_STORE=memory, or moved to a
+file on disk and read back the next time someone uses the room with
+MESSAGE_STORE=log. After ROOM_CODE_TTL seconds without members (default a
+day) its join code stops working and the room is forgotten altogether.
+Setting either to 0 turns it off.
+
+Each room this process knows about has one entry in a heap, ordered by the
+time it could next be due. The background task only pops entries whose time
+has come and pushes back any room that has members or has been active since,
+so the cost is O(log rooms) per room per timeout, however many rooms there
+are. Activity means a join or a leave: a room with members never goes idle.
+The last-activity time is kept in the shared state, so with CLUSTER_URL
+every worker sees the same one.
+"""
+import heapq
+import logging
+import os
+import threading
+import time
+
+ROOM_IDLE_TIMEOUT = float(os.environ.get('ROOM_IDLE_TIMEOUT', 15 * 60))
+ROOM_CODE_TTL = float(os.environ.get('ROOM_CODE_TTL', 24 * 3600))
+
+# How often rooms that have come due are looked at, in seconds
+LIFECYCLE_TICK = 30
+
+log = logging.getLogger('chat.lifecycle')
+
+
+class RoomLifecycle:
+    def __init__(self, socketio, state, message_store, idle_timeout=ROOM_IDLE_TIMEOUT,
+                 code_ttl=ROOM_CODE_TTL, tick=LIFECYCLE_TICK):
+        self.socketio = socketio
+        self.state = state
+        self.message_store = message_store
+        self.idle_timeout = idle_timeout
+        self.code_ttl = code_ttl
+        self.tick = tick
+        # (due time, room), one entry per room in `tracked`
+        self.heap = []
+        self.tracked = set()
+        # Rooms whose history this process has already evicted
+        self.evicted = set()
+        self.lock = threading.Lock()
+        self.started = False
+
+        # History replayed from disk belongs to rooms nobody has touched yet
+        for room in message_store.room_names():
+            if state.last_active(room) is None:
+                state.touch(room)
+            self._track(room)
+
+    def touch(self, room):
+        """Note a join or leave in `room`."""
+        self.state.touch(room)
+        self._track(room)
+
+    def _track(self, room):
+        if not (self.idle_timeout or self.code_ttl):
+            return
+        with self.lock:
+            if not self.started:
+                self.started = True
+                self.socketio.start_background_task(self._run)
+
+            self.evicted.discard(room)
+            if room not in self.tracked:
+                self.tracked.add(room)
+                heapq.heappush(self.heap, (time.time() + (self.idle_timeout or self.code_ttl), room))
+
+    def expire(self):
+        """Evict or forget every room that has come due."""
+        now = time.time()
+        while True:
+            with self.lock:
+                if not self.heap or self.heap[0][0] > now:
+                    return
+                _, room = heapq.heappop(self.heap)
+
+            try:
+                due = self._check(room, now)
+            except Exception:
+                # Try again next tick rather than losing track of the room
+                log.exception('Room expiry failed', extra={'room': room})
+                due = now + self.tick
+
+            with self.lock:
+                if due is None:
+                    self.tracked.discard(room)
+                else:
+                    heapq.heappush(self.heap, (due, room))
+
+    def _check(self, room, now):
+        """Act on a room that may be idle; return when to look again, or None."""
+        if self.state.member_count(room):
+            return now + (self.idle_timeout or self.code_ttl)
+
+        last_active = self.state.last_active(room) or now
+        if self.idle_timeout and room not in self.evicted:
+            if now < last_active + self.idle_timeout:
+                return last_active + self.idle_timeout
+            self.message_store.evict(room)
+            with self.lock:
+                self.evicted.add(room)
+            log.info('evicted idle room', extra={'room': room})
+
+        if not self.code_ttl:
+            return None
+        if now < last_active + self.code_ttl:
+            return last_active + self.code_ttl
+
+        self.state.drop_room(room)
+        self.message_store.drop(room)
+        with self.lock:
+            self.evicted.discard(room)
+        log.info('room expired', extra={'room': room})
+        return None
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.tick)
+            self.expire()
@@ -0,0 +1,95 @@
+"""How the Socket.IO server does its I/O.
+
+ASYNC_MODE picks the mode:
+
+- `threading` (default): one OS thread per connection. Fine for local development.
+- `eventlet` / `gevent`: green threads, so one worker can hold tens of thousands
+  of idle websocket connections.
+
+The green-thread modes need the standard library patched before anything
+else is imported, so servers call `monkey_patch()` as their very first step.
+"""
+import os
+import types
+
+ASYNC_MODE = os.environ.get('ASYNC_MODE', 'threading')
+
+if ASYNC_MODE not in ('threading', 'eventlet', 'gevent'):
+    raise ValueError(f'Unknown ASYNC_MODE: {ASYNC_MODE}')
+
+_patched = False
+
+
+def monkey_patch():
+    global _patched
+    if _patched:
+        return
+    _patched = True
+
+    if ASYNC_MODE == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+    elif ASYNC_MODE == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+
+
+def run_options(debug=False):
+    """Keyword arguments for socketio.run() in the current mode."""
+    if ASYNC_MODE == 'threading':
+        # The Werkzeug dev server is all threading mode has
+        return {'debug': debug, 'allow_unsafe_werkzeug': True}
+    # eventlet/gevent bring their own production-grade WSGI server
+    return {'debug': debug, 'log_output': debug}
+
+
+def os_threads():
+    """The unpatched `_thread` module, or its parts that we use.
+
+    For code that needs real OS threads, locks and thread ids even after
+    monkey_patch(): long-lived helper threads (which are not joined at exit)
+    and per-OS-thread data. Provides start_new_thread, allocate_lock and
+    get_ident.
+    """
+    if ASYNC_MODE == 'eventlet':
+        from eventlet import patcher
+        return patcher.original('_thread')
+    if ASYNC_MODE == 'gevent':
+        from gevent import monkey
+        names = ['start_new_thread', 'allocate_lock', 'get_ident']
+        return types.SimpleNamespace(**dict(zip(names, monkey.get_original('_thread', names))))
+    import _thread
+    return _thread
+
+
+def os_simple_queue():
+    """The unpatched `queue.SimpleQueue` class.
+
+    Its put() never blocks, and its get() blocks a real OS thread, so a
+    helper thread can wait on it while green threads feed it.
+    """
+    if ASYNC_MODE == 'eventlet':
+        from eventlet import patcher
+        return patcher.original('queue').SimpleQueue
+    if ASYNC_MODE == 'gevent':
+        from gevent import monkey
+        return monkey.get_original('queue', 'SimpleQueue')
+    import queue
+    return queue.SimpleQueue
+
+
+def run_blocking(fn, *args):
+    """Call fn(*args) on a real OS thread and return its result.
+
+    In the green-thread modes a blocking call (disk writes, image decoding,
+    subprocesses) would otherwise stall every client on the worker; here only
+    the calling green thread waits. In threading mode the caller already has
+    its own thread.
+    """
+    if ASYNC_MODE == 'eventlet':
+        from eventlet import tpool
+        return tpool.execute(fn, *args)
+    if ASYNC_MODE == 'gevent':
+        import gevent
+        return gevent.get_hub().threadpool.apply(fn, args)
+    return fn(*args)
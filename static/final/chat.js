@@ -0,0 +1,650 @@
+// Production-ready Socket.IO connection
+// Ask for MessagePack if its decoder loaded; the server answers in JSON otherwise
+const socket = io({
+    transports: ['polling', 'websocket'],
+    upgrade: true,
+    timeout: 20000,
+    forceNew: false,
+    reconnection: true,
+    reconnectionDelay: 1000,
+    reconnectionAttempts: 5,
+    maxReconnectionAttempts: 5,
+    auth: { codec: window.MessagePack ? 'msgpack' : 'json' }
+});
+
+// Room events come as JSON objects or, in MessagePack mode, as one binary attachment
+function onEvent(event, handler) {
+    socket.on(event, (data) => {
+        handler(data instanceof ArrayBuffer ? MessagePack.decode(new Uint8Array(data)) : data);
+    });
+}
+
+let username = '';
+let currentRoom = '';
+let currentCode = '';
+let pendingUpload = null;
+let oldestMessageId = null;
+let loadingHistory = false;
+
+// Connection status handling
+socket.on('connect', () => {
+    console.log('Connected to server');
+    // Pick up an interrupted upload where the server left off
+    resumeUpload();
+});
+
+socket.on('disconnect', () => {
+    console.log('Disconnected from server');
+});
+
+socket.on('connect_error', (error) => {
+    console.log('Connection error:', error);
+    setTimeout(() => {
+        if (!socket.connected) {
+            alert('Connection failed. Please refresh and try again.');
+        }
+    }, 3000);
+});
+
+function switchTab(tab) {
+    document.querySelectorAll('.tab').forEach(t => t.classList.remove('active'));
+    document.querySelectorAll('.tab-content').forEach(t => t.classList.remove('active'));
+    event.target.classList.add('active');
+    document.getElementById(tab + '-tab').classList.add('active');
+}
+
+function createRoom() {
+    username = document.getElementById('username').value.trim();
+    const roomname = document.getElementById('roomname').value.trim() || 'general';
+    if (!username) { alert('Enter username'); return; }
+
+    // Disable button during request
+    const btn = event.target;
+    btn.disabled = true;
+    btn.textContent = 'Creating...';
+
+    socket.emit('create_room', {username, roomname});
+
+    // Reset button after timeout
+    setTimeout(() => {
+        btn.disabled = false;
+        btn.textContent = 'Create & Join';
+    }, 10000);
+}
+
+function joinRoom() {
+    username = document.getElementById('username').value.trim();
+    const code = document.getElementById('code').value.trim().toUpperCase();
+    if (!username || !code) { alert('Enter username and code'); return; }
+
+    // Disable button during request
+    const btn = event.target;
+    btn.disabled = true;
+    btn.textContent = 'Joining...';
+
+    socket.emit('join_room', {username, code});
+
+    // Reset button after timeout
+    setTimeout(() => {
+        btn.disabled = false;
+        btn.textContent = 'Join Room';
+    }, 10000);
+}
+
+function sendMessage() {
+    const msg = document.getElementById('message').value.trim();
+    if (msg) {
+        socket.emit('send_message', {message: msg});
+        document.getElementById('message').value = '';
+    }
+}
+
+function copyCode() {
+    if (navigator.clipboard) {
+        navigator.clipboard.writeText(currentCode).then(() => {
+            alert('Code copied!');
+        });
+    } else {
+        // Fallback for older browsers
+        const textArea = document.createElement("textarea");
+        textArea.value = currentCode;
+        document.body.appendChild(textArea);
+        textArea.select();
+        document.execCommand('copy');
+        document.body.removeChild(textArea);
+        alert('Code copied!');
+    }
+}
+
+onEvent('room_created', (data) => {
+    currentRoom = data.room;
+    currentCode = data.code;
+    showChat(data.room, data.code);
+    loadMessages(data.messages);
+    renderPresence(data.presence);
+    // Reset button
+    document.querySelectorAll('button').forEach(btn => {
+        btn.disabled = false;
+        if (btn.textContent === 'Creating...') btn.textContent = 'Create & Join';
+    });
+});
+
+onEvent('room_joined', (data) => {
+    currentRoom = data.room;
+    currentCode = data.code;
+    showChat(data.room, data.code);
+    loadMessages(data.messages);
+    renderPresence(data.presence);
+    // Reset button
+    document.querySelectorAll('button').forEach(btn => {
+        btn.disabled = false;
+        if (btn.textContent === 'Joining...') btn.textContent = 'Join Room';
+    });
+});
+
+socket.on('error', (data) => {
+    alert(data.message);
+    // Reset buttons
+    document.querySelectorAll('button').forEach(btn => {
+        btn.disabled = false;
+        if (btn.textContent === 'Creating...') btn.textContent = 'Create & Join';
+        if (btn.textContent === 'Joining...') btn.textContent = 'Join Room';
+    });
+});
+
+// The server dropped an event because this client sent too many
+socket.on('rate_limited', (data) => {
+    document.querySelectorAll('button').forEach(btn => {
+        btn.disabled = false;
+        if (btn.textContent === 'Creating...') btn.textContent = 'Create & Join';
+        if (btn.textContent === 'Joining...') btn.textContent = 'Join Room';
+    });
+    // Uploads retry on their own
+    if (data.event === 'upload_chunk' || data.event === 'upload_start') return;
+    const message = `Slow down: try again in ${Math.ceil(data.retry_after)}s`;
+    if (currentRoom) {
+        addSystemMessage(message);
+    } else {
+        alert(message);
+    }
+});
+
+// Messages arrive in small per-room batches
+onEvent('messages', (batch) => {
+    batch.forEach(data => {
+        addMessage(data.username, data.message, data.timestamp, data.file);
+        if (data.file) {
+            hideUploadProgress();
+        }
+    });
+});
+
+socket.on('upload_error', (data) => {
+    hideUploadProgress();
+    alert('Upload failed: ' + data.message);
+});
+
+// File input handler
+document.getElementById('file-input').addEventListener('change', (e) => {
+    const file = e.target.files[0];
+    if (file) {
+        if (file.size > 16 * 1024 * 1024) {
+            alert('File size must be less than 16MB');
+            return;
+        }
+
+        const allowedTypes = ['image/jpeg', 'image/png', 'image/gif', 'video/mp4', 'video/webm', 'application/pdf', 'text/plain'];
+        if (!allowedTypes.includes(file.type)) {
+            alert('File type not supported. Please use images, videos, PDF, or text files.');
+            return;
+        }
+
+        startUpload(file);
+    }
+
+    e.target.value = '';
+});
+
+socket.on('user_joined', (data) => {
+    addSystemMessage(`${data.username} joined the chat`);
+});
+
+socket.on('user_left', (data) => {
+    addSystemMessage(`${data.username} left the chat`);
+});
+
+// Online users: a full list on join, then versioned deltas
+let presenceVersion = 0;
+const presenceItems = new Map();
+
+function renderPresence(snapshot) {
+    document.getElementById('users').innerHTML = '';
+    presenceItems.clear();
+    snapshot.users.forEach(addPresenceUser);
+    presenceVersion = snapshot.version;
+}
+
+function addPresenceUser(user) {
+    // A delta may announce someone this list already has
+    const existing = presenceItems.get(user.id);
+    if (existing) existing.remove();
+    const div = document.createElement('div');
+    div.textContent = user.name;
+    document.getElementById('users').appendChild(div);
+    presenceItems.set(user.id, div);
+}
+
+// Set while a full list is on its way, so missed deltas ask for only one
+let presenceSyncing = false;
+
+function syncPresence() {
+    if (presenceSyncing) return;
+    presenceSyncing = true;
+    socket.emit('presence_sync', (snapshot) => {
+        if (snapshot.error) {
+            // Rate limited; ask again once allowed
+            setTimeout(() => {
+                presenceSyncing = false;
+                syncPresence();
+            }, (snapshot.retry_after || 1) * 1000);
+            return;
+        }
+        presenceSyncing = false;
+        renderPresence(snapshot);
+    });
+}
+
+onEvent('presence', (data) => {
+    if (data.version <= presenceVersion) return;
+    // A delta holds where each user it names ended up, so it also applies on
+    // top of any version between its base and its own
+    if (data.base > presenceVersion) {
+        // Missed an update; start over from a full list
+        syncPresence();
+        return;
+    }
+    data.left.forEach(id => {
+        const div = presenceItems.get(id);
+        if (div) div.remove();
+        presenceItems.delete(id);
+    });
+    data.joined.forEach(addPresenceUser);
+    presenceVersion = data.version;
+});
+
+function showChat(room, code) {
+    document.getElementById('login').style.display = 'none';
+    document.getElementById('chat').style.display = 'block';
+    document.getElementById('room-title').textContent = room;
+    document.getElementById('room-code').textContent = code;
+}
+
+function addMessage(user, msg, timestamp, file = null) {
+    const messagesDiv = document.getElementById('messages');
+    messagesDiv.appendChild(buildMessage(user, msg, timestamp, file));
+
+    // Smooth scroll to bottom
+    requestAnimationFrame(() => {
+        scrollToBottom();
+    });
+}
+
+// width/height attributes for a preview, so the layout doesn't jump while it loads
+function mediaSize(file) {
+    return file.thumb_width ? `width="${file.thumb_width}" height="${file.thumb_height}"` : '';
+}
+
+function buildMessage(user, msg, timestamp, file = null) {
+    const messageDiv = document.createElement('div');
+    messageDiv.className = 'message';
+
+    const headerDiv = document.createElement('div');
+    headerDiv.className = 'message-header';
+
+    const usernameSpan = document.createElement('span');
+    usernameSpan.className = 'username';
+    usernameSpan.textContent = user;
+
+    const timestampSpan = document.createElement('span');
+    timestampSpan.className = 'message-timestamp';
+    timestampSpan.textContent = timestamp || new Date().toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'});
+
+    headerDiv.appendChild(usernameSpan);
+    headerDiv.appendChild(timestampSpan);
+    messageDiv.appendChild(headerDiv);
+
+    if (msg) {
+        const textDiv = document.createElement('div');
+        textDiv.className = 'message-text';
+        textDiv.textContent = msg;
+        messageDiv.appendChild(textDiv);
+    }
+
+    if (file) {
+        const fileDiv = document.createElement('div');
+        fileDiv.className = 'message-file';
+
+        if (file.type === 'image') {
+            // Show the thumbnail; the original is only fetched when opened
+            fileDiv.innerHTML = `
+                <div class="media-preview">
+                    <img src="${file.thumbnail || file.url}" ${mediaSize(file)} alt="${file.filename}" onclick="window.open('${file.url}', '_blank')" loading="lazy">
+                </div>
+            `;
+        } else if (file.type === 'video') {
+            fileDiv.innerHTML = `
+                <div class="media-preview">
+                    <video controls ${file.thumbnail ? `poster="${file.thumbnail}" preload="none"` : 'preload="metadata"'} ${mediaSize(file)}>
+                        <source src="${file.url}" type="video/mp4">
+                        Your browser does not support the video tag.
+                    </video>
+                </div>
+            `;
+        } else {
+            const icon = getFileIcon(file.filename);
+            fileDiv.innerHTML = `
+                <div class="file-preview" onclick="window.open('${file.url}', '_blank')">
+                    <div class="file-icon">${icon}</div>
+                    <div class="file-info">
+                        <div class="file-name">${file.filename}</div>
+                        <div class="file-size">${formatFileSize(file.size)}</div>
+                    </div>
+                </div>
+            `;
+        }
+
+        messageDiv.appendChild(fileDiv);
+    }
+
+    return messageDiv;
+}
+
+// Only the newest page of history comes with the join; older pages
+// are fetched as the user scrolls up
+function loadMessages(messages) {
+    const messagesDiv = document.getElementById('messages');
+    messagesDiv.innerHTML = '';
+    oldestMessageId = messages.length ? messages[0].id : null;
+    loadingHistory = false;
+
+    const fragment = document.createDocumentFragment();
+    messages.forEach(m => fragment.appendChild(buildMessage(m.username, m.message, m.timestamp, m.file)));
+    messagesDiv.appendChild(fragment);
+    scrollToBottom();
+}
+
+function loadOlderMessages() {
+    if (loadingHistory || !oldestMessageId) return;
+    loadingHistory = true;
+
+    socket.emit('fetch_history', {before_id: oldestMessageId}, (response) => {
+        if (response.error) {
+            // Rate limited or refused: try again on the next scroll
+            loadingHistory = false;
+            return;
+        }
+        const messages = response.messages;
+        if (!messages.length) {
+            oldestMessageId = null;
+            return;
+        }
+        oldestMessageId = messages[0].id;
+        loadingHistory = false;
+
+        // Keep the messages the user is looking at in place
+        const messagesDiv = document.getElementById('messages');
+        const previousHeight = messagesDiv.scrollHeight;
+        const fragment = document.createDocumentFragment();
+        messages.forEach(m => fragment.appendChild(buildMessage(m.username, m.message, m.timestamp, m.file)));
+        messagesDiv.insertBefore(fragment, messagesDiv.firstChild);
+        messagesDiv.scrollTop += messagesDiv.scrollHeight - previousHeight;
+    });
+}
+
+document.getElementById('messages').addEventListener('scroll', (e) => {
+    if (e.target.scrollTop < 100) {
+        loadOlderMessages();
+    }
+});
+
+function getFileIcon(filename) {
+    const ext = filename.split('.').pop().toLowerCase();
+    const icons = {
+        'pdf': '📄',
+        'doc': '📝',
+        'docx': '📝',
+        'txt': '📄',
+        'zip': '📦',
+        'rar': '📦'
+    };
+    return icons[ext] || '📎';
+}
+
+function formatFileSize(bytes) {
+    if (bytes === 0) return '0 Bytes';
+    const k = 1024;
+    const sizes = ['Bytes', 'KB', 'MB', 'GB'];
+    const i = Math.floor(Math.log(bytes) / Math.log(k));
+    return parseFloat((bytes / Math.pow(k, i)).toFixed(2)) + ' ' + sizes[i];
+}
+
+function showUploadProgress() {
+    document.getElementById('upload-progress').style.display = 'block';
+}
+
+function hideUploadProgress() {
+    document.getElementById('upload-progress').style.display = 'none';
+}
+
+function setUploadProgress(offset, size) {
+    document.querySelector('#upload-progress .progress-fill').style.width = Math.round(offset / size * 100) + '%';
+}
+
+// Uploads are sent as raw binary chunks. The server writes each chunk to disk
+// as it arrives and tells us the next offset, so after a reconnect we only
+// resend what it hasn't got yet.
+function startUpload(file) {
+    setUploadProgress(0, file.size);
+    showUploadProgress();
+    // Hash first, so the server can skip files it already has
+    hashFile(file).then((sha256) => {
+        pendingUpload = {file, uploadId: null, sha256};
+        resumeUpload();
+    });
+}
+
+// SHA-256 of the file as hex, or null where Web Crypto isn't available (plain http)
+function hashFile(file) {
+    if (!window.crypto || !crypto.subtle) return Promise.resolve(null);
+    return file.arrayBuffer()
+        .then((data) => crypto.subtle.digest('SHA-256', data))
+        .then((hash) => Array.from(new Uint8Array(hash), (b) => b.toString(16).padStart(2, '0')).join(''))
+        .catch(() => null);
+}
+
+function resumeUpload() {
+    if (!pendingUpload) return;
+
+    const upload = pendingUpload;
+    socket.emit('upload_start', {
+        filename: upload.file.name,
+        size: upload.file.size,
+        upload_id: upload.uploadId,
+        sha256: upload.sha256
+    }, (response) => {
+        if (response.retry_after) {
+            setTimeout(resumeUpload, response.retry_after * 1000);
+            return;
+        }
+        if (response.error) {
+            failUpload(response.error);
+            return;
+        }
+        if (response.done) {
+            // The server already had this file
+            setUploadProgress(response.offset, upload.file.size);
+            pendingUpload = null;
+            return;
+        }
+        upload.uploadId = response.upload_id;
+        upload.chunkSize = response.chunk_size;
+        sendChunk(upload, response.offset);
+    });
+}
+
+// How long to wait before resending a chunk the server was too busy to take
+const UPLOAD_RETRY = 500;
+
+function sendChunk(upload, offset) {
+    if (upload !== pendingUpload) return;
+
+    upload.file.slice(offset, offset + upload.chunkSize).arrayBuffer().then((data) => {
+        socket.emit('upload_chunk', {upload_id: upload.uploadId, offset, data}, (response) => {
+            if (response.busy || response.retry_after) {
+                // The server is busy or we are over our rate; send this chunk again shortly
+                setTimeout(() => sendChunk(upload, offset), Math.max(UPLOAD_RETRY, (response.retry_after || 0) * 1000));
+                return;
+            }
+            if (response.error) {
+                failUpload(response.error);
+                return;
+            }
+            setUploadProgress(response.offset, upload.file.size);
+            if (response.done) {
+                pendingUpload = null;
+                return;
+            }
+            sendChunk(upload, response.offset);
+        });
+    }).catch(() => {
+        failUpload('Error reading file');
+    });
+}
+
+function failUpload(message) {
+    pendingUpload = null;
+    hideUploadProgress();
+    alert('Upload failed: ' + message);
+}
+
+function addSystemMessage(msg) {
+    const messagesDiv = document.getElementById('messages');
+    const messageDiv = document.createElement('div');
+    messageDiv.className = 'system-message';
+    messageDiv.textContent = msg;
+    messagesDiv.appendChild(messageDiv);
+    messagesDiv.scrollTop = messagesDiv.scrollHeight;
+}
+
+// Responsive improvements
+function adjustForMobile() {
+    const isMobile = window.innerWidth <= 768;
+    const isLandscape = window.innerHeight < 500 && window.innerWidth > window.innerHeight;
+
+    if (isMobile) {
+        // Add floating room info for landscape mode
+        if (isLandscape) {
+            addFloatingRoomInfo();
+        } else {
+            removeFloatingRoomInfo();
+        }
+
+        // Improve scrolling behavior
+        const messagesDiv = document.getElementById('messages');
+        if (messagesDiv) {
+            messagesDiv.style.webkitOverflowScrolling = 'touch';
+            messagesDiv.style.scrollBehavior = 'smooth';
+        }
+
+        // Better keyboard handling
+        const messageInput = document.getElementById('message');
+        if (messageInput && !messageInput.hasAttribute('data-mobile-setup')) {
+            messageInput.setAttribute('data-mobile-setup', 'true');
+
+            // Scroll to bottom when keyboard appears
+            messageInput.addEventListener('focus', () => {
+                setTimeout(() => {
+                    scrollToBottom();
+                    // Prevent body scroll
+                    document.body.style.position = 'fixed';
+                    document.body.style.width = '100%';
+                }, 300);
+            });
+
+            // Restore scroll when keyboard disappears
+            messageInput.addEventListener('blur', () => {
+                setTimeout(() => {
+                    document.body.style.position = '';
+                    document.body.style.width = '';
+                    scrollToBottom();
+                }, 100);
+            });
+        }
+
+        // Prevent body scroll when chat is active
+        preventBodyScroll();
+    }
+}
+
+function scrollToBottom() {
+    const messagesDiv = document.getElementById('messages');
+    if (messagesDiv) {
+        messagesDiv.scrollTop = messagesDiv.scrollHeight;
+    }
+}
+
+function addFloatingRoomInfo() {
+    if (!document.getElementById('floating-room-info')) {
+        const roomCode = document.getElementById('room-code');
+        if (roomCode && roomCode.textContent !== '------') {
+            const floatingDiv = document.createElement('div');
+            floatingDiv.id = 'floating-room-info';
+            floatingDiv.className = 'floating-room-info';
+            floatingDiv.textContent = `Code: ${roomCode.textContent}`;
+            floatingDiv.onclick = () => copyCode();
+            document.body.appendChild(floatingDiv);
+        }
+    }
+}
+
+function removeFloatingRoomInfo() {
+    const floating = document.getElementById('floating-room-info');
+    if (floating) {
+        floating.remove();
+    }
+}
+
+// Handle orientation changes
+function handleOrientationChange() {
+    setTimeout(() => {
+        adjustForMobile();
+        scrollToBottom();
+    }, 200);
+}
+
+// Prevent body scroll on mobile when chat is open
+function preventBodyScroll() {
+    if (window.innerWidth <= 768) {
+        document.body.style.overflow = 'hidden';
+        document.body.style.height = '100vh';
+        document.body.style.height = '100dvh';
+    }
+}
+
+// Initialize responsive features
+window.addEventListener('load', () => {
+    adjustForMobile();
+    preventBodyScroll();
+});
+window.addEventListener('resize', adjustForMobile);
+window.addEventListener('orientationchange', handleOrientationChange);
+
+// Prevent zoom on iOS when focusing inputs
+if (/iPad|iPhone|iPod/.test(navigator.userAgent)) {
+    const inputs = document.querySelectorAll('input[type="text"]');
+    inputs.forEach(input => {
+        input.addEventListener('focus', () => {
+            input.style.fontSize = '16px';
+        });
+    });
+}
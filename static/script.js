@@ -1,13 +1,27 @@
+// Ask for MessagePack if its decoder loaded; the server answers in JSON otherwise
 const socket = io({
     transports: ['polling', 'websocket'],
     timeout: 20000,
-    forceNew: true
+    forceNew: true,
+    auth: { codec: window.MessagePack ? 'msgpack' : 'json' }
 });
 
+// Room events come as JSON objects or, in MessagePack mode, as one binary attachment
+function onEvent(event, handler) {
+    socket.on(event, (data) => {
+        handler(data instanceof ArrayBuffer ? MessagePack.decode(new Uint8Array(data)) : data);
+    });
+}
+
 let username = '';
 let room = '';
 let roomCode = '';
-let typingTimeout;
+let typingSince = 0;
+let typingIdleTimer;
+const typingSources = {};
+let pendingUpload = null;
+let oldestMessageId = null;
+let loadingHistory = false;
 
 function switchTab(tab) {
     // Update tab buttons
@@ -102,6 +116,9 @@ function sendMessage() {
     if (message) {
         socket.emit('send_message', { message });
         input.value = '';
+        // The server clears our typing state when the message arrives
+        clearTimeout(typingIdleTimer);
+        typingSince = 0;
     }
 }
 
@@ -150,6 +167,8 @@ socket.on('connect', () => {
     console.log('Connected to server');
     // Test connection by emitting a simple event
     socket.emit('test_connection');
+    // Pick up an interrupted upload where the server left off
+    resumeUpload();
 });
 
 socket.on('connection_confirmed', () => {
@@ -178,19 +197,21 @@ socket.on('reconnect_error', (error) => {
     console.log('Reconnection failed:', error);
 });
 
-socket.on('room_created', (data) => {
+onEvent('room_created', (data) => {
     room = data.room_name;
     roomCode = data.code;
     showChatScreen(data.room_name, data.code);
     loadMessages(data.messages);
+    renderPresence(data.presence);
     resetButtons();
 });
 
-socket.on('room_joined', (data) => {
+onEvent('room_joined', (data) => {
     room = data.room_name;
     roomCode = data.code;
     showChatScreen(data.room_name, data.code);
     loadMessages(data.messages);
+    renderPresence(data.presence);
     resetButtons();
 });
 
@@ -199,40 +220,110 @@ socket.on('join_error', (data) => {
     resetButtons();
 });
 
-socket.on('receive_message', (data) => {
-    addMessage(data.username, data.message, data.timestamp, data.file);
+// The server dropped an event because this client sent too many
+socket.on('rate_limited', (data) => {
+    resetButtons();
+    // Uploads retry on their own, and nobody needs to hear about typing
+    if (data.event === 'upload_chunk' || data.event === 'upload_start' || data.event === 'typing') return;
+    const message = `Slow down: try again in ${Math.ceil(data.retry_after)}s`;
+    if (room) {
+        addSystemMessage(message);
+    } else {
+        alert(message);
+    }
+});
+
+// Messages arrive in small per-room batches
+onEvent('receive_messages', (batch) => {
+    batch.forEach(data => addMessage(data.username, data.message, data.timestamp, data.file));
     scrollToBottom();
 });
 
-socket.on('user_joined', (data) => {
+onEvent('user_joined', (data) => {
     addSystemMessage(`${data.username} joined the chat`);
     scrollToBottom();
 });
 
-socket.on('user_left', (data) => {
+onEvent('user_left', (data) => {
     addSystemMessage(`${data.username} left the chat`);
     scrollToBottom();
 });
 
-socket.on('update_users', (data) => {
+// Online users: a full list on join, then versioned deltas (see presence.py)
+let presenceVersion = 0;
+const presenceItems = new Map();
+
+function renderPresence(snapshot) {
     const usersList = document.getElementById('users-list');
     usersList.innerHTML = '';
-    
-    data.users.forEach(user => {
-        const li = document.createElement('li');
-        li.textContent = user;
-        usersList.appendChild(li);
+    presenceItems.clear();
+    snapshot.users.forEach(addPresenceUser);
+    presenceVersion = snapshot.version;
+}
+
+function addPresenceUser(user) {
+    // A delta may announce someone this list already has
+    const existing = presenceItems.get(user.id);
+    if (existing) existing.remove();
+    const li = document.createElement('li');
+    li.textContent = user.name;
+    document.getElementById('users-list').appendChild(li);
+    presenceItems.set(user.id, li);
+}
+
+// Set while a full list is on its way, so missed deltas ask for only one
+let presenceSyncing = false;
+
+function syncPresence() {
+    if (presenceSyncing) return;
+    presenceSyncing = true;
+    socket.emit('presence_sync', (snapshot) => {
+        if (snapshot.error) {
+            // Rate limited; ask again once allowed
+            setTimeout(() => {
+                presenceSyncing = false;
+                syncPresence();
+            }, (snapshot.retry_after || 1) * 1000);
+            return;
+        }
+        presenceSyncing = false;
+        renderPresence(snapshot);
+    });
+}
+
+onEvent('presence', (data) => {
+    if (data.version <= presenceVersion) return;
+    // A delta holds where each user it names ended up, so it also applies on
+    // top of any version between its base and its own
+    if (data.base > presenceVersion) {
+        // Missed an update; start over from a full list
+        syncPresence();
+        return;
+    }
+    data.left.forEach(id => {
+        const li = presenceItems.get(id);
+        if (li) li.remove();
+        presenceItems.delete(id);
     });
+    data.joined.forEach(addPresenceUser);
+    presenceVersion = data.version;
 });
 
-socket.on('user_typing', (data) => {
-    const indicator = document.getElementById('typing-indicator');
-    indicator.textContent = `${data.username} is typing...`;
+// Each server process sends the full set of typists in its part of the room
+onEvent('typing_users', (data) => {
+    typingSources[data.source] = data.users.filter(user => user.id !== socket.id);
     
-    clearTimeout(typingTimeout);
-    typingTimeout = setTimeout(() => {
+    const names = Object.values(typingSources).flat().map(user => user.name);
+    const indicator = document.getElementById('typing-indicator');
+    if (names.length === 0) {
         indicator.textContent = '';
-    }, 2000);
+    } else if (names.length === 1) {
+        indicator.textContent = `${names[0]} is typing...`;
+    } else if (names.length <= 3) {
+        indicator.textContent = `${names.slice(0, -1).join(', ')} and ${names[names.length - 1]} are typing...`;
+    } else {
+        indicator.textContent = `${names.length} people are typing...`;
+    }
 });
 
 socket.on('upload_error', (data) => {
@@ -269,20 +360,64 @@ function showChatScreen(roomName, code) {
     document.getElementById('message-input').focus();
 }
 
+// Only the newest page of history comes with the join; older pages are
+// fetched as the user scrolls up
 function loadMessages(messages) {
     const messagesDiv = document.getElementById('messages');
     messagesDiv.innerHTML = '';
+    oldestMessageId = messages.length ? messages[0].id : null;
+    loadingHistory = false;
     
+    const fragment = document.createDocumentFragment();
     messages.forEach(msg => {
-        addMessage(msg.username, msg.message, msg.timestamp, msg.file);
+        fragment.appendChild(buildMessage(msg.username, msg.message, msg.timestamp, msg.file));
     });
+    messagesDiv.appendChild(fragment);
     
     scrollToBottom();
 }
 
+function loadOlderMessages() {
+    if (loadingHistory || !oldestMessageId) return;
+    loadingHistory = true;
+    
+    socket.emit('fetch_history', { before_id: oldestMessageId }, (response) => {
+        if (response.error) {
+            // Rate limited or refused: try again on the next scroll
+            loadingHistory = false;
+            return;
+        }
+        const messages = response.messages;
+        if (!messages.length) {
+            oldestMessageId = null;
+            return;
+        }
+        oldestMessageId = messages[0].id;
+        loadingHistory = false;
+        
+        // Keep the messages the user is looking at in place
+        const messagesDiv = document.getElementById('messages');
+        const previousHeight = messagesDiv.scrollHeight;
+        const fragment = document.createDocumentFragment();
+        messages.forEach(msg => {
+            fragment.appendChild(buildMessage(msg.username, msg.message, msg.timestamp, msg.file));
+        });
+        messagesDiv.insertBefore(fragment, messagesDiv.firstChild);
+        messagesDiv.scrollTop += messagesDiv.scrollHeight - previousHeight;
+    });
+}
+
 function addMessage(username, message, timestamp, file = null) {
     const messagesDiv = document.getElementById('messages');
-    
+    messagesDiv.appendChild(buildMessage(username, message, timestamp, file));
+}
+
+// width/height attributes for a preview, so the layout doesn't jump while it loads
+function mediaSize(file) {
+    return file.thumb_width ? `width="${file.thumb_width}" height="${file.thumb_height}"` : '';
+}
+
+function buildMessage(username, message, timestamp, file = null) {
     const messageDiv = document.createElement('div');
     messageDiv.className = 'message';
     
@@ -313,15 +448,16 @@ function addMessage(username, message, timestamp, file = null) {
         fileDiv.className = 'message-file';
         
         if (file.type === 'image') {
+            // Show the thumbnail; the original is only fetched when opened
             fileDiv.innerHTML = `
                 <div class="media-preview">
-                    <img src="${file.url}" alt="${file.filename}" onclick="openMedia('${file.url}')">
+                    <img src="${file.thumbnail || file.url}" ${mediaSize(file)} alt="${file.filename}" loading="lazy" onclick="openMedia('${file.url}')">
                 </div>
             `;
         } else if (file.type === 'video') {
             fileDiv.innerHTML = `
                 <div class="media-preview">
-                    <video controls>
+                    <video controls ${file.thumbnail ? `poster="${file.thumbnail}" preload="none"` : 'preload="metadata"'} ${mediaSize(file)}>
                         <source src="${file.url}" type="video/mp4">
                         Your browser does not support the video tag.
                     </video>
@@ -343,7 +479,7 @@ function addMessage(username, message, timestamp, file = null) {
         messageDiv.appendChild(fileDiv);
     }
     
-    messagesDiv.appendChild(messageDiv);
+    return messageDiv;
 }
 
 function addSystemMessage(message) {
@@ -392,12 +528,127 @@ function hideUploadProgress() {
     document.getElementById('upload-progress').style.display = 'none';
 }
 
+function setUploadProgress(offset, size) {
+    document.querySelector('#upload-progress .progress-fill').style.width = Math.round(offset / size * 100) + '%';
+}
+
+// Uploads are sent as raw binary chunks. The server writes each chunk to disk
+// as it arrives and tells us the next offset, so after a reconnect we only
+// resend what it hasn't got yet.
+function startUpload(file) {
+    setUploadProgress(0, file.size);
+    showUploadProgress();
+    // Hash first, so the server can skip files it already has
+    hashFile(file).then((sha256) => {
+        pendingUpload = { file, uploadId: null, sha256 };
+        resumeUpload();
+    });
+}
+
+// SHA-256 of the file as hex, or null where Web Crypto isn't available (plain http)
+function hashFile(file) {
+    if (!window.crypto || !crypto.subtle) return Promise.resolve(null);
+    return file.arrayBuffer()
+        .then((data) => crypto.subtle.digest('SHA-256', data))
+        .then((hash) => Array.from(new Uint8Array(hash), (b) => b.toString(16).padStart(2, '0')).join(''))
+        .catch(() => null);
+}
+
+function resumeUpload() {
+    if (!pendingUpload) return;
+    
+    const upload = pendingUpload;
+    socket.emit('upload_start', {
+        filename: upload.file.name,
+        size: upload.file.size,
+        upload_id: upload.uploadId,
+        sha256: upload.sha256
+    }, (response) => {
+        if (response.retry_after) {
+            setTimeout(resumeUpload, response.retry_after * 1000);
+            return;
+        }
+        if (response.error) {
+            failUpload(response.error);
+            return;
+        }
+        if (response.done) {
+            // The server already had this file
+            setUploadProgress(response.offset, upload.file.size);
+            pendingUpload = null;
+            return;
+        }
+        upload.uploadId = response.upload_id;
+        upload.chunkSize = response.chunk_size;
+        sendChunk(upload, response.offset);
+    });
+}
+
+// How long to wait before resending a chunk the server was too busy to take
+const UPLOAD_RETRY = 500;
+
+function sendChunk(upload, offset) {
+    if (upload !== pendingUpload) return;
+    
+    upload.file.slice(offset, offset + upload.chunkSize).arrayBuffer().then((data) => {
+        socket.emit('upload_chunk', { upload_id: upload.uploadId, offset, data }, (response) => {
+            if (response.busy || response.retry_after) {
+                // The server is busy or we are over our rate; send this chunk again shortly
+                setTimeout(() => sendChunk(upload, offset), Math.max(UPLOAD_RETRY, (response.retry_after || 0) * 1000));
+                return;
+            }
+            if (response.error) {
+                failUpload(response.error);
+                return;
+            }
+            setUploadProgress(response.offset, upload.file.size);
+            if (response.done) {
+                pendingUpload = null;
+                return;
+            }
+            sendChunk(upload, response.offset);
+        });
+    }).catch(() => {
+        failUpload('Error reading file');
+    });
+}
+
+function failUpload(message) {
+    pendingUpload = null;
+    hideUploadProgress();
+    alert('Upload failed: ' + message);
+}
+
 // Event listeners
 document.getElementById('message-input').addEventListener('keypress', (e) => {
     if (e.key === 'Enter') {
         sendMessage();
     } else {
-        socket.emit('typing');
+        noteTyping();
+    }
+});
+
+// Report typing when it starts, every TYPING_REFRESH while it goes on, and
+// once more when it stops, rather than on every key
+const TYPING_REFRESH = 3000;
+const TYPING_IDLE = 2000;
+
+function noteTyping() {
+    const now = Date.now();
+    if (now - typingSince > TYPING_REFRESH) {
+        socket.emit('typing', { typing: true });
+        typingSince = now;
+    }
+    clearTimeout(typingIdleTimer);
+    typingIdleTimer = setTimeout(() => {
+        socket.emit('typing', { typing: false });
+        typingSince = 0;
+    }, TYPING_IDLE);
+}
+
+document.getElementById('messages').addEventListener('scroll', (e) => {
+    if (e.target.scrollTop < 100) {
+        loadOlderMessages();
     }
 });
 
@@ -416,22 +667,7 @@ document.getElementById('file-input').addEventListener('change', (e) => {
             return;
         }
         
-        showUploadProgress();
-        
-        const reader = new FileReader();
-        reader.onload = function(event) {
-            socket.emit('upload_file', {
-                filename: file.name,
-                file_data: event.target.result
-            });
-        };
-        
-        reader.onerror = function() {
-            hideUploadProgress();
-            alert('Error reading file');
-        };
-        
-        reader.readAsDataURL(file);
+        startUpload(file);
     }
     
     e.target.value = '';
@@ -0,0 +1,245 @@
+"""Static assets served minified and precompressed, under content-hashed names.
+
+`StaticAssets(app)` serves files from the static folder at
+`/assets/<path>.<hash>.<ext>`. Templates link to them with
+`{{ asset_url('style.css') }}`. The URL changes whenever the content does,
+so browsers may cache them for a year without asking again
+(`Cache-Control: immutable`).
+
+The first time an asset is asked for, it is minified and hashed. It is then
+written to the build directory (ASSET_BUILD_DIR, default `static/dist/`)
+along with `.gz` and, after `pip install brotli`, `.br` siblings. When a
+server starts and the build directory already holds that version, the files
+are read back instead of being compressed again. `python static_assets.py`
+builds everything ahead of time and removes old versions, so a deploy
+doesn't pay for brotli's slow top setting at startup. Requests get the
+smallest variant their Accept-Encoding allows, from memory, without
+compressing anything per request.
+
+Pages work the same way: `page('index.html')` renders a template once, at
+startup. The page is served with `no-cache` and an ETag, so browsers check
+back and pick up new asset URLs after a deploy.
+
+Minifying is deliberately conservative, because gzip already removes most
+of what a full minifier would. CSS loses comments and optional whitespace.
+JS and HTML lose indentation and blank lines, and JS its whole-line `//`
+comments. Line breaks stay, so JS semicolon insertion works as before.
+"""
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import sys
+import threading
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ASSET_BUILD_DIR = os.environ.get('ASSET_BUILD_DIR', '')
+
+# Fingerprinted URLs change with their content, so they never need revalidating
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# Tried in this order, smallest first, with the suffix of their files on disk
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# Files the build step picks up from the static folder
+BUILD_EXTENSIONS = ('.css', '.js')
+
+log = logging.getLogger('chat.assets')
+
+
+def minify_css(text):
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    text = re.sub(r'\s+', ' ', text)
+    # No space is needed next to these. A space before ':' is left alone,
+    # since in a selector it means a descendant.
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    text = re.sub(r':\s+', ':', text)
+    return text.replace(';}', '}').strip() + '\n'
+
+
+def minify_js(text):
+    lines = (line.strip() for line in text.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//')) + '\n'
+
+
+def minify_html(text):
+    lines = (line.strip() for line in text.splitlines())
+    return '\n'.join(line for line in lines if line) + '\n'
+
+
+MINIFIERS = {'.css': minify_css, '.js': minify_js, '.html': minify_html}
+
+
+def compress(body):
+    """{Content-Encoding: bytes} for `body`, with only the variants that are smaller."""
+    variants = {}
+    if brotli is not None:
+        variants['br'] = brotli.compress(body, quality=11)
+    variants['gzip'] = gzip.compress(body, 9, mtime=0)
+    variants = {encoding: data for encoding, data in variants.items() if len(data) < len(body)}
+    variants['identity'] = body
+    return variants
+
+
+class Asset:
+    __slots__ = ('content_type', 'digest', 'variants')
+
+    def __init__(self, content_type, digest, variants):
+        self.content_type = content_type
+        self.digest = digest
+        self.variants = variants
+
+    @classmethod
+    def from_bytes(cls, body, content_type):
+        return cls(content_type, hashlib.sha256(body).hexdigest(), compress(body))
+
+
+class StaticAssets:
+    def __init__(self, app, directory=None, prefix='/assets', build_dir=None, minify=True):
+        self.app = app
+        self.directory = os.path.abspath(directory or app.static_folder)
+        self.prefix = prefix
+        self.build_dir = os.path.abspath(build_dir or ASSET_BUILD_DIR or os.path.join(self.directory, 'dist'))
+        self.minify = minify
+        # Source path -> fingerprinted path, and fingerprinted path -> Asset
+        self.names = {}
+        self.assets = {}
+        self.lock = threading.Lock()
+        app.add_url_rule(prefix + '/<path:name>', 'assets', self.serve)
+        app.jinja_env.globals['asset_url'] = self.url
+
+    def url(self, path):
+        """The fingerprinted URL of `path` in the static folder."""
+        with self.lock:
+            name = self.names.get(path)
+            if name is None:
+                name = self._load(path)
+        return f'{self.prefix}/{name}'
+
+    def _load(self, path):
+        with open(os.path.join(self.directory, path), 'rb') as f:
+            body = f.read()
+        stem, ext = os.path.splitext(path)
+        if self.minify and ext in MINIFIERS:
+            body = MINIFIERS[ext](body.decode('utf-8')).encode('utf-8')
+        digest = hashlib.sha256(body).hexdigest()
+        name = f'{stem}.{digest[:12]}{ext}'
+
+        variants = self._read_built(name, body)
+        if variants is None:
+            variants = compress(body)
+            self._write_built(name, variants)
+        self.assets[name] = Asset(_content_type(path), digest, variants)
+        self.names[path] = name
+        return name
+
+    def _read_built(self, name, body):
+        # A build of this exact content, if there is one on disk
+        path = os.path.join(self.build_dir, name)
+        try:
+            with open(path, 'rb') as f:
+                if f.read() != body:
+                    return None
+            variants = {}
+            for encoding, suffix in ENCODINGS:
+                if os.path.exists(path + suffix):
+                    with open(path + suffix, 'rb') as f:
+                        variants[encoding] = f.read()
+        except OSError:
+            return None
+        variants['identity'] = body
+        return variants
+
+    def _write_built(self, name, variants):
+        path = os.path.join(self.build_dir, name)
+        suffixes = dict(ENCODINGS, identity='')
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # The uncompressed file goes last: its presence means the build is complete
+            for encoding in sorted(variants, key=lambda encoding: encoding == 'identity'):
+                _write_atomic(path + suffixes[encoding], variants[encoding])
+        except OSError as e:
+            # Still served from memory; only the next startup has to compress again
+            log.warning('could not write built asset %s: %s', name, e)
+
+    def build(self):
+        """Build every CSS and JS file in the static folder; remove older builds."""
+        for root, dirs, files in os.walk(self.directory):
+            dirs[:] = [d for d in dirs if os.path.join(root, d) != self.build_dir]
+            for filename in files:
+                if filename.endswith(BUILD_EXTENSIONS):
+                    self.url(os.path.relpath(os.path.join(root, filename), self.directory).replace(os.sep, '/'))
+
+        keep = set()
+        for name in self.assets:
+            keep.add(name)
+            keep.update(name + suffix for _, suffix in ENCODINGS)
+        for root, _, files in os.walk(self.build_dir):
+            for filename in files:
+                path = os.path.join(root, filename)
+                if os.path.relpath(path, self.build_dir).replace(os.sep, '/') not in keep:
+                    os.remove(path)
+        return sorted(self.assets)
+
+    def page(self, template, **context):
+        """Render `template` once, for serving with send()."""
+        html = self.app.jinja_env.get_template(template).render(**context)
+        if self.minify:
+            html = minify_html(html)
+        return Asset.from_bytes(html.encode('utf-8'), 'text/html; charset=utf-8')
+
+    def serve(self, name):
+        asset = self.assets.get(name)
+        if asset is None:
+            return Response('Not found\n', 404)
+        return self.send(asset, IMMUTABLE)
+
+    def send(self, asset, cache_control='no-cache'):
+        """A response with the best variant of `asset` for this request."""
+        encoding = 'identity'
+        for candidate, _ in ENCODINGS:
+            if candidate in asset.variants and request.accept_encodings[candidate]:
+                encoding = candidate
+                break
+        etag = asset.digest[:32] + ('' if encoding == 'identity' else '-' + encoding)
+
+        headers = {'Cache-Control': cache_control, 'Vary': 'Accept-Encoding', 'ETag': f'"{etag}"'}
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return Response(asset.variants[encoding], content_type=asset.content_type, headers=headers)
+
+
+def _content_type(path):
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    if content_type.startswith('text/') or content_type.endswith('javascript'):
+        content_type += '; charset=utf-8'
+    return content_type
+
+
+def _write_atomic(path, data):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+if __name__ == '__main__':
+    # Build ahead of a deploy: python static_assets.py [static folder]
+    from flask import Flask
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    directory = sys.argv[1] if len(sys.argv) > 1 else os.path.join(here, 'static')
+    assets = StaticAssets(Flask(__name__), directory=directory)
+    for name in assets.build():
+        sizes = ', '.join(f'{encoding} {len(data)}' for encoding, data in assets.assets[name].variants.items())
+        print(f'{assets.build_dir}/{name}: {sizes}')
@@ -0,0 +1,51 @@
+import hashlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import blob_store  # noqa: E402
+from blob_store import BlobStore, create_blob_store  # noqa: E402
+
+
+def put(store, tmp_path, body, room):
+    digest = hashlib.sha256(body).hexdigest()
+    src = tmp_path / 'upload.part'
+    src.write_bytes(body)
+    store.put(str(src), digest, room)
+    return digest
+
+
+def test_put_references_the_blob_before_the_flusher_can_delete_it(tmp_path):
+    store = BlobStore(str(tmp_path / 'uploads'), flush_interval=3600)
+    digest = put(store, tmp_path, b'hello', 'a')
+    store.release('a', digest)
+    # Uploaded again before the flusher ran
+    put(store, tmp_path, b'hello', 'b')
+    store.flush()
+    assert store.size(digest) == 5
+    assert store.refs[digest] == {'b': 1}
+    store.close()
+
+
+def test_only_a_room_sharing_the_blob_references_it_again(tmp_path):
+    store = BlobStore(str(tmp_path / 'uploads'), flush_interval=3600)
+    digest = put(store, tmp_path, b'hello', 'a')
+    assert not store.add_ref_if_shared('b', digest)
+    assert store.add_ref_if_shared('a', digest)
+    assert store.refs[digest] == {'a': 2}
+    store.close()
+
+
+def test_refuses_a_multi_process_cluster(tmp_path, monkeypatch):
+    monkeypatch.setenv('CLUSTER_URL', 'redis://localhost:6379/0')
+    with pytest.raises(ValueError):
+        create_blob_store(str(tmp_path))
+
+    monkeypatch.setenv('CLUSTER_URL', 'local://')
+    monkeypatch.setattr(blob_store, '_local_blobs', None)
+    store = create_blob_store(str(tmp_path))
+    assert create_blob_store(str(tmp_path)) is store
+    store.close()
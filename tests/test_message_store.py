@@ -0,0 +1,170 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import message_store  # noqa: E402
+from message_store import LogMessageStore  # noqa: E402
+
+
+def message(n):
+    return {'username': 'bob', 'message': f'm{n}', 'timestamp': '12:00'}
+
+
+def open_store(path, **kwargs):
+    # No fsync batching from the background flusher; the tests flush themselves
+    kwargs.setdefault('fsync_interval', 3600)
+    return LogMessageStore(str(path), capacity=10, **kwargs)
+
+
+def texts(messages):
+    return [m['message'] for m in messages]
+
+
+def test_replay_restores_history_and_ids(tmp_path):
+    store = open_store(tmp_path)
+    for n in range(3):
+        store.append('a', message(n))
+    store.append('b', message(0))
+    store.close()
+
+    store = open_store(tmp_path)
+    assert texts(store.recent('a')) == ['m0', 'm1', 'm2']
+    assert store.append('a', message(3)) == 3
+    assert store.append('b', message(1)) == 1
+    store.close()
+
+
+def test_compaction_keeps_retained_history_only(tmp_path):
+    store = open_store(tmp_path, segment_bytes=200, max_segments=2)
+    for n in range(40):
+        store.append('a', message(n))
+        # What the background flusher does between appends
+        store.flush()
+    segments = [name for name in os.listdir(tmp_path) if name.endswith('.log')]
+    assert len(segments) <= 4
+    store.close()
+
+    store = open_store(tmp_path)
+    assert texts(store.recent('a')) == [f'm{n}' for n in range(30, 40)]
+    assert store.append('a', message(40)) == 40
+    store.close()
+
+
+def test_evicted_room_comes_back_from_its_archive(tmp_path):
+    store = open_store(tmp_path)
+    for n in range(3):
+        store.append('a', message(n))
+    store.evict('a')
+    assert store.room_names() == []
+    assert texts(store.recent('a')) == ['m0', 'm1', 'm2']
+    assert store.append('a', message(3)) == 3
+    store.close()
+
+    store = open_store(tmp_path)
+    assert texts(store.recent('a')) == ['m0', 'm1', 'm2', 'm3']
+    store.close()
+
+
+def test_dropped_room_is_gone(tmp_path):
+    store = open_store(tmp_path)
+    store.append('a', message(0))
+    store.evict('a')
+    store.drop('a')
+    assert store.recent('a') == []
+    store.close()
+
+
+def test_dropped_room_stays_gone_after_restart(tmp_path):
+    store = open_store(tmp_path)
+    for n in range(3):
+        store.append('a', message(n))
+    store.append('b', message(0))
+    store.drop('a')
+    store.close()
+
+    store = open_store(tmp_path)
+    assert store.recent('a') == []
+    assert store.room_names() == ['b']
+    assert store.append('a', message(0)) == 0
+    store.close()
+
+
+def test_evicted_room_is_read_from_its_archive_after_restart(tmp_path):
+    store = open_store(tmp_path)
+    for n in range(3):
+        store.append('a', message(n))
+    store.evict('a')
+    store.close()
+
+    store = open_store(tmp_path)
+    assert store.room_names() == []
+    assert texts(store.recent('a')) == ['m0', 'm1', 'm2']
+    assert store.append('a', message(3)) == 3
+    store.close()
+
+
+def test_room_used_while_its_archive_is_written_keeps_its_history(tmp_path):
+    store = open_store(tmp_path)
+    for n in range(3):
+        store.append('a', message(n))
+    # What another thread sees between evict() letting go of the lock and logging the eviction
+    with store.lock:
+        store.evicting['a'] = list(store.rooms.pop('a'))
+        store.next_ids.pop('a')
+    assert store.append('a', message(3)) == 3
+    assert texts(store.recent('a')) == ['m0', 'm1', 'm2', 'm3']
+    store.close()
+
+
+def test_drop_discards_each_message_once(tmp_path):
+    store = open_store(tmp_path)
+    for n in range(3):
+        store.append('a', message(n))
+    store.evict('a')
+    store.close()
+
+    discarded = []
+    store = open_store(tmp_path)
+    store.on_discard = lambda room, messages: discarded.append(texts(messages))
+    store.drop('a')
+    assert discarded == [['m0', 'm1', 'm2']]
+    store.close()
+
+
+def test_drop_discards_once_when_memory_and_archive_both_have_the_room(tmp_path):
+    store = open_store(tmp_path)
+    for n in range(3):
+        store.append('a', message(n))
+    # A stale archive left behind next to the history in memory
+    path = store._archive_path('a')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.writelines(json.dumps(m) + '\n' for m in store.recent('a'))
+
+    discarded = []
+    store.on_discard = lambda room, messages: discarded.append(texts(messages))
+    store.drop('a')
+    assert discarded == [['m0', 'm1', 'm2']]
+    store.close()
+
+
+def test_log_directory_is_used_by_one_store_at_a_time(tmp_path):
+    store = open_store(tmp_path)
+    with pytest.raises(RuntimeError):
+        open_store(tmp_path)
+    store.close()
+    open_store(tmp_path).close()
+
+
+def test_local_cluster_shares_one_store(monkeypatch):
+    monkeypatch.setenv('CLUSTER_URL', 'local://')
+    monkeypatch.setenv('MESSAGE_STORE', 'memory')
+    monkeypatch.setattr(message_store, '_local_store', None)
+    first, second = message_store.create_message_store(), message_store.create_message_store()
+    assert first.append('a', message(0)) == 0
+    assert second.append('a', message(1)) == 1
+    assert texts(first.recent('a')) == ['m0', 'm1']
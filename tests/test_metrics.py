@@ -0,0 +1,16 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import Counter  # noqa: E402
+
+
+def test_finished_threads_shards_are_merged_without_a_scrape():
+    counter = Counter('events_total', 'Events')
+    # The shard of a thread that has exited; no live thread has this ident
+    counter.shards[-1] = {None: 5}
+    counter.inc()
+    assert -1 not in counter.shards
+    assert counter.retired == {None: 5}
+    assert counter.collect() == {None: 6}
@@ -0,0 +1,38 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from membership import RoomMembership  # noqa: E402
+from presence import PresenceBroadcaster  # noqa: E402
+
+
+class FakeSocketIO:
+    def start_background_task(self, target):
+        pass
+
+
+def broadcaster():
+    sent = []
+    presence = PresenceBroadcaster(FakeSocketIO(), None, emit=lambda event, data, to: sent.append(data))
+    return presence, sent
+
+
+def test_versions_keep_going_up_when_a_room_empties():
+    membership = RoomMembership()
+    assert membership.join('a', 's1', 'bob') == 1
+    assert membership.leave('a', 's1') == 2
+    assert membership.join('a', 's2', 'al') == 3
+    membership.leave('a', 's2')
+    membership.forget('a')
+    assert membership.snapshot('a') == (0, [])
+
+
+def test_delta_spans_changes_reported_out_of_order():
+    presence, sent = broadcaster()
+    presence.joined('a', 's2', 'al', 7)
+    presence.joined('a', 's1', 'bob', 6)
+    presence.flush()
+    assert sent[0]['base'] == 5
+    assert sent[0]['version'] == 7
+    assert sorted(user['name'] for user in sent[0]['joined']) == ['al', 'bob']
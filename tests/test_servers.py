@@ -0,0 +1,100 @@
+import hashlib
+import importlib
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import logs  # noqa: E402
+
+# The servers read their settings when first imported
+os.environ['RATE_LIMITS'] = 'off'
+# Set up before the servers do, so records don't go to pytest's captured stdout
+logs.setup_logging(stream=open(os.devnull, 'w'))
+
+SERVERS = ('app', 'app_fast', 'FINAL_WORKING_VERSION')
+
+
+@pytest.fixture(params=SERVERS)
+def server(request, monkeypatch):
+    # Upload folders and templates are relative to the repository
+    monkeypatch.chdir(ROOT)
+    return importlib.import_module(request.param)
+
+
+def create_room(server, name):
+    client = server.socketio.test_client(server.app)
+    client.emit('create_room', {'username': 'bob', 'room_name': name, 'roomname': name})
+    created = [event for event in client.get_received() if event['name'] == 'room_created']
+    return client, created[0]['args'][0]['code']
+
+
+def test_history_api_clamps_limit(server):
+    client, code = create_room(server, 'limits')
+    for n in range(3):
+        client.emit('send_message', {'message': f'm{n}'})
+    http = server.app.test_client()
+
+    response = http.get(f'/api/rooms/{code}/messages?limit=-5')
+    assert response.status_code == 200
+    assert len(response.get_json()['messages']) == 1
+
+    response = http.get(f'/api/rooms/{code}/messages?before_id=3&limit=-5')
+    assert response.status_code == 200
+    assert [m['message'] for m in response.get_json()['messages']] == ['m2']
+    client.disconnect()
+
+
+def test_fetch_history_clamps_limit(server):
+    client, _ = create_room(server, 'fetch-limits')
+    for n in range(3):
+        client.emit('send_message', {'message': f'm{n}'})
+    reply = client.emit('fetch_history', {'before_id': 3, 'limit': -5}, callback=True)
+    assert [m['message'] for m in reply['messages']] == ['m2']
+    reply = client.emit('fetch_history', ['not', 'a', 'dict'], callback=True)
+    assert reply['error']
+    client.disconnect()
+
+
+def test_typing_ignores_payloads_that_are_not_dicts(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    server = importlib.import_module('app')
+    client, _ = create_room(server, 'typing')
+    client.emit('typing', ['not', 'a', 'dict'])
+    client.emit('typing', 'yes')
+    client.emit('typing', {'typing': True})
+    assert server.typing.rooms['typing']
+    client.disconnect()
+
+
+@pytest.mark.parametrize('name', ['app', 'FINAL_WORKING_VERSION'])
+def test_uploads_are_served_only_as_allowed_types(name, monkeypatch, tmp_path):
+    monkeypatch.chdir(ROOT)
+    server = importlib.import_module(name)
+    body = b'<script>alert(1)</script>'
+    digest = hashlib.sha256(body).hexdigest()
+    src = tmp_path / 'upload'
+    src.write_bytes(body)
+    path = server.blobs.put(str(src), digest, 'serving')
+    http = server.app.test_client()
+    try:
+        assert http.get(f'/uploads/{digest}/evil.html').status_code == 404
+        assert http.get(f'/uploads/{digest}/evil').status_code == 404
+
+        response = http.get(f'/uploads/{digest}/notes.txt')
+        assert response.status_code == 200
+        assert response.mimetype == 'text/plain'
+        assert response.headers['X-Content-Type-Options'] == 'nosniff'
+        assert response.headers['Content-Disposition'] == 'attachment'
+
+        response = http.get(f'/uploads/{digest}/cat.png')
+        assert response.mimetype == 'image/png'
+        assert response.headers['X-Content-Type-Options'] == 'nosniff'
+        assert response.headers['Content-Disposition'] == 'inline'
+        response.close()
+    finally:
+        server.blobs.release('serving', digest)
+        os.remove(path)
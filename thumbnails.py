@@ -0,0 +1,107 @@
+"""Downscaled previews for image and video uploads.
+
+After an upload is stored, a background WorkerPool job writes a JPEG
+preview next to the blob, `<digest>.thumb.jpg`, plus `<digest>.json` with
+the dimensions of the original and of the preview. Images need Pillow
+(`pip install Pillow`); video poster frames need `ffmpeg` on the PATH.
+Without them, or if a file can't be decoded, messages simply go out with no
+preview, as before.
+
+Previews are built once per blob, so a re-sent file reuses them.
+"""
+import json
+import logging
+import os
+import shutil
+import subprocess
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+FFMPEG = shutil.which('ffmpeg')
+
+# Longest side of a preview, in pixels
+THUMB_SIZE = 320
+
+THUMB_SUFFIX = '.thumb.jpg'
+
+log = logging.getLogger('chat.thumbnails')
+
+
+class Previews:
+    def __init__(self, blobs, pool):
+        self.blobs = blobs
+        self.pool = pool
+
+    def can_build(self, kind):
+        if kind == 'image':
+            return Image is not None
+        if kind == 'video':
+            return FFMPEG is not None
+        return False
+
+    def info(self, digest):
+        """Stored preview info for a blob, or None if it has none yet."""
+        try:
+            with open(self.blobs.path(digest) + '.json') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def request(self, digest, kind, done):
+        """Call done(info or None) once a preview for `digest` exists.
+
+        Runs `done` right away when the preview is already there, or when
+        none can be built (no tool for this kind, or the pool is full).
+        """
+        info = self.info(digest)
+        if info is not None or not self.can_build(kind):
+            done(info)
+            return
+        if not self.pool.submit(self.build, digest, kind, done=lambda info, error: done(info)):
+            done(None)
+
+    def build(self, digest, kind):
+        """Write the preview and its info file. Blocking; runs in the pool."""
+        src = self.blobs.path(digest)
+        try:
+            info = self._render(src, kind)
+        except Exception as e:
+            # Remember the failure too, so a re-sent copy doesn't try again
+            log.info('No preview for %s: %s', digest, e)
+            info = {}
+
+        with open(src + '.json.tmp', 'w') as f:
+            json.dump(info, f)
+        os.replace(src + '.json.tmp', src + '.json')
+        return info
+
+    def _render(self, src, kind):
+        thumb = src + THUMB_SUFFIX
+        tmp = thumb + '.tmp'
+
+        info = {}
+        if kind == 'image':
+            with Image.open(src) as image:
+                image = ImageOps.exif_transpose(image)
+                info['width'], info['height'] = image.size
+                image.thumbnail((THUMB_SIZE, THUMB_SIZE))
+                image.convert('RGB').save(tmp, 'JPEG', quality=80)
+        else:
+            # One frame a second in, scaled down; fall back to the first frame for very short clips
+            for seek in ('1', '0'):
+                subprocess.run([FFMPEG, '-loglevel', 'error', '-y', '-ss', seek, '-i', src,
+                                '-frames:v', '1', '-vf', f"scale='min({THUMB_SIZE},iw)':-2",
+                                '-f', 'image2', tmp], check=True, timeout=60)
+                if os.path.exists(tmp) and os.path.getsize(tmp):
+                    break
+            else:
+                raise RuntimeError('ffmpeg found no frame')
+
+        if Image is not None:
+            with Image.open(tmp) as image:
+                info['thumb_width'], info['thumb_height'] = image.size
+        os.replace(tmp, thumb)
+        return info
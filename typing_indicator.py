@@ -0,0 +1,89 @@
+"""Who-is-typing state, aggregated per room and broadcast on a fixed tick.
+
+Clients report when they start and stop typing (and refresh the start every
+few seconds while they keep going) instead of sending every keypress. The
+server keeps the set of typists per room and, once per tick, broadcasts the
+new set to rooms where it changed:
+
+    {'source': 'a1b2c3d4', 'users': [{'id': sid, 'name': username}]}
+
+`source` names the server process, so with several workers a client keeps
+one set per worker and shows their union. Typists that stop refreshing drop
+out after `expire` seconds, so a closed tab does not type forever.
+"""
+import threading
+import time
+import uuid
+
+# How often changed typing sets are broadcast, in seconds
+TYPING_TICK = 0.5
+
+# Drop a typist who has not refreshed for this long; clients refresh every 3s
+TYPING_EXPIRE = 5.0
+
+
+class TypingAggregator:
+    def __init__(self, socketio, event='typing_users', tick=TYPING_TICK, expire=TYPING_EXPIRE, emit=None):
+        self.socketio = socketio
+        self.emit = emit or socketio.emit
+        self.event = event
+        self.tick = tick
+        self.expire = expire
+        self.source = uuid.uuid4().hex[:8]
+        self.rooms = {}
+        self.sent = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.started = False
+
+    def start(self, room, sid, username):
+        with self.lock:
+            if not self.started:
+                self.started = True
+                self.socketio.start_background_task(self._run)
+
+            typists = self.rooms.setdefault(room, {})
+            if sid not in typists:
+                self.dirty.add(room)
+            typists[sid] = (username, time.monotonic() + self.expire)
+
+    def stop(self, room, sid):
+        with self.lock:
+            typists = self.rooms.get(room)
+            if typists and typists.pop(sid, None):
+                self.dirty.add(room)
+                if not typists:
+                    del self.rooms[room]
+
+    def flush(self):
+        now = time.monotonic()
+        updates = []
+        with self.lock:
+            for room, typists in list(self.rooms.items()):
+                expired = [sid for sid, (_, expires) in typists.items() if expires <= now]
+                for sid in expired:
+                    del typists[sid]
+                if expired:
+                    self.dirty.add(room)
+                if not typists:
+                    del self.rooms[room]
+
+            for room in self.dirty:
+                typists = self.rooms.get(room, {})
+                # Someone who started and stopped within one tick changed nothing
+                if set(typists) == self.sent.get(room, set()):
+                    continue
+                if typists:
+                    self.sent[room] = set(typists)
+                else:
+                    self.sent.pop(room, None)
+                updates.append((room, [{'id': sid, 'name': name} for sid, (name, _) in typists.items()]))
+            self.dirty.clear()
+
+        for room, typists in updates:
+            self.emit(self.event, {'source': self.source, 'users': typists}, to=room)
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.tick)
+            self.flush()
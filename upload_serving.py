@@ -0,0 +1,132 @@
+"""Serving uploaded files.
+
+Uploads are stored under their content hash (older ones under a unique
+name) and never change, so responses carry a strong ETag and
+`Cache-Control: public, max-age=<1 year>, immutable`, and repeat visits
+are answered from the browser cache or with a 304. Range
+requests are honoured, so `<video>` can seek without downloading the whole
+file first.
+
+UPLOAD_OFFLOAD hands the file transfer to the front-end web server, so
+media playback does not occupy a chat worker at all:
+
+- unset: stream the file from Python
+- `accel`: reply with `X-Accel-Redirect: <UPLOAD_ACCEL_PREFIX><name>` (nginx).
+  Map the prefix to the upload folder in an `internal` location.
+- `sendfile`: reply with `X-Sendfile: <absolute path>` (Apache mod_xsendfile, lighttpd)
+
+Either way the server serves the file with sendfile() and handles Range
+itself.
+
+The content type comes from the file name's extension, and only the types
+in SERVED_TYPES are served at all; anything else is a 404, so a URL ending
+in `.html` can't turn an upload into a page on our origin. Every response
+says `X-Content-Type-Options: nosniff`, and whatever isn't an image, video
+or audio is sent as an attachment rather than shown in the browser.
+"""
+import hashlib
+import os
+import re
+import stat
+from urllib.parse import quote
+
+from flask import Response, abort, send_file
+from werkzeug.security import safe_join
+
+UPLOAD_OFFLOAD = os.environ.get('UPLOAD_OFFLOAD', '')
+UPLOAD_ACCEL_PREFIX = os.environ.get('UPLOAD_ACCEL_PREFIX', '/_uploads/')
+
+if UPLOAD_OFFLOAD not in ('', 'accel', 'sendfile'):
+    raise ValueError(f'Unknown UPLOAD_OFFLOAD: {UPLOAD_OFFLOAD}')
+
+# Extension -> content type for everything uploads may be; see ALLOWED_EXTENSIONS
+SERVED_TYPES = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'gif': 'image/gif',
+    'mp4': 'video/mp4',
+    'webm': 'video/webm',
+    'pdf': 'application/pdf',
+    'txt': 'text/plain',
+    'doc': 'application/msword',
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+}
+
+# Shown in the page; everything else is downloaded
+INLINE_TYPES = ('image/', 'video/', 'audio/')
+
+# Upload names are unique, so a cached copy never goes stale
+UPLOAD_MAX_AGE = 365 * 24 * 3600
+
+# How files were named before content-addressed storage: `<uuid4>_<name>`.
+# Nothing else in the upload folder (refs.json, .part files) is served.
+LEGACY_NAME_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}_[^/\\]+$')
+
+
+def upload_etag(filename, size):
+    # The name alone identifies the content; the size is there as a sanity check
+    return f'{hashlib.sha1(filename.encode()).hexdigest()[:20]}-{size:x}'
+
+
+def serve_upload(folder, filename):
+    """A file from before content-addressed storage, stored under its own name."""
+    if not LEGACY_NAME_RE.match(filename):
+        abort(404)
+    path = safe_join(os.path.abspath(folder), filename)
+    if path is None:
+        abort(404)
+    return _send(path, filename, None, filename)
+
+
+def serve_blob(blobs, digest, filename, suffix=''):
+    """A file from the BlobStore; `filename` only picks one of SERVED_TYPES.
+
+    `suffix` picks a file derived from the blob instead, like its thumbnail.
+    """
+    relative = blobs.relative_path(digest)
+    if relative is None:
+        abort(404)
+    relative += suffix
+    # The digest names the exact bytes, which is what a strong ETag is for
+    return _send(os.path.abspath(os.path.join(blobs.root, relative)), filename, digest + suffix,
+                 relative.replace(os.sep, '/'))
+
+
+def served_type(filename):
+    """Content type to serve `filename` as, or None if it isn't served."""
+    if '.' not in filename:
+        return None
+    return SERVED_TYPES.get(filename.rsplit('.', 1)[1].lower())
+
+
+def _send(path, filename, etag, accel_path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        abort(404)
+    if not stat.S_ISREG(st.st_mode):
+        abort(404)
+
+    mimetype = served_type(filename)
+    if mimetype is None:
+        abort(404)
+    etag = etag or upload_etag(filename, st.st_size)
+
+    if UPLOAD_OFFLOAD:
+        response = Response(mimetype=mimetype)
+        if UPLOAD_OFFLOAD == 'accel':
+            response.headers['X-Accel-Redirect'] = UPLOAD_ACCEL_PREFIX + quote(accel_path)
+        else:
+            response.headers['X-Sendfile'] = path
+        response.set_etag(etag)
+    else:
+        response = send_file(path, mimetype=mimetype, conditional=True, etag=etag, max_age=UPLOAD_MAX_AGE)
+
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    # The browser names a download after the URL, which ends in the upload's name
+    response.headers['Content-Disposition'] = 'inline' if mimetype.startswith(INLINE_TYPES) else 'attachment'
+    response.cache_control.public = True
+    response.cache_control.max_age = UPLOAD_MAX_AGE
+    response.cache_control.immutable = True
+    return response
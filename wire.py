@@ -0,0 +1,72 @@
+"""Opt-in MessagePack encoding for server-to-client events.
+
+A client asks for it when it connects, with `auth: {codec: 'msgpack'}`.
+Events to that client then carry one binary attachment holding the
+MessagePack-encoded payload instead of JSON text, which is smaller and
+cheaper to decode on phones. Clients that don't ask, or servers without
+`pip install msgpack`, stay on JSON.
+
+Room broadcasts are encoded once per format. A chat room is two Socket.IO
+rooms, `json:<room>` and `msgpack:<room>`, and each client joins the one for
+its codec, so `broadcast()` sends the JSON payload to one and the MessagePack
+bytes to the other. Room names come from users, so both get a prefix: no name
+can land in the other codec's room, or in a client's own sid room. On a
+single process a format nobody in the room uses is not encoded at all.
+Client-to-server events are small and stay JSON.
+"""
+from flask_socketio import join_room
+from socketio import PubSubManager
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_PREFIX = 'json:'
+MSGPACK_PREFIX = 'msgpack:'
+
+
+class Wire:
+    def __init__(self, socketio):
+        self.socketio = socketio
+        self.msgpack_sids = set()
+        # Pages only load the browser's decoder when this is set
+        self.msgpack_enabled = msgpack is not None
+
+    def connect(self, sid, auth):
+        """Pick the codec for a new connection; returns 'msgpack' or 'json'."""
+        if msgpack is not None and isinstance(auth, dict) and auth.get('codec') == 'msgpack':
+            self.msgpack_sids.add(sid)
+            return 'msgpack'
+        return 'json'
+
+    def disconnect(self, sid):
+        self.msgpack_sids.discard(sid)
+
+    def join(self, sid, room):
+        """join_room() for the current client, into the room for its codec."""
+        join_room((MSGPACK_PREFIX if sid in self.msgpack_sids else JSON_PREFIX) + room, sid=sid)
+
+    def send(self, event, data, sid):
+        """Emit to one client in its codec."""
+        if sid in self.msgpack_sids:
+            data = msgpack.packb(data)
+        self.socketio.emit(event, data, to=sid)
+
+    def recipients(self, room):
+        """How many clients on this process a broadcast to `room` reaches."""
+        rooms = self.socketio.server.manager.rooms.get('/', {})
+        return len(rooms.get(JSON_PREFIX + room, ())) + len(rooms.get(MSGPACK_PREFIX + room, ()))
+
+    def broadcast(self, event, data, to):
+        """Emit to everyone in a room, in both codecs."""
+        if self._reaches(JSON_PREFIX + to):
+            self.socketio.emit(event, data, to=JSON_PREFIX + to)
+        if msgpack is not None and self._reaches(MSGPACK_PREFIX + to):
+            self.socketio.emit(event, msgpack.packb(data), to=MSGPACK_PREFIX + to)
+
+    def _reaches(self, room):
+        # Other processes' members of the room are unknown here, so with a
+        # pub/sub manager every broadcast has to go out
+        manager = self.socketio.server.manager
+        return isinstance(manager, PubSubManager) or bool(manager.rooms.get('/', {}).get(room))
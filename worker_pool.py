@@ -0,0 +1,86 @@
+"""Blocking work done off the Socket.IO event path.
+
+A WorkerPool runs a fixed number of background tasks that take jobs from a
+queue and run each one on a real OS thread (see server_config.run_blocking),
+so slow disk or CPU work never stalls the clients sharing the worker. The
+queue is bounded: `submit()` returns False once `max_pending` jobs are
+queued or running, and the caller can tell the client to back off instead
+of piling up work the server can't keep up with.
+
+A handler that needs the result before it can reply uses `call()`, which
+waits for its own job only; the other clients on the worker carry on.
+"""
+import logging
+import threading
+
+import server_config
+
+log = logging.getLogger('chat.worker_pool')
+
+
+class PoolFull(Exception):
+    pass
+
+
+class WorkerPool:
+    def __init__(self, socketio, workers=2, max_pending=32):
+        self.socketio = socketio
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.queue = None
+
+    def submit(self, fn, *args, done=None):
+        """Queue fn(*args); `done(result, error)` runs back on the event path.
+
+        Returns False without queueing when the pool is full.
+        """
+        with self.lock:
+            if self.pending >= self.max_pending:
+                return False
+            self.pending += 1
+            if self.queue is None:
+                self.queue = self.socketio.server.eio.create_queue()
+                for _ in range(self.workers):
+                    self.socketio.start_background_task(self._run)
+        self.queue.put((fn, args, done))
+        return True
+
+    def call(self, fn, *args):
+        """Run fn(*args) in the pool and return its result, or raise its error.
+
+        Raises PoolFull without running anything when the pool is full.
+        """
+        finished = self.socketio.server.eio.create_event()
+        outcome = []
+
+        def done(result, error):
+            outcome.append((result, error))
+            finished.set()
+
+        if not self.submit(fn, *args, done=done):
+            raise PoolFull('Server is busy')
+        finished.wait()
+        result, error = outcome[0]
+        if error is not None:
+            raise error
+        return result
+
+    def _run(self):
+        while True:
+            fn, args, done = self.queue.get()
+            result = error = None
+            try:
+                result = server_config.run_blocking(fn, *args)
+            except Exception as e:
+                error = e
+                if done is None:
+                    log.error('Background job %s failed: %s', getattr(fn, '__name__', fn), e)
+            with self.lock:
+                self.pending -= 1
+            if done is not None:
+                try:
+                    done(result, error)
+                except Exception:
+                    log.exception('Background job callback failed')
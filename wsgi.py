@@ -0,0 +1,21 @@
+"""Production entry point.
+
+    gunicorn -k eventlet -w 1 --bind 0.0.0.0:$PORT wsgi:app
+
+Serves FINAL_WORKING_VERSION.py unless CHAT_APP names another server module
+(`app` or `app_fast`). Defaults ASYNC_MODE to eventlet, which is what the
+gunicorn worker class above expects; use `-k gevent` with ASYNC_MODE=gevent.
+Each worker is one process, so for more than one use CLUSTER_URL.
+"""
+import importlib
+import os
+
+os.environ.setdefault('ASYNC_MODE', 'eventlet')
+
+import server_config
+server_config.monkey_patch()
+
+server = importlib.import_module(os.environ.get('CHAT_APP', 'FINAL_WORKING_VERSION'))
+
+app = server.app
+socketio = server.socketio